@@ -0,0 +1,116 @@
+# Benchmark of the secondary indexes declared in simple/schema.py
+# Builds a temporary database from the data directory, optionally enlarged with copies of every source,
+# and times the lookups used by tests/test_integrity.py and the ingest scripts with and without the indexes.
+# Run from the repository root: python scripts/examples/benchmark_indexes.py [--copies N]
+
+import os
+import sys
+import argparse
+import tempfile
+import timeit
+from sqlalchemy import text
+from astrodbkit2.astrodb import create_database, Database
+sys.path.append(os.getcwd())  # hack to be able to discover simple
+from simple.schema import *
+from simple.build import load_database_parallel
+
+DB_PATH = 'data'
+SOURCE_TABLES = ['Sources', 'Names', 'Photometry', 'Parallaxes', 'ProperMotions', 'SpectralTypes']
+
+QUERIES = {
+    'Names.other_name lookups (x100)':
+        ("SELECT source FROM Names WHERE other_name = :name", 'names'),
+    'Photometry.band IN (...)':
+        ("SELECT source, band, magnitude FROM Photometry WHERE band IN ('WISE_W1', 'WISE_W2')", None),
+    'Photometry.reference lookups (<= 100)':
+        ("SELECT source FROM Photometry WHERE reference = :reference", 'Photometry'),
+    'Parallaxes.reference lookups (<= 100)':
+        ("SELECT source FROM Parallaxes WHERE reference = :reference", 'Parallaxes'),
+    'Sources.reference lookups (<= 100)':
+        ("SELECT source FROM Sources WHERE reference = :reference", 'Sources'),
+    'Distinct Photometry references':
+        ("SELECT DISTINCT reference FROM Photometry", None),
+}
+
+
+def add_copies(db, copies):
+    # Enlarge the database with copies of every source and its data, under new source names
+    with db.engine.begin() as conn:
+        for table in SOURCE_TABLES:
+            rows = [dict(row._mapping) for row in conn.execute(db.metadata.tables[table].select())]
+            if not rows:
+                continue
+            for i in range(copies):
+                new_rows = []
+                for row in rows:
+                    row = dict(row, source=f"{row['source']} #{i}")
+                    if table == 'Names':
+                        row['other_name'] = f"{row['other_name']} #{i}"
+                    new_rows.append(row)
+                conn.execute(db.metadata.tables[table].insert(), new_rows)
+
+
+def time_queries(db, parameters, number):
+    # Best time of each query, in ms
+    results = {}
+    with db.engine.connect() as conn:
+        for label, (sql, parameter) in QUERIES.items():
+            values = [{}] if parameter is None else parameters[parameter]
+            # A query without results only times an empty index probe
+            if not any(conn.execute(text(sql), value).first() for value in values):
+                raise RuntimeError(f'{label}: no rows returned, the benchmark would be meaningless')
+
+            def run():
+                for value in values:
+                    conn.execute(text(sql), value).fetchall()
+
+            results[label] = min(timeit.repeat(run, number=number, repeat=3)) / number * 1000
+            plan = conn.execute(text('EXPLAIN QUERY PLAN ' + sql), values[0]).fetchall()
+            results[label] = (results[label], '; '.join(row[-1] for row in plan))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the secondary indexes of the SIMPLE schema')
+    parser.add_argument('--copies', type=int, default=20, help='Copies of every source to add (default: 20)')
+    parser.add_argument('--number', type=int, default=5, help='Runs of each query per timing (default: 5)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        connection_string = 'sqlite:///' + os.path.join(directory, 'benchmark.db')
+        create_database(connection_string)
+        db = Database(connection_string)
+        load_database_parallel(db, DB_PATH)
+        add_copies(db, args.copies)
+        print(f'{db.query(db.Sources).count()} sources, {db.query(db.Photometry).count()} photometry rows, '
+              f'{db.query(db.Names).count()} names')
+
+        names = [{'name': row[0]} for row in db.query(db.Names.c.other_name).limit(100).all()]
+        parameters = {'names': names}
+        for table in ['Photometry', 'Parallaxes', 'Sources']:
+            # References used by the table, so every lookup finds rows
+            column = db.metadata.tables[table].c.reference
+            parameters[table] = [{'reference': row[0]} for row in db.query(column).distinct().limit(100).all()]
+
+        with_indexes = time_queries(db, parameters, args.number)
+
+        # Drop the secondary indexes, keeping those created for the primary keys
+        indexes = [index for table in db.metadata.sorted_tables for index in table.indexes]
+        with db.engine.begin() as conn:
+            for index in indexes:
+                conn.execute(text(f'DROP INDEX "{index.name}"'))
+        without_indexes = time_queries(db, parameters, args.number)
+
+        print(f"\n{'Query':40s} {'without (ms)':>12s} {'with (ms)':>10s} {'speedup':>8s}")
+        for label in QUERIES:
+            before, after = without_indexes[label][0], with_indexes[label][0]
+            print(f'{label:40s} {before:12.2f} {after:10.2f} {before / after:7.1f}x')
+            print(f'    without: {without_indexes[label][1]}')
+            print(f'    with:    {with_indexes[label][1]}')
+
+        db.session.close()
+        db.engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,18 @@
+import sys
 from astrodbkit2.astrodb import create_database
-from astrodbkit2.astrodb import Database
 from astropy.table import Table
+sys.path.append('../../')  # hack to be able to discover simple
 from utils import ingest_parallaxes
+from simple.database import connect
+from simple.changes import create_change_tracking, drop_change_tracking
+from simple.export import save_database
 
 connection_string = 'sqlite:///../../SIMPLE.db'  # SQLite
 create_database(connection_string)
-db = Database(connection_string)
+db = connect(connection_string)
 db.load_database('../../data')
+# Only the JSON files of the sources changed by this ingest are saved at the end
+create_change_tracking(db)
 
 # load table
 ingest_table = Table.read('Y-dwarf_table.csv', data_start=2)
@@ -18,4 +24,6 @@ plx_ref = ingest_table['astrometry_ref']
 ingest_parallaxes(db, sources, plx, plx_unc, plx_ref, verbose=True)
 
 # Save modified JSON files
-db.save_db('../../data')
+save_database(db, '../../data', changed_only=True)
+# Stop tracking changes, so the database also works with astrodbkit2 alone
+drop_change_tracking(db.engine, db)
@@ -1,17 +1,24 @@
 # Script to add Y dwarfs spectral types
 
+import sys
 from astrodbkit2.astrodb import create_database
-from astrodbkit2.astrodb import Database
 #from simple.schema import *
 from astropy.table import Table
 import numpy as np
 import re
+sys.path.append('../../')  # hack to be able to discover simple
 from utils import convert_spt_string_to_code
+from simple.adopted import recompute_adopted
+from simple.database import connect
+from simple.changes import create_change_tracking, drop_change_tracking
+from simple.export import save_database
 
 connection_string = 'sqlite:///../../SIMPLE.db'  # SQLite
 create_database(connection_string)
-db = Database(connection_string)
+db = connect(connection_string)
 db.load_database('../../data')
+# Only the JSON files of the sources changed by this ingest are saved at the end
+create_change_tracking(db)
 
 
 # load table
@@ -45,4 +52,9 @@ if len(new_ref)>0:
 SpT_table = Table([db_names, spectral_types, spectral_type_codes, regime, spt_refs], names=('source','spectral_type_string','spectral_type_code','regime','reference'))
 db.add_table_data(SpT_table, table='SpectralTypes', fmt='astropy')
 
-db.save_db('../../data')
\ No newline at end of file
+# Set the adopted spectral type of the ingested sources
+recompute_adopted(db, tables=['SpectralTypes'], sources=db_names)
+
+save_database(db, '../../data', changed_only=True)
+# Stop tracking changes, so the database also works with astrodbkit2 alone
+drop_change_tracking(db.engine, db)
\ No newline at end of file
@@ -1,31 +1,44 @@
 # Script to ingest Y dwarfs from Kirkpartick+2019
 
+import sys
 from astrodbkit2.astrodb import create_database
-from astrodbkit2.astrodb import Database
 #from simple.schema import *
 from astropy.table import Table
 import numpy as np
+sys.path.append('../../')  # hack to be able to discover simple
+from simple.spatial import crossmatch
+from simple.database import connect
+from simple.changes import create_change_tracking, drop_change_tracking
+from simple.export import save_database
 
 connection_string = 'sqlite:///../../SIMPLE.db'  # SQLite
 create_database(connection_string)
-db = Database(connection_string)
+db = connect(connection_string)
 db.load_database('../../data')
+# Only the JSON files of the sources changed by this ingest are saved at the end
+create_change_tracking(db)
 
 
 # load table of sources to ingest
 Ydwarfs = Table.read('Y-dwarf_table.csv',data_start=2)
 
-# find sources already in database
-existing_sources = []
-missing_sources = []
-db_names = []
-for i,name in enumerate(Ydwarfs['source']):
-	if len(db.search_object(name,resolve_simbad=True)) != 0:
+# find sources already in database, matching positions and names in a single pass
+match_radius = 2 / 3600  # degrees
+matches = crossmatch(db, Ydwarfs, radius=match_radius, name_col='source')
+existing_sources = list(matches['matched'])
+missing_sources = list(matches['unmatched'])
+db_names = list(Ydwarfs['source'])
+for i, db_name in zip(matches['matched'], matches['source']):
+	db_names[i] = db_name
+# several candidates: use the nearest one within the match radius, otherwise leave the row for manual review
+for i, candidates, separations in zip(matches['ambiguous'], matches['candidates'], matches['candidate_separations']):
+	nearest = np.nanargmin(separations) if np.isfinite(separations).any() else None
+	if nearest is not None and separations[nearest] <= match_radius:
+		print(f"{Ydwarfs['source'][i]} matches several sources: {candidates}, using the nearest: {candidates[nearest]}")
 		existing_sources.append(i)
-		db_names.append(db.search_object(name,resolve_simbad=True)[0].source)
+		db_names[i] = candidates[nearest]
 	else:
-		missing_sources.append(i)
-		db_names.append(Ydwarfs['source'][i])
+		print(f"{Ydwarfs['source'][i]} matches several sources by name: {candidates}, deferred for manual review")
 
 # add missing references
 ref_list = Ydwarfs['reference'].tolist()
@@ -50,12 +63,16 @@ if len(missing_sources)>0:
 	db.Names.insert().execute(names_data)
 
 # add other names for existing sources if alternative names not in database yet
+known_names = db.query(db.Names.c.source, db.Names.c.other_name).\
+	filter(db.Names.c.source.in_([db_names[es] for es in existing_sources])).all()
+known_names = set(tuple(x) for x in known_names)
 other_names_data = []
 for es in existing_sources:
-	es_names = db.search_object(db_names[es], output_table='Names')
-	if Ydwarfs['source'][es] not in [x[1] for x in es_names]:
+	if (db_names[es], Ydwarfs['source'][es]) not in known_names:
 		other_names_data.append({'source': db_names[es], 'other_name':Ydwarfs['source'][es]})
-if len(existing_sources)>0:
+if len(other_names_data)>0:
 	db.Names.insert().execute(other_names_data)
 
-db.save_db('../../data')
+save_database(db, '../../data', changed_only=True)
+# Stop tracking changes, so the database also works with astrodbkit2 alone
+drop_change_tracking(db.engine, db)
@@ -1,7 +1,13 @@
 # Script to add photometry from the BDNYC database into SIMPLE
 
+import sys
+import os
 from astrodbkit2.astrodb import Database, and_
 from sqlalchemy import types  # for BDNYC column overrides
+sys.path.append(os.getcwd())  # hack to be able to discover simple
+from simple.database import connect
+from simple.changes import create_change_tracking, drop_change_tracking
+from simple.export import save_database
 
 verbose = True
 
@@ -21,11 +27,13 @@ bdnyc = Database(connection_string,
 
 # SIMPLE
 connection_string = 'sqlite:///SIMPLE.db'
-db = Database(connection_string)
+db = connect(connection_string)
 
 # --------------------------------------------------------------------------------------
 # Reload from directory, if needed
 db.load_database('data', verbose=False)
+# Only the JSON files of the sources changed by this ingest are saved at the end
+create_change_tracking(db)
 
 # --------------------------------------------------------------------------------------
 # For each source in SIMPLE, search in BDNYC and grab specified photometry
@@ -94,4 +102,6 @@ for source, bdnyc_id in source_dict.items():
 
 # --------------------------------------------------------------------------------------
 # Output changes to directory
-db.save_database('data')
+save_database(db, 'data', changed_only=True)
+# Stop tracking changes, so the database also works with astrodbkit2 alone
+drop_change_tracking(db.engine, db)
@@ -1,8 +1,14 @@
 # Script to copy over BDNYC database sources into SIMPLE
 
+import sys
+import os
 from astrodbkit2.astrodb import Database, and_
 from sqlalchemy import types  # for BDNYC column overrides
 from collections import Counter
+sys.path.append(os.getcwd())  # hack to be able to discover simple
+from simple.database import connect
+from simple.changes import create_change_tracking, drop_change_tracking
+from simple.export import save_database
 
 # Establish connection to databases
 
@@ -19,7 +25,9 @@ bdnyc = Database(connection_string,
 
 # SIMPLE
 connection_string = 'sqlite:///SIMPLE.db'
-db = Database(connection_string)
+db = connect(connection_string)
+# Only the JSON files of the sources changed by this ingest are saved
+create_change_tracking(db)
 
 # Copy first publications that are not already in SIMPLE
 temp = db.query(db.Publications.c.name).all()
@@ -39,7 +47,7 @@ db.Publications.insert().execute(data)
 
 # Verify insert and save to disk
 db.query(db.Publications).count()
-db.save_db('data')
+save_database(db, 'data', changed_only=True)
 
 # ----------------------------------------------------------------------------------------
 # Add Sources that are not already in SIMPLE
@@ -130,4 +138,6 @@ for old_name, new_name in name_updates.items():
         .values(source=new_name)
     db.engine.execute(stmt)
 
-db.save_db('data')
+save_database(db, 'data', changed_only=True)
+# Stop tracking changes, so the database also works with astrodbkit2 alone
+drop_change_tracking(db.engine, db)
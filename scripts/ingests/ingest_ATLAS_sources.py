@@ -4,21 +4,26 @@
 
 #------------------------------------------------------------------------------------------------
 
+import sys
 from astrodbkit2.astrodb import create_database
-from astrodbkit2.astrodb import Database
 #from simple.schema import *
 from astropy.table import Table
 import numpy as np
-from astropy.coordinates import SkyCoord
-import astropy.units as u
-from astroquery.simbad import Simbad
 import warnings
 warnings.filterwarnings("ignore", module='astroquery.simbad')
+sys.path.append('../../')  # hack to be able to discover simple
+from simple.spatial import crossmatch
+from simple.database import connect
+from simple.changes import create_change_tracking, drop_change_tracking
+from simple.export import save_database
+from utils import check_names_simbad, known_names_policy, review_policy
 
 connection_string = 'sqlite:///../../SIMPLE.db'  # SQLite
 create_database(connection_string)
-db = Database(connection_string)
+db = connect(connection_string)
 db.load_database('../../data')
+# Only the JSON files of the sources changed by this ingest are saved at the end
+create_change_tracking(db)
 
 
 # load table of sources to ingest
@@ -26,61 +31,38 @@ input_file = ("ATLAS_table.vot")
 ATLAS=Table.read(input_file)
 
 #Making sure all target names are simbad resolvable:
-
-resolved_name = []
-
-for j in range(len(ATLAS)):
-	identifer_result_table = Simbad.query_object(ATLAS['Name'][j], verbose=False)
-	if identifer_result_table is not None and len(identifer_result_table) == 1:
-		# Successfully identified
-		if isinstance(identifer_result_table['MAIN_ID'][0],str):
-			resolved_name.append(identifer_result_table['MAIN_ID'][0])
-		else:
-			resolved_name.append(identifer_result_table['MAIN_ID'][0].decode())
-	else:
-		coord_result_table = Simbad.query_region(SkyCoord(ATLAS['_RAJ2000'][j],
-			ATLAS['_DEJ2000'][j], unit=(u.deg, u.deg), frame='icrs'), radius='2s', verbose=False)
-
-		if len(coord_result_table) > 1:
-			for i, name in enumerate(coord_result_table['MAIN_ID']):
-				print(f'{i}: {name}')
-			selection = int(input('Choose \n'))
-			#print(selection)
-			#print(coord_result_table[selection])
-			if isinstance(coord_result_table['MAIN_ID'][selection],str):
-				resolved_name.append(coord_result_table['MAIN_ID'][selection])
-			else:
-				resolved_name.append(coord_result_table['MAIN_ID'][selection].decode())
-
-		elif len(coord_result_table) == 1:
-			#print(coord_result_table[0])
-			if isinstance(coord_result_table['MAIN_ID'][0],str):
-				resolved_name.append(coord_result_table['MAIN_ID'][0])
-			else:
-				resolved_name.append(coord_result_table['MAIN_ID'][0].decode())
-
-		else:
-			print("coord search failed")
-			resolved_name.append(ATLAS['Name'][j])
-
-
-
-# find sources already in database
-existing_sources = []
-missing_sources = []
-db_names = []
-for i,name in enumerate(resolved_name):
-	if len(db.search_object(name,resolve_simbad=True, verbose=False)) != 0:
+# Simbad is queried in batches and answers are cached, so reruns do not query Simbad again
+# Ambiguous positions use the object already in the Names table, otherwise they are deferred to the review file
+# and left out of this ingest. Add a "selection" to the review file entries and rerun to ingest them.
+review_file = 'ATLAS_review.json'
+resolved_name = check_names_simbad(ATLAS['Name'], ATLAS['_RAJ2000'], ATLAS['_DEJ2000'], radius='2s',
+								   policy=known_names_policy(db, fallback=review_policy(review_file)),
+								   review_file=review_file)
+keep = [name is not None for name in resolved_name]
+ATLAS = ATLAS[keep]
+resolved_name = [name for name in resolved_name if name is not None]
+
+# find sources already in database, matching positions and resolved names in a single pass
+ATLAS["source"]=resolved_name
+match_radius = 2 / 3600  # degrees
+matches = crossmatch(db, ATLAS, radius=match_radius, ra_col='_RAJ2000', dec_col='_DEJ2000', name_col='source')
+existing_sources = list(matches['matched'])
+missing_sources = list(matches['unmatched'])
+db_names = list(resolved_name)
+for i, db_name in zip(matches['matched'], matches['source']):
+	db_names[i] = db_name
+# several candidates: use the nearest one within the match radius, otherwise leave the row for manual review
+for i, candidates, separations in zip(matches['ambiguous'], matches['candidates'], matches['candidate_separations']):
+	nearest = np.nanargmin(separations) if np.isfinite(separations).any() else None
+	if nearest is not None and separations[nearest] <= match_radius:
+		print(f"{resolved_name[i]} matches several sources: {candidates}, using the nearest: {candidates[nearest]}")
 		existing_sources.append(i)
-		db_names.append(db.search_object(name,resolve_simbad=True)[0].source)
-
+		db_names[i] = candidates[nearest]
 	else:
-		missing_sources.append(i)
-		db_names.append(resolved_name[i])
+		print(f"{resolved_name[i]} matches several sources by name: {candidates}, deferred for manual review")
 
 # renaming column heads for ingest
 ATLAS["reference"]=["Missing"]*len(ATLAS["Name"])
-ATLAS["source"]=resolved_name
 #ATLAS.rename_column('Name', 'source')
 ATLAS.rename_column('_RAJ2000', 'ra')
 ATLAS.rename_column('_DEJ2000', 'dec')
@@ -100,15 +82,19 @@ if len(missing_sources)>0:
 	db.Names.insert().execute(names_data)
 
 # add other names for existing sources if alternative names not in database yet
+known_names = db.query(db.Names.c.source, db.Names.c.other_name).\
+	filter(db.Names.c.source.in_([db_names[es] for es in existing_sources])).all()
+known_names = set(tuple(x) for x in known_names)
 other_names_data = []
 for es in existing_sources:
-	es_names = db.search_object(db_names[es], output_table='Names')
-	if ATLAS['Name'][es] not in [x[1] for x in es_names]:
+	if (db_names[es], ATLAS['Name'][es]) not in known_names:
 		other_names_data.append({'source': db_names[es], 'other_name':ATLAS['Name'][es]})
 
-if len(existing_sources)>0:
+if len(other_names_data)>0:
 	db.Names.insert().execute(other_names_data)
 
-db.save_db('../../data')
+save_database(db, '../../data', changed_only=True)
+# Stop tracking changes, so the database also works with astrodbkit2 alone
+drop_change_tracking(db.engine, db)
 
 
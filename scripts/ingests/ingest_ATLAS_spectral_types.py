@@ -1,16 +1,22 @@
 #------------------------------------------------------------------------------------------------
 
+import sys
 from astrodbkit2.astrodb import create_database
-from astrodbkit2.astrodb import Database
 from astropy.table import Table
 import numpy as np
 import re
+sys.path.append('../../')  # hack to be able to discover simple
 from utils import convert_spt_string_to_code
+from simple.database import connect
+from simple.changes import create_change_tracking, drop_change_tracking
+from simple.export import save_database
 
 connection_string = 'sqlite:///../../SIMPLE.db'  # SQLite
 create_database(connection_string)
-db = Database(connection_string)
+db = connect(connection_string)
 db.load_database('../../data')
+# Only the JSON files of the sources changed by this ingest are saved at the end
+create_change_tracking(db)
 
 
 # load table of sources to ingest
@@ -35,4 +41,9 @@ for name in names:
 
 # Convert SpT string to code
 spectral_type_codes_optical = convert_spt_string_to_code(spectral_types_optical, verbose = True)
-spectral_type_codes_nir = convert_spt_string_to_code(spectral_types_nir, verbose = True)
\ No newline at end of file
+spectral_type_codes_nir = convert_spt_string_to_code(spectral_types_nir, verbose = True)
+
+# Save modified JSON files
+save_database(db, '../../data', changed_only=True)
+# Stop tracking changes, so the database also works with astrodbkit2 alone
+drop_change_tracking(db.engine, db)
@@ -1,163 +1,731 @@
+import os
+import json
+import time
+from functools import lru_cache
 import numpy as np
-from astropy.coordinates import SkyCoord
+from astropy.coordinates import SkyCoord, Angle
 import astropy.units as u
+from astropy.table import Table
 from astroquery.simbad import Simbad
+from simple.adopted import update_adopted
+from simple.names import normalize_name
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
 import warnings
 warnings.filterwarnings("ignore", module='astroquery.simbad')
 import re
 
+# Default location of the on-disk cache of Simbad answers
+SIMBAD_CACHE = os.path.join(os.path.expanduser('~'), '.simple', 'simbad_cache.json')
+# Default review file for the ambiguities deferred by check_names_simbad, in the working directory
+SIMBAD_REVIEW_FILE = 'simbad_review.json'
 
-# Make sure all source names are Simbad resolvable:
-def check_names_simbad(ingest_names, ingest_ra, ingest_dec, radius='2s', verbose=False):
-    verboseprint = print if verbose else lambda *a, **k: None
 
-    resolved_names = []
-    n_sources = len(ingest_names)
-    n_name_matches = 0
-    n_selections = 0
-    n_nearby = 0
-    n_notfound = 0
-
-    for i, ingest_name in enumerate(ingest_names):
-        # Query Simbad for identifiers matching the ingest source name
-        identifer_result_table = Simbad.query_object(ingest_name, verbose=False)
-
-        # Successfully resolved one matching identifier in Simbad
-        if identifer_result_table is not None and len(identifer_result_table) == 1:
-            # Add the Simbad resolved identifier ot the resolved_name list and deals with unicode
-            if isinstance(identifer_result_table['MAIN_ID'][0], str):
-                resolved_names.append(identifer_result_table['MAIN_ID'][0])
-            else:
-                resolved_names.append(identifer_result_table['MAIN_ID'][0].decode())
-            verboseprint(resolved_names[i], "Found name match in Simbad")
-            n_name_matches = n_name_matches + 1
+def _decode(value):
+    # Simbad strings can come back as bytes depending on the astroquery version
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def _column(table, *names):
+    # Case-insensitive column lookup, since astroquery versions differ (MAIN_ID vs main_id)
+    colnames = {c.lower(): c for c in table.colnames}
+    for name in names:
+        if name.lower() in colnames:
+            return table[colnames[name.lower()]]
+    return None
+
+
+def default_simbad_service():
+    """
+    Simbad query object used by SimbadResolver, with the identifier and object type columns added when available
+
+    :return: astroquery.simbad.SimbadClass instance
+    """
+    simbad = Simbad()
+    for field in ('typed_id', 'otype'):
+        try:
+            simbad.add_votable_fields(field)
+        except (KeyError, ValueError):
+            # Not a valid field for this version of astroquery
+            pass
+    return simbad
+
+
+# Policies to choose between several Simbad objects found around a position.
+# A policy is called as policy(ingest_name, objects), with objects the list of dictionaries
+# (main_id, ra, dec, otype, separation) sorted by separation, and returns the chosen main_id,
+# or None to defer the choice to a later review.
+def ask_policy(ingest_name, objects):
+    """Interactively ask for the object to use"""
+    print(ingest_name)
+    for j, obj in enumerate(objects):
+        print(f"{j}: {obj['main_id']}")
+    selection = int(input('Choose \n'))
+    return objects[selection]['main_id']
+
+
+def nearest_policy(ingest_name, objects):
+    """Use the nearest object"""
+    return objects[0]['main_id']
+
+
+def defer_policy(ingest_name, objects):
+    """Defer every ambiguity to the review file"""
+    return None
+
+
+def otype_policy(otypes, fallback=defer_policy):
+    """
+    Policy using the nearest object with one of the preferred Simbad object types
+
+    :param otypes: object types, in order of preference (eg, ['BD*', 'LM*'])
+    :param fallback: policy to use when no object has one of the types. Default: defer_policy
+    :return: policy
+    """
+    def policy(ingest_name, objects):
+        for otype in otypes:
+            for obj in objects:
+                if obj.get('otype') == otype:
+                    return obj['main_id']
+        return fallback(ingest_name, objects)
+    return policy
+
+
+def known_names_policy(db, fallback=defer_policy):
+    """
+    Policy using the object whose identifier is already in the Names table, when only one of them is.
+    Identifiers and names are compared after normalization, see simple.names.normalize_name.
+
+    :param db: Database with the Names table
+    :param fallback: policy to use when none or several objects are known. Default: defer_policy
+    :return: policy
+    """
+    known_names = set()
+
+    def policy(ingest_name, objects):
+        if not known_names:
+            # Read the Names table once, on first use
+            known_names.update(normalize_name(name) for name, in db.query(db.Names.c.other_name).all())
+            known_names.discard(None)
+        known = [obj for obj in objects if normalize_name(obj['main_id']) in known_names]
+        if len(known) == 1:
+            return known[0]['main_id']
+        return fallback(ingest_name, objects)
+    return policy
+
+
+def review_policy(review_file, fallback=defer_policy):
+    """
+    Policy using the selections recorded in a review file written by SimbadResolver.resolve.
+    Entries of the file can be resolved by adding a "selection" key with the chosen main_id.
+
+    :param review_file: JSON review file
+    :param fallback: policy for ambiguities without a selection. Default: defer_policy
+    :return: policy
+    """
+    selections = {}
+    if os.path.exists(review_file):
+        with open(review_file, 'r') as f:
+            selections = {entry['ingest_name']: entry['selection'] for entry in json.load(f)
+                          if entry.get('selection')}
+
+    def policy(ingest_name, objects):
+        if ingest_name in selections:
+            return selections[ingest_name]
+        return fallback(ingest_name, objects)
+    return policy
+
+
+class SimbadResolver:
+    """
+    Resolve source names with batched Simbad queries, keeping every answer in an on-disk cache.
+
+    Names are sent in chunks with query_objects and only names that are not found in Simbad are searched
+    by position, again in chunks with query_region. Answers, including failed lookups, are cached by
+    normalized name or rounded coordinates and reused until they are older than the time-to-live.
+
+    The service can be replaced by any object with query_objects(names) and query_region(coordinates, radius)
+    methods returning astropy Tables with Simbad-like columns (main_id, ra, dec, and optionally
+    user_specified_id/typed_id and otype), for example a recorded stand-in for tests.
+
+    :param cache_file: JSON file for the cache, None to only cache in memory. Default: ~/.simple/simbad_cache.json
+    :param ttl: Time-to-live of cache entries, in days. Default: 30
+    :param chunk_size: Maximum number of names or positions per Simbad query. Default: 500
+    :param service: Simbad query object. Default: default_simbad_service()
+    """
+
+    def __init__(self, cache_file=SIMBAD_CACHE, ttl=30, chunk_size=500, service=None):
+        self.cache_file = cache_file
+        self.ttl = ttl * 86400.
+        self.chunk_size = chunk_size
+        self.service = service if service is not None else default_simbad_service()
+        self.cache = {'names': {}, 'regions': {}}
+        self.deferred = []
+
+        if cache_file is not None and os.path.exists(cache_file):
+            with open(cache_file, 'r') as f:
+                cache = json.load(f)
+            now = time.time()
+            for kind in self.cache:
+                self.cache[kind] = {k: v for k, v in cache.get(kind, {}).items() if now - v['time'] < self.ttl}
+
+    def save(self):
+        """Write the cache to disk"""
+        if self.cache_file is None:
+            return
+        directory = os.path.dirname(self.cache_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.cache_file, 'w') as f:
+            json.dump(self.cache, f)
+
+    @staticmethod
+    def name_key(name):
+        """Cache key for a name: whitespace collapsed and lower case"""
+        return re.sub(r"\s+", " ", _decode(name)).strip().lower()
+
+    @staticmethod
+    def region_key(ra, dec, radius):
+        """Cache key for a cone: coordinates rounded to 1e-5 deg and radius in arcsec"""
+        return f'{float(ra):.5f} {float(dec):+.5f} {Angle(radius).arcsec:.3f}'
+
+    def query_names(self, names):
+        """
+        Get the Simbad main identifier of each name, None when Simbad does not know the name
+
+        :param names: list of names
+        :return: list of main identifiers
+        """
+        keys = [self.name_key(name) for name in names]
+        missing = {}
+        for name, key in zip(names, keys):
+            if key not in self.cache['names']:
+                missing.setdefault(key, _decode(name))
+
+        missing = list(missing.items())
+        for start in range(0, len(missing), self.chunk_size):
+            chunk = missing[start:start + self.chunk_size]
+            now = time.time()
+            results = {key: None for key, _ in chunk}
+
+            table = self.service.query_objects([name for _, name in chunk])
+            if table is not None and len(table) > 0:
+                main_ids = _column(table, 'main_id')
+                typed_ids = _column(table, 'user_specified_id', 'typed_id')
+                script_ids = _column(table, 'script_number_id')
+                for i in range(len(table)):
+                    if np.ma.is_masked(main_ids[i]) or _decode(main_ids[i]).strip() == '':
+                        continue
+                    if typed_ids is not None:
+                        key = self.name_key(typed_ids[i])
+                    elif script_ids is not None:
+                        key = chunk[int(script_ids[i]) - 1][0]
+                    else:
+                        key = chunk[i][0]
+                    if key in results:
+                        results[key] = _decode(main_ids[i])
+
+            for key, main_id in results.items():
+                self.cache['names'][key] = {'time': now, 'main_id': main_id}
+            self.save()
+
+        return [self.cache['names'][key]['main_id'] for key in keys]
+
+    def query_regions(self, ra, dec, radius='2s'):
+        """
+        Get the Simbad objects within a radius of each position
+
+        :param ra: list of right ascensions (deg)
+        :param dec: list of declinations (deg)
+        :param radius: search radius. Default: 2 arcsec
+        :return: list, for each position, of lists of dictionaries with main_id, ra, dec, otype, and separation (arcsec)
+            sorted by separation
+        """
+        keys = [self.region_key(r, d, radius) for r, d in zip(ra, dec)]
+        missing = {}
+        for r, d, key in zip(ra, dec, keys):
+            if key not in self.cache['regions']:
+                missing.setdefault(key, (float(r), float(d)))
+
+        missing = list(missing.items())
+        radius_arcsec = Angle(radius).arcsec
+        for start in range(0, len(missing), self.chunk_size):
+            chunk = missing[start:start + self.chunk_size]
+            now = time.time()
+            centers = SkyCoord([c[0] for _, c in chunk], [c[1] for _, c in chunk], unit=(u.deg, u.deg), frame='icrs')
+            results = {key: [] for key, _ in chunk}
+
+            table = self.service.query_region(centers, radius=radius)
+            if table is not None and len(table) > 0:
+                main_ids = _column(table, 'main_id')
+                otypes = _column(table, 'otype')
+                if 'ra' in table.colnames:
+                    objects = SkyCoord(table['ra'], table['dec'], unit=(u.deg, u.deg), frame='icrs')
+                else:
+                    objects = SkyCoord(_column(table, 'ra'), _column(table, 'dec'), unit=(u.hourangle, u.deg),
+                                       frame='icrs')
+                # Assign each object to every queried position within the radius
+                for j, center in enumerate(centers):
+                    separation = center.separation(objects).arcsec
+                    for i in np.nonzero(separation <= radius_arcsec)[0]:
+                        results[chunk[j][0]].append({'main_id': _decode(main_ids[i]),
+                                                     'ra': float(objects[i].ra.deg),
+                                                     'dec': float(objects[i].dec.deg),
+                                                     'otype': _decode(otypes[i]) if otypes is not None else None,
+                                                     'separation': float(separation[i])})
+
+            for key, objects_found in results.items():
+                objects_found.sort(key=lambda x: x['separation'])
+                self.cache['regions'][key] = {'time': now, 'objects': objects_found}
+            self.save()
+
+        return [self.cache['regions'][key]['objects'] for key in keys]
+
+    def resolve(self, ingest_names, ingest_ra, ingest_dec, radius='2s', verbose=False, policy=defer_policy,
+                review_file=None):
+        """
+        Resolve names to Simbad main identifiers, see check_names_simbad
+
+        :param ingest_names: list of names
+        :param ingest_ra: list of right ascensions (deg)
+        :param ingest_dec: list of declinations (deg)
+        :param radius: radius of the positional search. Default: 2 arcsec
+        :param verbose: print the outcome for each name
+        :param policy: policy to choose between several objects found around a position. Default: defer_policy
+        :param review_file: JSON file to which deferred ambiguities are added. Default: None (only kept in deferred)
+        :return: list of resolved names, None for deferred ambiguities
+        """
+        verboseprint = print if verbose else lambda *a, **k: None
+
+        ingest_names = [_decode(name) for name in ingest_names]
+        n_sources = len(ingest_names)
+        n_name_matches = 0
+        n_selections = 0
+        n_nearby = 0
+        n_notfound = 0
+        deferred = []
+
+        # Query Simbad for identifiers matching the ingest source names
+        resolved_names = self.query_names(ingest_names)
 
         # If no identifier match found, search within "radius" of coords for a Simbad object
-        else:
-            verboseprint("searching around ", ingest_name)
-            coord_result_table = Simbad.query_region(
-                SkyCoord(ingest_ra[i], ingest_dec[i], unit=(u.deg, u.deg), frame='icrs'), radius=radius, verbose=verbose)
-                
+        misses = [i for i, name in enumerate(resolved_names) if name is None]
+        regions = self.query_regions([ingest_ra[i] for i in misses], [ingest_dec[i] for i in misses], radius=radius)
+        region_results = dict(zip(misses, regions))
+
+        for i, ingest_name in enumerate(ingest_names):
+            if i not in region_results:
+                verboseprint(resolved_names[i], "Found name match in Simbad")
+                n_name_matches = n_name_matches + 1
+                continue
+
+            objects_found = region_results[i]
             # If no match is found in Simbad, use the name in the ingest table
-            if coord_result_table is None:
-                resolved_names.append(ingest_name)
-                verboseprint("coord search failed")
+            if len(objects_found) == 0:
+                resolved_names[i] = ingest_name
+                verboseprint(ingest_name, "coord search failed")
                 n_notfound = n_notfound + 1
-                
-            # If more than one match found within "radius", query user for selection and append to resolved_name
-            elif len(coord_result_table) > 1:
-                for j, name in enumerate(coord_result_table['MAIN_ID']):
-                    print(f'{j}: {name}')
-                selection = int(input('Choose \n'))
-                if isinstance(coord_result_table['MAIN_ID'][selection], str):
-                    resolved_names.append(coord_result_table['MAIN_ID'][selection])
-                else:
-                    resolved_names.append(coord_result_table['MAIN_ID'][selection].decode())
-                verboseprint(resolved_names[i], "you selected")
-                n_selections = n_selections + 1
-
-            # If there is only one match found, accept it and append to the resolved_name list
-            elif len(coord_result_table) == 1:
-                if isinstance(coord_result_table['MAIN_ID'][0], str):
-                    resolved_names.append(coord_result_table['MAIN_ID'][0])
+
+            # If more than one match found within "radius", let the policy choose or defer
+            elif len(objects_found) > 1:
+                resolved_names[i] = policy(ingest_name, objects_found)
+                if resolved_names[i] is None:
+                    verboseprint(ingest_name, "deferred")
+                    deferred.append({'ingest_name': ingest_name, 'ra': float(ingest_ra[i]),
+                                     'dec': float(ingest_dec[i]), 'candidates': objects_found})
                 else:
-                    resolved_names.append(coord_result_table['MAIN_ID'][0].decode())
+                    verboseprint(resolved_names[i], "selected")
+                    n_selections = n_selections + 1
+
+            # If there is only one match found, accept it
+            else:
+                resolved_names[i] = objects_found[0]['main_id']
                 verboseprint(resolved_names[i], "only result nearby in Simbad")
                 n_nearby = n_nearby + 1
 
-    # Report how many find via which methods
-    print("Names Found:", n_name_matches)
-    print("Names Selected", n_selections)
-    print("Names Found", n_nearby)
-    print("Not found", n_notfound)
+        # Report how many find via which methods
+        print("Names Found:", n_name_matches)
+        print("Names Selected", n_selections)
+        print("Names Found", n_nearby)
+        print("Not found", n_notfound)
+        print("Deferred", len(deferred))
 
-    n_found = n_notfound + n_name_matches + n_selections + n_nearby
-    print('problem' if n_found != n_sources else (n_sources, 'names'))
+        n_found = n_notfound + n_name_matches + n_selections + n_nearby + len(deferred)
+        print('problem' if n_found != n_sources else (n_sources, 'names'))
 
-    return resolved_names
+        self.deferred = deferred
+        if review_file is not None and len(deferred) > 0:
+            write_review_file(review_file, deferred)
+
+        return resolved_names
+
+
+def write_review_file(review_file, deferred):
+    """
+    Add deferred ambiguities to a JSON review file, replacing older entries for the same ingest names.
+    Each entry lists the ingest name, position, and candidate Simbad objects; adding a "selection" key
+    with the chosen main_id resolves it on the next run that uses review_policy.
+
+    :param review_file: JSON review file
+    :param deferred: list of entries, as in SimbadResolver.deferred
+    """
+    entries = []
+    if os.path.exists(review_file):
+        with open(review_file, 'r') as f:
+            entries = json.load(f)
+    new_names = set(entry['ingest_name'] for entry in deferred)
+    entries = [entry for entry in entries if entry['ingest_name'] not in new_names] + deferred
+    with open(review_file, 'w') as f:
+        json.dump(entries, f, indent=4)
+
+
+# Make sure all source names are Simbad resolvable:
+def check_names_simbad(ingest_names, ingest_ra, ingest_dec, radius='2s', verbose=False, resolver=None,
+                       policy=defer_policy, review_file=SIMBAD_REVIEW_FILE):
+    """
+    Resolve names to Simbad main identifiers. Names are looked up in Simbad first and,
+    for those not found, the Simbad objects within radius of the coordinates are used.
+    If no object is found the ingest name is kept. When several objects are found, the policy chooses one
+    (ask_policy, nearest_policy, otype_policy, known_names_policy, review_policy) or defers the choice,
+    in which case the resolved name is None and the ambiguity is added to the review file.
+    By default every ambiguity is deferred, so ingests run unattended; use ask_policy to choose interactively.
+    Queries are batched and cached on disk, see SimbadResolver.
+
+    :param ingest_names: list of names
+    :param ingest_ra: list of right ascensions (deg)
+    :param ingest_dec: list of declinations (deg)
+    :param radius: radius of the positional search. Default: 2 arcsec
+    :param verbose: print the outcome for each name
+    :param resolver: SimbadResolver to use. Default: SimbadResolver() with the default cache
+    :param policy: policy to choose between several objects found around a position. Default: defer_policy
+    :param review_file: JSON file to which deferred ambiguities are added, None to not write them.
+        Default: simbad_review.json
+    :return: list of resolved names, None for deferred ambiguities
+    """
+    if resolver is None:
+        resolver = SimbadResolver()
+
+    return resolver.resolve(ingest_names, ingest_ra, ingest_dec, radius=radius, verbose=verbose, policy=policy,
+                            review_file=review_file)
+
+
+# Numeric codes of the start of each spectral class: M0 = 60, L0 = 70, T0 = 80, Y0 = 90
+SPECTRAL_CLASS_CODES = {'O': 0, 'B': 10, 'A': 20, 'F': 30, 'G': 40, 'K': 50, 'M': 60, 'L': 70, 'T': 80, 'Y': 90}
+_LUMINOSITY_CLASS = r'(?:Iab|Ia|Ib|III|II|IV|VI|V|I)'
+SPECTRAL_TYPE_PATTERN = re.compile(
+    r'^\s*(?P<prefix>(?:esd|usd|sd|d)(?:/(?:esd|usd|sd|d))?|>=|<=|≥|≤|>|<|~)?\s*'
+    r'(?P<spectral_class>[OBAFGKMLTY])(?P<subclass>\d*\.?\d+)?'
+    r'(?:\s*(?P<separator>[-–/])\s*(?P<spectral_class2>[OBAFGKMLTY])?(?P<subclass2>\d*\.?\d+))?'
+    r'\s*(?P<uncertain>:*)\s*'
+    rf'(?P<luminosity_class>{_LUMINOSITY_CLASS}(?:-{_LUMINOSITY_CLASS})?(?![a-z]))?'
+    r'\s*(?P<peculiarity>(?:pec|p|blue|red|sb|bin|fl-g|int-g|vl-g|alpha|beta|gamma|delta|[eknαβγδ+(\[,]).*?)?'
+    r'\s*(?P<uncertain2>:*)\s*$')
+_SPT_COLUMNS = ('spectral_type_code', 'spectral_type_error', 'uncertain', 'prefix',
+                'luminosity_class', 'peculiarity', 'second_type', 'composite', 'failed')
+_SPT_DTYPES = (float, float, bool, str, str, str, str, bool, bool)
+
+
+@lru_cache(maxsize=None)
+def _parse_spectral_type(spt):
+    # Parse a single spectral type string into the values of the parse_spectral_types columns
+    match = SPECTRAL_TYPE_PATTERN.match(spt)
+    if match is None:
+        return np.nan, np.nan, False, '', '', '', '', False, True
+
+    code = SPECTRAL_CLASS_CODES[match['spectral_class']] + float(match['subclass'] or 0)
+    error = np.nan
+    second_type = ''
+    composite = match['separator'] == '/'
+    if match['subclass2'] is not None:
+        # The code is the first type: the start of a range (eg, L4-5, with its extent as error),
+        # or the primary of a composite (eg, L7/T3, whose components are not averaged)
+        spectral_class2 = match['spectral_class2'] or match['spectral_class']
+        second_type = spectral_class2 + match['subclass2']
+        if not composite:
+            error = abs(SPECTRAL_CLASS_CODES[spectral_class2] + float(match['subclass2']) - code)
+
+    uncertain = bool(match['uncertain'] or match['uncertain2'])
+    return (code, error, uncertain, match['prefix'] or '', match['luminosity_class'] or '',
+            match['peculiarity'] or '', second_type, composite, False)
+
+
+def parse_spectral_types(spectral_types):
+    """
+    Parse a column of spectral type strings into numeric codes and their other parts.
+    Codes are M0 = 60, L0 = 70, T0 = 80, Y0 = 90 (O0 = 0 through K0 = 50 for earlier types);
+    a type without a subclass (eg, T, >L, Lpec) gets the code of subclass 0,
+    a range of types (eg, L1-L3) gets the code of its first type with the extent of the range as error, and
+    a composite type (eg, L7/T3, an unresolved binary) gets the code of its first type.
+    Each distinct string is only parsed once, and strings that can not be parsed are flagged
+    instead of raising an error.
+
+    :param spectral_types: list, numpy array, or astropy column of spectral type strings. Masked values count as failed.
+    :return: astropy Table with one row per input string and columns
+        spectral_type_code, spectral_type_error, uncertain (: or :: in the type),
+        prefix (eg, sd, d/sd, >), luminosity_class (eg, V, III),
+        peculiarity (remaining text, starting with eg pec, blue, γ),
+        second_type (second type of a range or composite, eg L3 for L1-L3 and T3 for L7/T3),
+        composite (True for composite types like L7/T3),
+        failed (True where the string could not be parsed)
+    """
+
+    values = np.ma.filled(np.ma.asarray(spectral_types, dtype=object), '')
+    values = np.array([_decode(value) for value in values.ravel()], dtype=object)
+    distinct, inverse = np.unique(values.astype(str), return_inverse=True)
+    parsed = [_parse_spectral_type(spt) for spt in distinct]
+
+    t = Table()
+    for i, (name, dtype) in enumerate(zip(_SPT_COLUMNS, _SPT_DTYPES)):
+        column = np.array([row[i] for row in parsed], dtype=dtype) if parsed else np.array([], dtype=dtype)
+        t[name] = column[inverse]
+    return t
 
 
 def convert_spt_string_to_code(spectral_types, verbose=False):
     """
+    Convert spectral type strings to numeric codes (M0 = 60, L0 = 70, T0 = 80, Y0 = 90).
     normal tests: M0, M5.5, L0, L3.5, T0, T3, T4.5, Y0, Y5, Y9.
-    weird TESTS: sdM4, ≥Y4, T5pec, L2:, L0blue, Lpec, >L9, >M10, >L, T, Y
-    digits are needed in current implementation.
-    :param spectral_types:
-    :param verbose:
-    :return:
+    weird TESTS: sdM4, d/sdM4, ≥Y4, T5pec, L2:, L0blue, Lpec, >L9, >M10, >L, T, Y
+    Ranges (L4-5) and composite types (L7/T3) get the code of their first type.
+    Strings that can not be parsed get a code of NaN; see parse_spectral_types for the other parts of the types.
+
+    :param spectral_types: list of spectral type strings
+    :param verbose: print each type and its code
+    :return: list of spectral type codes
     """
 
     verboseprint = print if verbose else lambda *a, **k: None
 
-    spectral_type_codes = []
-    for spt in spectral_types:
-        spt_code = np.nan
-        # identify main spectral class, loop over any prefix text to identify MLTY
-        for i, item in enumerate(spt):
-            if item == 'M':
-                spt_code = 60
-                break
-            elif item == 'L':
-                spt_code = 70
-                break
-            elif item == 'T':
-                spt_code = 80
-                break
-            elif item == 'Y':
-                spt_code = 90
-                break
-        # find integer or decimal subclass and add to spt_code
-        spt_code += float(re.findall('\d*\.?\d+', spt[i + 1:])[0])
-        spectral_type_codes.append(spt_code)
+    spectral_type_codes = parse_spectral_types(spectral_types)['spectral_type_code'].tolist()
+    for spt, spt_code in zip(spectral_types, spectral_type_codes):
         verboseprint(spt, spt_code)
     return spectral_type_codes
 
 
-def ingest_parallaxes(db, sources, plx, plx_unc, plx_ref, verbose=False, norun=False):
+def convert_spt_code_to_string(spectral_type_codes, decimals=1):
+    """
+    Convert numeric spectral type codes back to strings (eg, 65.5 to M5.5, 70 to L0).
+
+    :param spectral_type_codes: list or array of spectral type codes
+    :param decimals: number of decimals of the subclass. Trailing zeros are dropped.
+    :return: numpy array of spectral type strings, empty where the code is NaN or out of range
     """
 
-    TODO: do stuff about adopted in cases of multiple measurements.
+    codes = np.round(np.atleast_1d(np.ma.filled(np.ma.asarray(spectral_type_codes, dtype=float), np.nan)), decimals)
+    spectral_classes = np.array(list(SPECTRAL_CLASS_CODES), dtype=str)
+    valid = np.isfinite(codes) & (codes >= 0) & (codes < 10 * len(spectral_classes))
+    class_index = np.floor(np.where(valid, codes, 0) / 10).astype(int)
+    subclasses = np.round(np.where(valid, codes, 0) - 10 * class_index, decimals)
+
+    # Format each distinct subclass only once
+    distinct, inverse = np.unique(subclasses, return_inverse=True)
+    formatted = np.array([f'{s:.{decimals}f}'.rstrip('0').rstrip('.') if decimals > 0 else f'{s:.0f}'
+                          for s in distinct], dtype=str)
+    strings = np.char.add(spectral_classes[class_index], formatted[inverse.ravel()])
+    return np.where(valid, strings, '')
+
+
+# Maximum number of values in a single IN (...) clause, below the SQLite limit on query parameters
+QUERY_CHUNK_SIZE = 900
+
+
+def _to_python(value):
+    # Convert numpy scalars and masked values to Python values that can be inserted in the database
+    if value is np.ma.masked or value is None:
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return _decode(value) if isinstance(value, (str, bytes)) else value
 
-    :param db:
-    :param sources:
-    :param plx:
-    :param plx_unc:
-    :param plx_ref:
-    :param verbose:
-    :param norun:
-    :return:
+
+def resolve_source_names(db, names):
     """
-    verboseprint = print if verbose else lambda *a, **k: None
+    Find the database source of each name, matching Sources.source and Names.other_name (case-insensitive)
+    with one query per chunk of names instead of one search_object call per name.
+
+    :param db: Database object
+    :param names: list of source names
+    :return: list of database source names, in the order of the input names
+    :raises RuntimeError: if any name is not found in the database or matches several sources
+    """
+
+    keys = [_decode(name).strip().lower() for name in names]
+    distinct = sorted(set(keys))
+    matches = {}
+    for start in range(0, len(distinct), QUERY_CHUNK_SIZE):
+        chunk = distinct[start:start + QUERY_CHUNK_SIZE]
+        sources = db.query(db.Sources.c.source.label('name'), db.Sources.c.source). \
+            filter(func.lower(db.Sources.c.source).in_(chunk))
+        other_names = db.query(db.Names.c.other_name.label('name'), db.Names.c.source). \
+            filter(func.lower(db.Names.c.other_name).in_(chunk))
+        for name, source in sources.union(other_names).all():
+            matches.setdefault(name.lower(), set()).add(source)
 
-    n_added = 0
+    missing = [name for name, key in zip(names, keys) if key not in matches]
+    ambiguous = [f'{name} ({", ".join(sorted(matches[key]))})' for name, key in zip(names, keys)
+                 if len(matches.get(key, ())) > 1]
+    if missing or ambiguous:
+        msg = ''
+        if missing:
+            msg += f'Sources not found in the database: {", ".join(map(_decode, missing))}. '
+        if ambiguous:
+            msg += f'Names matching several sources: {", ".join(ambiguous)}. '
+        raise RuntimeError(msg.strip())
 
-    for i, source in enumerate(sources):
-        db_name = db.search_object(source, output_table='Sources')[0].source
+    return [next(iter(matches[key])) for key in keys]
 
-        # Search for existing parallax data and determine if this is the best
-        adopted = None
-        source_plx_data = db.query(db.Parallaxes).filter(db.Parallaxes.c.source == db_name).table()
-        if source_plx_data is None or len(source_plx_data) == 0:
-            adopted = True
+
+def ingest_measurements(db, table, sources, values, verbose=False, norun=False):
+    """
+    Ingest per-source measurements (eg, Parallaxes, ProperMotions, RadialVelocities) as one set-based operation.
+    Source names are resolved with resolve_source_names and all rows are inserted with a single executemany.
+    For tables with an adopted column, the adopted flags of the touched sources are then recomputed
+    with simple.adopted.update_adopted, using the rules of simple.adopted.ADOPTION_RULES.
+    Everything runs in a single transaction, which is rolled back for a dry run.
+    A dry run does not fail on rows rejected by the schema constraints (see simple.schema): they are printed instead.
+
+    :param db: Database object
+    :param table: name of the table to ingest into
+    :param sources: list of source names
+    :param values: dictionary of column name to list of values, one per source. Must include reference.
+    :param verbose: print the rows to add
+    :param norun: only build and print the rows (including the adopted flags they would get), without changing the database
+    :return: list of the rows to add
+    """
+
+    verboseprint = print if verbose else lambda *a, **k: None
+    db_table = db.metadata.tables[table]
+
+    db_names = resolve_source_names(db, sources)
+    rows = [{'source': db_name, **{column: _to_python(v[i]) for column, v in values.items()}}
+            for i, db_name in enumerate(db_names)]
+
+    rejected = []
+    with db.engine.connect() as conn:
+        transaction = conn.begin()
+        try:
+            if rows:
+                conn.execute(db_table.insert(), rows)
+            if 'adopted' in db_table.columns:
+                update_adopted(conn, db_table, db_names)
+                _read_adopted(conn, db_table, rows)
+        except IntegrityError:
+            # Rows rejected by the schema constraints: nothing is added
+            transaction.rollback()
+            if not norun:
+                raise
+            rejected = _rejected_rows(conn, db_table, rows)
+        except Exception:
+            transaction.rollback()
+            raise
         else:
-            print("OTHER PARALLAX EXISTS")
-            print(source_plx_data)
+            if norun:
+                transaction.rollback()
+            else:
+                transaction.commit()
+
+    for row in rows:
+        verboseprint(row)
+    for row, error in rejected:
+        print(f"Rejected by the database: {row} ({error})")
+    if not norun:
+        print("Added to database: ", len(rows))
+
+    return rows
+
 
-        # TODO: Work out logic for updating/setting adopted. Be it's own function.
+def _rejected_rows(conn, table, rows):
+    # Rows rejected by the database, each inserted on its own in a transaction that is rolled back,
+    # and rows with the same primary key as a previous row
+    key_columns = [c.name for c in table.primary_key.columns]
+    rejected, keys = [], set()
+    for row in rows:
+        key = tuple(row.get(c) for c in key_columns)
+        if key in keys:
+            rejected.append((row, 'same primary key as a previous row'))
+            continue
+        keys.add(key)
+        transaction = conn.begin()
+        try:
+            conn.execute(table.insert(), [row])
+        except IntegrityError as e:
+            rejected.append((row, e.orig))
+        finally:
+            transaction.rollback()
+    return rejected
 
-        # TODO: Make function which validates refs
 
-        # Construct data to be added
-        parallax_data = [{'source': db_name,
-                          'parallax': plx[i],
-                          'parallax_error': plx_unc[i],
-                          'reference': plx_ref[i],
-                          'adopted': adopted}]
-        verboseprint(parallax_data)
+def _read_adopted(conn, table, rows):
+    # Set the adopted flag of the rows from the table, matching them by primary key
+    key_columns = [c.name for c in table.primary_key.columns]
+    distinct = sorted(set(row['source'] for row in rows))
+    adopted = {}
+    for start in range(0, len(distinct), QUERY_CHUNK_SIZE):
+        query = select(*table.primary_key.columns, table.c.adopted). \
+            where(table.c.source.in_(distinct[start:start + QUERY_CHUNK_SIZE]))
+        for row in conn.execute(query):
+            adopted[tuple(row[:-1])] = row[-1]
+    for row in rows:
+        row['adopted'] = adopted.get(tuple(row.get(c) for c in key_columns))
 
-        # Consider making this optional or a key to only view the output but not do the operation.
-        if not norun:
-            db.Parallaxes.insert().execute(parallax_data)
-            n_added += 1
 
-    print("Added to database: ", n_added)
+def ingest_parallaxes(db, sources, plx, plx_unc, plx_ref, verbose=False, norun=False):
+    """
+    Ingest parallaxes. The adopted parallax of each source is recomputed, see simple.adopted.ADOPTION_RULES.
+
+    :param db: Database object
+    :param sources: list of source names
+    :param plx: list of parallaxes, in mas
+    :param plx_unc: list of parallax uncertainties, in mas
+    :param plx_ref: list of references
+    :param verbose: print the rows to add
+    :param norun: only build and print the rows, without changing the database
+    :return: list of the rows to add
+    """
+
+    return ingest_measurements(db, 'Parallaxes', sources,
+                               {'parallax': plx, 'parallax_error': plx_unc, 'reference': plx_ref},
+                               verbose=verbose, norun=norun)
+
+
+def ingest_proper_motions(db, sources, pm_ra, pm_ra_unc, pm_dec, pm_dec_unc, pm_ref, verbose=False, norun=False):
+    """
+    Ingest proper motions.
+
+    :param db: Database object
+    :param sources: list of source names
+    :param pm_ra: list of proper motions in RA, in mas/yr
+    :param pm_ra_unc: list of uncertainties of the proper motions in RA, in mas/yr
+    :param pm_dec: list of proper motions in Dec, in mas/yr
+    :param pm_dec_unc: list of uncertainties of the proper motions in Dec, in mas/yr
+    :param pm_ref: list of references
+    :param verbose: print the rows to add
+    :param norun: only build and print the rows, without changing the database
+    :return: list of the rows to add
+    """
+
+    return ingest_measurements(db, 'ProperMotions', sources,
+                               {'mu_ra': pm_ra, 'mu_ra_error': pm_ra_unc, 'mu_dec': pm_dec,
+                                'mu_dec_error': pm_dec_unc, 'reference': pm_ref},
+                               verbose=verbose, norun=norun)
+
+
+def ingest_radial_velocities(db, sources, rv, rv_unc, rv_ref, verbose=False, norun=False):
+    """
+    Ingest radial velocities.
+
+    :param db: Database object
+    :param sources: list of source names
+    :param rv: list of radial velocities, in km/s
+    :param rv_unc: list of radial velocity uncertainties, in km/s
+    :param rv_ref: list of references
+    :param verbose: print the rows to add
+    :param norun: only build and print the rows, without changing the database
+    :return: list of the rows to add
+    """
+
+    return ingest_measurements(db, 'RadialVelocities', sources,
+                               {'radial_velocity': rv, 'radial_velocity_error': rv_unc, 'reference': rv_ref},
+                               verbose=verbose, norun=norun)
@@ -0,0 +1,29 @@
+# Script to export the database to columnar Arrow (or Parquet) files for analysis, see simple/arrow.py
+# Requires pyarrow. Run from the repository root: python scripts/tutorials/export_snapshot.py [--format parquet]
+# The tables can then be loaded without going through SQL, eg:
+#     from simple.arrow import read_snapshot
+#     photometry = read_snapshot('snapshot', 'Photometry').to_pandas()
+
+import os
+import sys
+import argparse
+sys.path.append(os.getcwd())  # hack to be able to discover simple
+from simple.schema import *
+from simple.database import connect
+from simple.arrow import export_snapshot, FORMATS
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the SIMPLE database to Arrow or Parquet files')
+    parser.add_argument('--database', default='SIMPLE.db', help='SQLite database to export (default: SIMPLE.db)')
+    parser.add_argument('--output', default='snapshot', help='Directory for the files (default: snapshot)')
+    parser.add_argument('--format', default='arrow', choices=list(FORMATS), help='File format (default: arrow)')
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    db = connect('sqlite:///' + args.database)
+    counts = export_snapshot(db, args.output, fmt=args.format)
+    for name, count in counts.items():
+        print(f'{name}: {count} rows')
+
+    db.session.close()
+    db.engine.dispose()
@@ -1,11 +1,17 @@
 # Script to generate database from JSON contents
 # This gets run automatically with Github Actions
+# Run with --incremental to only reload the JSON files that changed since the last build,
+# or with --ndjson DIR to build from the one file per table layout of simple/ndjson.py
 
 import sys
 import os
+import argparse
 from astrodbkit2.astrodb import create_database, Database
 sys.path.append(os.getcwd())  # hack to be able to discover simple
 from simple.schema import *
+from simple.build import manifest_is_current, write_manifest, load_database_incremental, load_database_parallel
+from simple.database import connect
+from simple.ndjson import load_ndjson
 
 # Location of source data
 DB_PATH = 'data'
@@ -15,34 +21,67 @@ DB_PATH = 'data'
 # SQLlite settings
 DB_TYPE = 'sqlite'
 DB_NAME = 'SIMPLE.db'
+# Content hashes of the JSON files used for the last build
+MANIFEST_NAME = 'SIMPLE.manifest.json'
 
-# Set correct connection string
-if DB_TYPE == 'sqlite':
-    # First, remove the existing database in order to recreate it from the schema
-    # If the schema has not changed, this part can be skipped
-    if os.path.exists(DB_NAME):
-        os.remove(DB_NAME)
-    connection_string = 'sqlite:///' + DB_NAME
-elif DB_TYPE == 'postgres':
-    # For Postgres, we connect and drop all database tables
-    connection_string = 'postgresql://' + DB_NAME
-    try:
-        db = Database(connection_string)
-        db.base.metadata.drop_all()
-        db.session.close()
-        db.engine.dispose()
-    except RuntimeError:
-        # Database already empty or doesn't yet exist
-        pass
-
-create_database(connection_string)
-
-# Now that the database is created, connect to it and load up the JSON data
-db = Database(connection_string)
-db.load_database(DB_PATH, verbose=False)
-
-print('New database generated.')
-
-# Close all connections
-db.session.close()
-db.engine.dispose()
+# Guard needed for the process pool used by load_database_parallel on platforms that spawn workers
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate the SIMPLE database from its JSON files')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only reload the JSON files that changed since the last build')
+    parser.add_argument('--ndjson', metavar='DIR',
+                        help='build from the NDJSON files of DIR (see simple/ndjson.py) instead of ' + DB_PATH)
+    args = parser.parse_args()
+    if args.incremental and args.ndjson:
+        parser.error('--incremental only applies to the JSON files of ' + DB_PATH)
+
+    # Set correct connection string
+    if DB_TYPE == 'sqlite':
+        connection_string = 'sqlite:///' + DB_NAME
+        db_exists = os.path.exists(DB_NAME)
+    elif DB_TYPE == 'postgres':
+        connection_string = 'postgresql://' + DB_NAME
+        db_exists = True
+
+    if args.incremental and db_exists and manifest_is_current(MANIFEST_NAME):
+        # Only reload the JSON files that changed since the last build
+        db = connect(connection_string)
+        changes = load_database_incremental(db, DB_PATH, MANIFEST_NAME, verbose=False)
+        print(f"Database updated: {len(changes['added'])} added, {len(changes['changed'])} changed, "
+              f"{len(changes['removed'])} removed files.")
+    else:
+        if DB_TYPE == 'sqlite':
+            # First, remove the existing database in order to recreate it from the schema
+            # If the schema has not changed, this part can be skipped
+            if os.path.exists(DB_NAME):
+                os.remove(DB_NAME)
+        elif DB_TYPE == 'postgres':
+            # For Postgres, we connect and drop all database tables
+            try:
+                db = Database(connection_string)
+                db.base.metadata.drop_all()
+                db.session.close()
+                db.engine.dispose()
+            except RuntimeError:
+                # Database already empty or doesn't yet exist
+                pass
+
+        create_database(connection_string)
+
+        # Now that the database is created, connect to it and load up the JSON data
+        # The JSON files are parsed in parallel and each table is bulk inserted in a single transaction
+        db = connect(connection_string)
+        if args.ndjson:
+            # The manifest describes the JSON files of DB_PATH, so the next incremental build starts over
+            load_ndjson(db, args.ndjson, verbose=False)
+            if os.path.exists(MANIFEST_NAME):
+                os.remove(MANIFEST_NAME)
+        else:
+            load_database_parallel(db, DB_PATH, verbose=False)
+            write_manifest(DB_PATH, MANIFEST_NAME)
+
+        print('New database generated.')
+
+    # Close all connections
+    db.session.close()
+    db.engine.dispose()
@@ -0,0 +1,55 @@
+# Script to check the validation rules of simple/validation.py against a SIMPLE database
+# Run from the repository root: python scripts/tutorials/validate_database.py [--database SIMPLE.db]
+# Prints the number of violations of each rule, and the violations themselves with --verbose.
+# With --since (eg, --since origin/main...HEAD for a pull request) or --files, only checks what the changes can break.
+# Exits with status 1 if there are errors (warnings, eg publications without DOI, are only reported).
+
+import os
+import sys
+import argparse
+sys.path.append(os.getcwd())  # hack to be able to discover simple
+from simple.schema import *
+from simple.database import connect
+from simple.validation import validate, changes_from_files, changes_from_git, VALIDATION_RULES
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Validate the contents of a SIMPLE database')
+    parser.add_argument('--database', default='SIMPLE.db', help='SQLite database to validate (default: SIMPLE.db)')
+    parser.add_argument('--tables', nargs='+', help='Only check the rules of these tables')
+    parser.add_argument('--rules', nargs='+', choices=list(VALIDATION_RULES), metavar='RULE',
+                        help='Only check these rules (see simple.validation.VALIDATION_RULES)')
+    changes = parser.add_mutually_exclusive_group()
+    changes.add_argument('--since', metavar='REVISIONS',
+                         help='Only check the data changed in git since a revision or range (eg, origin/main...HEAD)')
+    changes.add_argument('--files', nargs='+', help='Only check the data of these changed JSON files')
+    parser.add_argument('--enforced', action='store_true',
+                        help='Also check the rules enforced by the CHECK constraints of the database')
+    parser.add_argument('--output', help='Also write the violations to this file (eg, report.csv or report.ecsv)')
+    parser.add_argument('--verbose', action='store_true', help='Print every violation')
+    args = parser.parse_args()
+
+    changes = None
+    if args.since:
+        changes = changes_from_git(args.since)
+    elif args.files:
+        changes = changes_from_files(args.files)
+    if changes is not None:
+        print(f"Checking {len(changes['sources'])} changed sources and tables {changes['tables']}")
+
+    db = connect('sqlite:///' + args.database)
+    report = validate(db, tables=args.tables, rules=args.rules, changes=changes, enforced=args.enforced)
+    db.session.close()
+    db.engine.dispose()
+
+    for rule, config in VALIDATION_RULES.items():
+        count = (report['rule'] == rule).sum()
+        if count:
+            print(f"{config['level']:8} {rule}: {count} ({config['description']})")
+    if args.verbose and len(report):
+        report.pprint_all()
+    if args.output:
+        report.write(args.output, overwrite=True)
+
+    errors = (report['level'] == 'error').sum()
+    print(f"{errors} errors, {len(report) - errors} warnings")
+    sys.exit(1 if errors else 0)
@@ -0,0 +1,180 @@
+# Recomputation of the adopted flags of measurement tables (Parallaxes, SpectralTypes, ...)
+
+from sqlalchemy import case, func, select, tuple_
+
+# Maximum number of sources in a single update, below the SQLite limit on query parameters
+CHUNK_SIZE = 900
+
+# Rules used to choose the adopted measurement of each source, applied in order until one measurement is best:
+#   smallest_error: smallest value of error_column, measurements without an error last
+#   most_recent: most recent publication, from the year of the bibcode of the reference
+#   preferred_regime: first regime of the regimes list
+ADOPTION_RULES = {
+    'Parallaxes': {'rules': ['smallest_error', 'most_recent'],
+                   'error_column': 'parallax_error'},
+    'SpectralTypes': {'rules': ['preferred_regime', 'smallest_error', 'most_recent'],
+                      'error_column': 'spectral_type_error',
+                      'regimes': ['optical', 'nir', 'infrared']},
+}
+
+
+def _nulls_last(column):
+    # Portable NULLS LAST, as SQLite and Postgres sort NULL values differently
+    return case((column.is_(None), 1), else_=0)
+
+
+def adoption_order(table, rules, error_column=None, regimes=None):
+    """
+    Build the ORDER BY clauses ranking the measurements of a source, best first
+
+    Parameters
+    ----------
+    table : sqlalchemy.Table
+        Measurement table
+    rules : list of str
+        Rules to apply in order: smallest_error, most_recent, preferred_regime
+    error_column : str
+        Column with the measurement error, needed by smallest_error
+    regimes : list of str
+        Regimes from most to least preferred, needed by preferred_regime.
+        Regimes not in the list rank after those in the list.
+
+    Returns
+    -------
+    List of ORDER BY clauses, ending with the reference to break any remaining ties
+    """
+
+    publications = table.metadata.tables['Publications']
+    order = []
+    for rule in rules:
+        if rule == 'smallest_error':
+            error = table.c[error_column]
+            order += [_nulls_last(error), error]
+        elif rule == 'most_recent':
+            year = select(func.substr(publications.c.bibcode, 1, 4)). \
+                where(publications.c.name == table.c.reference).scalar_subquery()
+            order += [_nulls_last(year), year.desc()]
+        elif rule == 'preferred_regime':
+            order.append(case({regime: i for i, regime in enumerate(regimes)}, value=table.c.regime,
+                              else_=len(regimes)))
+        else:
+            raise ValueError(f'Unknown adoption rule: {rule}')
+
+    return order + [table.c.reference]
+
+
+def best_measurement(table, columns, rules=None, error_column=None, regimes=None, sources=None):
+    """
+    Subquery with the best measurement of each source in a table: the adopted measurement when there is one,
+    otherwise the first one according to the adoption rules
+
+    Parameters
+    ----------
+    table : sqlalchemy.Table
+        Measurement table
+    columns : list of str
+        Columns to include, besides source
+    rules, error_column, regimes
+        Adoption rules, see adoption_order. Default: the entry of the table in ADOPTION_RULES
+    sources : list of str or sqlalchemy Select
+        Only include these sources. Default: None (all sources)
+
+    Returns
+    -------
+    sqlalchemy Subquery, with one row per source
+    """
+
+    config = ADOPTION_RULES.get(table.name, {})
+    rules = config.get('rules', []) if rules is None else rules
+    error_column = config.get('error_column') if error_column is None else error_column
+    regimes = config.get('regimes', []) if regimes is None else regimes
+
+    order = [case((table.c.adopted.is_(True), 0), else_=1)] if 'adopted' in table.c else []
+    order += adoption_order(table, rules, error_column, regimes)
+    rank = func.row_number().over(partition_by=table.c.source, order_by=order).label('rank')
+    ranked = select(table.c.source, *[table.c[c] for c in dict.fromkeys(columns)], rank)
+    if sources is not None:
+        ranked = ranked.where(table.c.source.in_(sources))
+    ranked = ranked.subquery()
+    return select(ranked).where(ranked.c.rank == 1).subquery(table.name.lower())
+
+
+def update_adopted(conn, table, sources=None, rules=None, error_column=None, regimes=None, partition_by=('source',)):
+    """
+    Recompute the adopted flags of a table with set-based updates: the measurements are ranked
+    with a window function and the best of each source is adopted, with one UPDATE per chunk of sources.
+
+    Parameters
+    ----------
+    conn : sqlalchemy.engine.Connection
+        Connection to use, typically within a transaction
+    table : sqlalchemy.Table
+        Measurement table, with an adopted column
+    sources : list of str
+        Sources to update. Default: None (all sources)
+    rules, error_column, regimes
+        Adoption rules, see adoption_order. Default: the entry of the table in ADOPTION_RULES
+    partition_by : tuple of str
+        Columns defining the groups with one adopted measurement, eg ('source', 'regime') for one per regime
+        (which requires dropping the index allowing one adopted measurement per source, see simple.schema).
+        Default: ('source',)
+
+    Returns
+    -------
+    Number of rows examined
+    """
+
+    config = ADOPTION_RULES.get(table.name, {})
+    rules = config.get('rules', []) if rules is None else rules
+    error_column = config.get('error_column') if error_column is None else error_column
+    regimes = config.get('regimes', []) if regimes is None else regimes
+
+    primary_key = list(table.primary_key.columns)
+    rank = func.row_number().over(partition_by=[table.c[c] for c in partition_by],
+                                  order_by=adoption_order(table, rules, error_column, regimes))
+
+    def update(filter_clause):
+        ranked = select(*primary_key, rank.label('rank'))
+        if filter_clause is not None:
+            ranked = ranked.where(filter_clause)
+        ranked = ranked.subquery()
+        best = select(*[ranked.c[c.name] for c in primary_key]).where(ranked.c.rank == 1)
+        # Flags are cleared first, as unique indexes on the adopted measurements (see simple.schema) are checked
+        # row by row during an UPDATE
+        clear = table.update().values(adopted=False).where(table.c.adopted)
+        stmt = table.update().values(adopted=tuple_(*primary_key).in_(best))
+        if filter_clause is not None:
+            clear = clear.where(filter_clause)
+            stmt = stmt.where(filter_clause)
+        conn.execute(clear)
+        return conn.execute(stmt).rowcount
+
+    if sources is None:
+        return update(None)
+
+    sources = sorted(set(sources))
+    return sum(update(table.c.source.in_(sources[start:start + CHUNK_SIZE]))
+               for start in range(0, len(sources), CHUNK_SIZE))
+
+
+def recompute_adopted(db, tables=None, sources=None):
+    """
+    Recompute the adopted flags of several measurement tables in a single transaction
+
+    Parameters
+    ----------
+    db : astrodbkit2.astrodb.Database
+        Database to update
+    tables : list of str
+        Tables to update. Default: the tables in ADOPTION_RULES
+    sources : list of str
+        Sources to update, eg the sources touched by an ingest. Default: None (all sources)
+
+    Returns
+    -------
+    Dictionary of table name: number of rows examined
+    """
+
+    tables = list(ADOPTION_RULES) if tables is None else tables
+    with db.engine.begin() as conn:
+        return {name: update_adopted(conn, db.metadata.tables[name], sources) for name in tables}
@@ -0,0 +1,182 @@
+# Columnar snapshots of the database in Apache Arrow (IPC) and Parquet files, for fast analysis of whole tables
+
+import os
+from sqlalchemy import BigInteger, Boolean, Date, DateTime, Enum, Float, Integer
+from astrodbkit2.astrodb import Base
+from simple.build import data_tables
+from simple.summary import summary_query
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# File extension of each snapshot format
+FORMATS = {'arrow': '.arrow', 'parquet': '.parquet'}
+
+# Name of the snapshot of the per-source summary (see simple.summary)
+SUMMARY_NAME = 'SourceSummary'
+
+# Number of rows fetched and written at a time
+BATCH_SIZE = 65536
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError('pyarrow is required for Arrow and Parquet snapshots: pip install pyarrow')
+
+
+def arrow_type(column_type):
+    """
+    Arrow type of a column of the SIMPLE schema: enumerations are dictionary encoded,
+    other columns use the matching Arrow type (strings for unknown types)
+
+    Parameters
+    ----------
+    column_type : sqlalchemy.types.TypeEngine
+        Type of the column
+
+    Returns
+    -------
+    pyarrow.DataType
+    """
+
+    _require_pyarrow()
+    if isinstance(column_type, Enum):
+        return pa.dictionary(pa.int8(), pa.string())
+    if isinstance(column_type, Boolean):
+        return pa.bool_()
+    if isinstance(column_type, (Integer, BigInteger)):
+        return pa.int64()
+    if isinstance(column_type, Float):
+        return pa.float64()
+    if isinstance(column_type, DateTime):
+        return pa.timestamp('us')
+    if isinstance(column_type, Date):
+        return pa.date32()
+    return pa.string()
+
+
+def _column_arrays(rows, columns, schema):
+    # Arrow arrays of the columns of a batch of rows
+    arrays = []
+    for i, (column, field) in enumerate(zip(columns, schema)):
+        values = [row[i] for row in rows]
+        if pa.types.is_dictionary(field.type):
+            # Fixed dictionary (the enumeration values, as stored in the database), the same for every batch
+            dictionary = list(column.type.enums)
+            lookup = {value: index for index, value in enumerate(dictionary)}
+            try:
+                indices = pa.array([None if v is None else lookup[v] for v in values], pa.int8())
+            except KeyError as e:
+                raise ValueError(f'Value {e.args[0]!r} of {column.name} is not in its enumeration')
+            arrays.append(pa.DictionaryArray.from_arrays(indices, pa.array(dictionary, pa.string())))
+        else:
+            arrays.append(pa.array(values, field.type))
+    return arrays
+
+
+def _write_snapshot(conn, query, columns, filename, fmt, batch_size):
+    # Stream the results of a query to an Arrow or Parquet file, batch by batch
+    schema = pa.schema([pa.field(column.name, arrow_type(column.type)) for column in columns])
+    if fmt == 'arrow':
+        writer = pa.ipc.new_file(filename, schema)
+    else:
+        writer = pq.ParquetWriter(filename, schema)
+
+    rows = 0
+    with writer:
+        result = conn.execute(query)
+        while True:
+            batch = result.fetchmany(batch_size)
+            if not batch:
+                break
+            writer.write_table(pa.Table.from_arrays(_column_arrays(batch, columns, schema), schema=schema))
+            rows += len(batch)
+    return rows
+
+
+def export_snapshot(db, directory, fmt='arrow', tables=None, summary=True, batch_size=BATCH_SIZE):
+    """
+    Export database tables to columnar files, one file per table, with the column types of simple/schema.py
+    (enumerations as dictionary columns). Arrow files are uncompressed and can be memory-mapped with read_snapshot;
+    Parquet files are compressed, eg for distribution. Rows are sorted by primary key and streamed in batches.
+    Requires pyarrow.
+
+    Parameters
+    ----------
+    db : astrodbkit2.astrodb.Database
+        Database to export
+    directory : str
+        Name of directory in which to save the files
+    fmt : str
+        Format of the files: arrow (Arrow IPC file) or parquet. Default: arrow
+    tables : list of str
+        Tables to export. Default: None (all tables)
+    summary : bool
+        Also export the per-source summary of simple.summary.source_summary, as SourceSummary. Default: True
+    batch_size : int
+        Number of rows fetched and written at a time. Default: 65536
+
+    Returns
+    -------
+    Dictionary of exported table name: number of rows
+    """
+
+    _require_pyarrow()
+    if fmt not in FORMATS:
+        raise ValueError(f'Unknown snapshot format {fmt}, expected one of {list(FORMATS)}')
+
+    counts = {}
+    with db.engine.connect() as conn:
+        for table in data_tables(db.metadata):
+            if tables is not None and table.name not in tables:
+                continue
+            # Column types of the SIMPLE schema, as reflection does not recover enumerations
+            schema_table = Base.metadata.tables.get(table.name, table)
+            columns = [schema_table.c[c.name] if c.name in schema_table.c else c for c in table.columns]
+            query = table.select().order_by(*table.primary_key.columns)
+            filename = os.path.join(directory, table.name + FORMATS[fmt])
+            counts[table.name] = _write_snapshot(conn, query, columns, filename, fmt, batch_size)
+
+        if summary:
+            columns = list(summary_query(Base.metadata).selected_columns)
+            filename = os.path.join(directory, SUMMARY_NAME + FORMATS[fmt])
+            counts[SUMMARY_NAME] = _write_snapshot(conn, summary_query(db.metadata), columns, filename, fmt,
+                                                   batch_size)
+
+    return counts
+
+
+def read_snapshot(directory, name, columns=None):
+    """
+    Read a table exported by export_snapshot. Arrow files are memory-mapped without copying the data,
+    Parquet files are decoded from a memory map.
+    Requires pyarrow.
+
+    Parameters
+    ----------
+    directory : str
+        Name of directory containing the files
+    name : str
+        Name of the table, eg Photometry or SourceSummary
+    columns : list of str
+        Columns to read. Default: None (all columns)
+
+    Returns
+    -------
+    pyarrow.Table, eg use .to_pandas() for a DataFrame
+    """
+
+    _require_pyarrow()
+    filename = os.path.join(directory, name + FORMATS['arrow'])
+    if os.path.exists(filename):
+        table = pa.ipc.open_file(pa.memory_map(filename, 'r')).read_all()
+        return table if columns is None else table.select(columns)
+
+    filename = os.path.join(directory, name + FORMATS['parquet'])
+    if os.path.exists(filename):
+        return pq.read_table(filename, columns=columns, memory_map=True)
+
+    raise FileNotFoundError(f'No snapshot of {name} in {directory}')
@@ -0,0 +1,544 @@
+# Utilities to (re)build the SIMPLE database from the JSON files in the data directory
+
+import os
+import json
+import hashlib
+import multiprocessing
+from sqlalchemy import and_, inspect, text
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.schema import CreateTable, CreateIndex
+from astrodbkit2 import REFERENCE_TABLES, PRIMARY_TABLE, PRIMARY_TABLE_KEY, FOREIGN_KEY
+from astrodbkit2.astrodb import Base
+import simple.schema  # noqa: F401, populates Base with the SIMPLE tables
+from simple.database import is_derived_table
+from simple.serialization import read_json
+
+MANIFEST_VERSION = 1
+
+
+def data_tables(metadata):
+    # Tables holding the JSON data, in foreign key dependency order (derived tables are skipped)
+    return [table for table in metadata.sorted_tables if not is_derived_table(table.name)]
+
+
+def file_hash(filename):
+    """
+    Compute the SHA-256 hash of the contents of a file
+
+    Parameters
+    ----------
+    filename : str
+        File to hash
+
+    Returns
+    -------
+    Hex digest of the file contents
+    """
+
+    with open(filename, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def schema_hash(metadata=None):
+    """
+    Compute a hash of the DDL for the schema, used to detect when the database needs to be recreated
+
+    Parameters
+    ----------
+    metadata : sqlalchemy.MetaData
+        Metadata to hash. Default: the SIMPLE schema (astrodbkit2.astrodb.Base.metadata)
+
+    Returns
+    -------
+    Hex digest of the schema DDL
+    """
+
+    if metadata is None:
+        metadata = Base.metadata
+
+    dialect = sqlite.dialect()
+    ddl = []
+    for table in data_tables(metadata):
+        ddl.append(str(CreateTable(table).compile(dialect=dialect)))
+        for index in sorted(table.indexes, key=lambda x: x.name):
+            ddl.append(str(CreateIndex(index).compile(dialect=dialect)))
+
+    return hashlib.sha256('\n'.join(ddl).encode('utf-8')).hexdigest()
+
+
+def scan_directory(directory):
+    """
+    Hash all JSON files in a directory
+
+    Parameters
+    ----------
+    directory : str
+        Name of directory containing the JSON files
+
+    Returns
+    -------
+    Dictionary of file name: content hash
+    """
+
+    return {file: file_hash(os.path.join(directory, file))
+            for file in sorted(os.listdir(directory)) if file.endswith('.json')}
+
+
+def read_source_file(filename, columns=None, primary_table=PRIMARY_TABLE, primary_table_key=PRIMARY_TABLE_KEY,
+                     foreign_key=FOREIGN_KEY):
+    """
+    Read a single source JSON file into rows for each table, mirroring `astrodbkit2.astrodb.Database.load_json`.
+    If `columns` is provided, the contents are also validated against the schema and every row is
+    filled out with all the columns of its table so the rows of a table can be inserted together.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the JSON file
+    columns : dict
+        Dictionary of table name: list of column names, as returned by `table_columns`. Default: None
+    primary_table : str
+        Name of the primary table. Default: Sources
+    primary_table_key : str
+        Name of the primary key in the primary table. Default: source
+    foreign_key : str
+        Name of the foreign key in other tables. Default: source
+
+    Returns
+    -------
+    source : str
+        Name of the source stored in the file
+    rows : dict
+        Dictionary of table name: list of row dictionaries
+    """
+
+    data = read_json(filename)
+
+    if columns is not None:
+        if len(data.get(primary_table, [])) != 1 or primary_table_key not in data[primary_table][0]:
+            raise RuntimeError(f'{filename}: expected a single {primary_table} entry with a {primary_table_key}')
+        for key, value in data.items():
+            if key not in columns:
+                raise RuntimeError(f'{filename}: table {key} is not in the database')
+            unknown = set().union(*value) - set(columns[key]) if value else set()
+            if unknown:
+                raise RuntimeError(f'{filename}: unknown {key} columns {sorted(unknown)}')
+
+    source = data[primary_table][0][primary_table_key]
+    for key, value in data.items():
+        if key == primary_table:
+            continue
+        for row in value:
+            row[foreign_key] = source
+
+    if columns is not None:
+        data = {key: [{c: row.get(c) for c in columns[key]} for row in value] for key, value in data.items()}
+
+    return source, data
+
+
+def read_reference_file(filename, table, columns):
+    """
+    Read the JSON file of a reference table into rows filled out with all the columns of the table,
+    rejecting unknown columns as `read_source_file` does (and as astrodbkit2 does when loading)
+
+    Parameters
+    ----------
+    filename : str
+        Name of the JSON file
+    table : str
+        Name of the reference table
+    columns : dict
+        Dictionary of table name: list of column names, as returned by `table_columns`
+
+    Returns
+    -------
+    List of row dictionaries
+    """
+
+    data = read_json(filename, parse_dates=False)
+    unknown = set().union(*data) - set(columns[table]) if data else set()
+    if unknown:
+        raise RuntimeError(f'{filename}: unknown {table} columns {sorted(unknown)}')
+    return [{c: row.get(c) for c in columns[table]} for row in data]
+
+
+def _read_source_file(args):
+    # Process pool worker for read_source_files, reporting failures instead of raising
+    filename, columns = args
+    try:
+        return read_source_file(filename, columns=columns)
+    except RuntimeError as e:
+        return None, str(e)
+    except (ValueError, KeyError, IndexError, TypeError) as e:
+        return None, f'{filename}: {e!r}'
+
+
+def table_columns(metadata):
+    """
+    Get the column names of each data table
+
+    Parameters
+    ----------
+    metadata : sqlalchemy.MetaData
+        Database metadata, eg `db.metadata`
+
+    Returns
+    -------
+    Dictionary of table name: list of column names
+    """
+
+    return {table.name: [c.name for c in table.columns] for table in data_tables(metadata)}
+
+
+def read_source_files(filenames, columns, processes=None):
+    """
+    Read, validate, and batch the rows of many source JSON files, optionally with a process pool
+
+    Parameters
+    ----------
+    filenames : list
+        Names of the JSON files
+    columns : dict
+        Dictionary of table name: list of column names, as returned by `table_columns`
+    processes : int
+        Number of worker processes. Default: None (use all CPUs); 1 reads the files in this process
+
+    Returns
+    -------
+    rows : dict
+        Dictionary of table name: list of row dictionaries, across all files
+    """
+
+    tasks = [(filename, columns) for filename in filenames]
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(tasks))
+
+    if processes > 1:
+        chunksize = max(1, len(tasks) // (4 * processes))
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.map(_read_source_file, tasks, chunksize=chunksize)
+    else:
+        results = [_read_source_file(task) for task in tasks]
+
+    errors = [data for source, data in results if source is None]
+    if errors:
+        raise RuntimeError('Invalid JSON files:\n' + '\n'.join(errors))
+
+    rows = {}
+    sources = set()
+    for source, data in results:
+        if source in sources:
+            raise RuntimeError(f'Source {source} is present in more than one JSON file')
+        sources.add(source)
+        for table_name, table_rows in data.items():
+            rows.setdefault(table_name, []).extend(table_rows)
+
+    return rows
+
+
+def read_manifest(filename):
+    """
+    Read a build manifest. Returns None if the manifest is missing or of an incompatible version.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the manifest file
+
+    Returns
+    -------
+    manifest : dict or None
+    """
+
+    if not os.path.exists(filename):
+        return None
+
+    with open(filename, 'r') as f:
+        manifest = json.load(f)
+
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+
+    return manifest
+
+
+def write_manifest(directory, filename, reference_tables=REFERENCE_TABLES, primary_table=PRIMARY_TABLE,
+                   primary_table_key=PRIMARY_TABLE_KEY, hashes=None, previous=None):
+    """
+    Write the build manifest for the current contents of a data directory.
+    This records the content hash of each JSON file and, for source files, the source it contains.
+    Entries of a previous manifest are reused for files whose hash did not change.
+
+    Parameters
+    ----------
+    directory : str
+        Name of directory containing the JSON files
+    filename : str
+        Name of the manifest file to write
+    reference_tables : list
+        List of reference tables. Default: astrodbkit2.REFERENCE_TABLES
+    primary_table : str
+        Name of the primary table. Default: Sources
+    primary_table_key : str
+        Name of the primary key in the primary table. Default: source
+    hashes : dict
+        Output of `scan_directory` for `directory`, if already computed. Default: None
+    previous : dict
+        Previous manifest whose entries can be reused. Default: None
+
+    Returns
+    -------
+    manifest : dict
+    """
+
+    if hashes is None:
+        hashes = scan_directory(directory)
+    previous_files = previous['files'] if previous is not None else {}
+
+    files = {}
+    for file, hash_value in hashes.items():
+        entry = {'hash': hash_value}
+        if file in previous_files and previous_files[file]['hash'] == hash_value:
+            entry = previous_files[file]
+        elif file.replace('.json', '') not in reference_tables:
+            with open(os.path.join(directory, file), 'r') as f:
+                entry['source'] = json.load(f)[primary_table][0][primary_table_key]
+        files[file] = entry
+
+    manifest = {'version': MANIFEST_VERSION, 'schema': schema_hash(), 'files': files}
+    with open(filename, 'w') as f:
+        f.write(json.dumps(manifest, indent=4, sort_keys=True))
+
+    return manifest
+
+
+def manifest_is_current(filename):
+    """
+    Check that a manifest exists and was written for the current schema,
+    that is, that the database it describes can be updated incrementally.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the manifest file
+
+    Returns
+    -------
+    bool
+    """
+
+    manifest = read_manifest(filename)
+    return manifest is not None and manifest['schema'] == schema_hash()
+
+
+def create_indexes(db, metadata=None):
+    """
+    Create the indexes of the schema that are missing from an existing database,
+    eg a database built before they were added to simple.schema
+
+    Parameters
+    ----------
+    db : astrodbkit2.astrodb.Database
+        Database to update
+    metadata : sqlalchemy.MetaData
+        Schema with the indexes. Default: the SIMPLE schema (astrodbkit2.astrodb.Base.metadata)
+
+    Returns
+    -------
+    List of the names of the created indexes
+    """
+
+    if metadata is None:
+        metadata = Base.metadata
+
+    inspector = inspect(db.engine)
+    tables = inspector.get_table_names()
+    if db.engine.dialect.name == 'sqlite':
+        # Expression indexes are not returned by the inspector for SQLite
+        with db.engine.connect() as conn:
+            existing = {row[0] for row in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'"))}
+    else:
+        existing = {index['name'] for table in tables for index in inspector.get_indexes(table)}
+
+    created = []
+    for table in data_tables(metadata):
+        if table.name not in tables:
+            continue
+        for index in sorted(table.indexes, key=lambda x: x.name):
+            if index.name not in existing:
+                index.create(bind=db.engine)
+                created.append(index.name)
+
+    return created
+
+
+def _sync_reference_table(conn, table, rows, delete=False):
+    # Insert or update the rows of a reference table to match the JSON contents.
+    # Rows no longer in the JSON are only removed when delete=True, which is done last so
+    # that data referring to them has already been removed.
+    pk = [c for c in table.primary_key.columns]
+    existing = {tuple(r._mapping[c.name] for c in pk): dict(r._mapping) for r in conn.execute(table.select())}
+    new = {tuple(r.get(c.name) for c in pk): r for r in rows}
+
+    if delete:
+        for key in set(existing) - set(new):
+            conn.execute(table.delete().where(and_(*[c == v for c, v in zip(pk, key)])))
+        return
+
+    to_insert = [row for key, row in new.items() if key not in existing]
+    if to_insert:
+        conn.execute(table.insert(), to_insert)
+
+    for key, row in new.items():
+        if key in existing:
+            values = {c.name: row.get(c.name) for c in table.columns}
+            if values != existing[key]:
+                conn.execute(table.update().where(and_(*[c == v for c, v in zip(pk, key)])).values(values))
+
+
+def insert_rows(conn, metadata, rows):
+    """
+    Bulk insert rows, one executemany per table, in foreign key dependency order
+
+    Parameters
+    ----------
+    conn : sqlalchemy.engine.Connection
+        Connection to insert with (usually inside a transaction)
+    metadata : sqlalchemy.MetaData
+        Database metadata, eg `db.metadata`
+    rows : dict
+        Dictionary of table name: list of row dictionaries
+    """
+
+    for table in data_tables(metadata):
+        if rows.get(table.name):
+            conn.execute(table.insert(), rows[table.name])
+
+
+def load_database_incremental(db, directory, manifest_file, reference_tables=REFERENCE_TABLES, verbose=False):
+    """
+    Update a database built from `directory` with only the JSON files that changed since the manifest was written.
+    Rows for changed or removed source files are deleted and changed or added files are reinserted.
+    Changed reference tables (eg, Publications.json) are synced row by row.
+    All changes are applied in a single transaction and the manifest is rewritten afterwards.
+
+    Parameters
+    ----------
+    db : astrodbkit2.astrodb.Database
+        Database built from `directory`, as described by the manifest
+    directory : str
+        Name of directory containing the JSON files
+    manifest_file : str
+        Name of the manifest file written by the last build
+    reference_tables : list
+        List of reference tables. Default: astrodbkit2.REFERENCE_TABLES
+    verbose : bool
+        Flag to enable diagnostic messages
+
+    Returns
+    -------
+    changes : dict
+        Lists of added, changed, and removed files
+    """
+
+    verboseprint = print if verbose else lambda *a, **k: None
+
+    manifest = read_manifest(manifest_file)
+    if manifest is None or manifest['schema'] != schema_hash():
+        raise RuntimeError(f'{manifest_file} is missing or out of date; rebuild the database in full.')
+
+    old_files = manifest['files']
+    new_files = scan_directory(directory)
+    added = sorted(set(new_files) - set(old_files))
+    removed = sorted(set(old_files) - set(new_files))
+    changed = sorted(f for f in set(new_files) & set(old_files) if new_files[f] != old_files[f]['hash'])
+
+    is_reference = {f: f.replace('.json', '') in reference_tables for f in set(new_files) | set(old_files)}
+    ref_updates = [f for f in added + changed if is_reference[f]]
+    ref_removals = [f for f in removed if is_reference[f]]
+    source_inserts = [f for f in added + changed if not is_reference[f]]
+    source_deletes = [old_files[f]['source'] for f in changed + removed if not is_reference[f]]
+
+    # Order reference tables by foreign key dependencies (eg, Publications before Telescopes)
+    ref_order = [t for t in data_tables(db.metadata) if t.name in reference_tables]
+    columns = table_columns(db.metadata)
+
+    with db.engine.begin() as conn:
+        for table in ref_order:
+            if table.name + '.json' in ref_updates:
+                verboseprint(f'Updating {table.name} table')
+                rows = read_reference_file(os.path.join(directory, table.name + '.json'), table.name, columns)
+                _sync_reference_table(conn, table, rows)
+
+        if source_deletes:
+            verboseprint(f'Deleting {len(source_deletes)} sources')
+            for table in reversed(data_tables(db.metadata)):
+                if table.name in reference_tables:
+                    continue
+                key = PRIMARY_TABLE_KEY if table.name == PRIMARY_TABLE else FOREIGN_KEY
+                conn.execute(table.delete().where(table.columns[key].in_(source_deletes)))
+
+        if source_inserts:
+            verboseprint(f'Loading {len(source_inserts)} source files')
+            rows = read_source_files([os.path.join(directory, f) for f in source_inserts], columns, processes=1)
+            insert_rows(conn, db.metadata, rows)
+
+        for table in reversed(ref_order):
+            if table.name + '.json' in ref_updates:
+                rows = read_reference_file(os.path.join(directory, table.name + '.json'), table.name, columns)
+                _sync_reference_table(conn, table, rows, delete=True)
+            elif table.name + '.json' in ref_removals:
+                verboseprint(f'Clearing {table.name} table')
+                conn.execute(table.delete())
+
+    write_manifest(directory, manifest_file, reference_tables=reference_tables, hashes=new_files, previous=manifest)
+
+    return {'added': added, 'changed': changed, 'removed': removed}
+
+
+def load_database_parallel(db, directory, processes=None, reference_tables=REFERENCE_TABLES, verbose=False):
+    """
+    Reload entire database from a directory of JSON files, like `astrodbkit2.astrodb.Database.load_database`.
+    The source files are parsed and validated in a process pool and their rows are batched per table,
+    then the existing contents are cleared and each table is inserted with a single executemany,
+    in foreign key order, inside one transaction.
+
+    Parameters
+    ----------
+    db : astrodbkit2.astrodb.Database
+        Database to load
+    directory : str
+        Name of directory containing the JSON files
+    processes : int
+        Number of worker processes. Default: None (use all CPUs)
+    reference_tables : list
+        List of reference tables. Default: astrodbkit2.REFERENCE_TABLES
+    verbose : bool
+        Flag to enable diagnostic messages
+    """
+
+    verboseprint = print if verbose else lambda *a, **k: None
+
+    columns = table_columns(db.metadata)
+    rows = {}
+    for table in reference_tables:
+        filename = os.path.join(directory, table + '.json')
+        if table in columns and os.path.exists(filename):
+            rows[table] = read_reference_file(filename, table, columns)
+        else:
+            verboseprint(f'{table}.json not found.')
+
+    filenames = [os.path.join(directory, file) for file in sorted(os.listdir(directory))
+                 if file.endswith('.json') and file.replace('.json', '') not in reference_tables]
+    verboseprint(f'Reading {len(filenames)} source files')
+    rows.update(read_source_files(filenames, columns, processes=processes))
+
+    with db.engine.begin() as conn:
+        for table in reversed(data_tables(db.metadata)):
+            verboseprint(f'Deleting {table.name} table')
+            conn.execute(table.delete())
+
+        verboseprint('Loading tables')
+        insert_rows(conn, db.metadata, rows)
@@ -0,0 +1,170 @@
+# Tracking of the sources and reference tables changed since the last save, for incremental saves
+
+from sqlalchemy import inspect, text
+from simple.database import DERIVED_TABLE_PREFIX, is_derived_table
+
+# Change logs, filled by triggers on the SIMPLE tables and emptied when the changes are saved
+CHANGED_SOURCES_TABLE = DERIVED_TABLE_PREFIX + 'ChangedSources'
+CHANGED_TABLES_TABLE = DERIVED_TABLE_PREFIX + 'ChangedTables'
+TRIGGER_EVENTS = {'insert': ('INSERT', ['new']), 'delete': ('DELETE', ['old']), 'update': ('UPDATE', ['old', 'new'])}
+
+
+def _tracked_tables(db):
+    # (table name, is a reference table) for the tables saved to JSON
+    return [(name, name in db._reference_tables) for name in db.metadata.tables if not is_derived_table(name)]
+
+
+def _trigger_name(log_table, table_name, event):
+    return f'{log_table}_{table_name}_{event}'
+
+
+def create_source_log(conn, log_table, tables):
+    """
+    Create a log of the changed sources: triggers on each table record the sources of the rows
+    inserted, updated, or deleted in log_table (both the old and new source for updates). Requires SQLite.
+
+    Parameters
+    ----------
+    conn : sqlalchemy.engine.Connection
+        Connection to the database
+    log_table : str
+        Name of the log table to create, usually a derived table (see simple.database)
+    tables : dict
+        Dictionary of table name: source column, for the tables to watch
+    """
+
+    conn.execute(text(f"CREATE TABLE {log_table} (source TEXT PRIMARY KEY)"))
+    for name, key in tables.items():
+        for event, (operation, rows) in TRIGGER_EVENTS.items():
+            statements = ''.join(f"INSERT OR IGNORE INTO {log_table} (source) VALUES ({row}.{key});" for row in rows)
+            conn.execute(text(f'CREATE TRIGGER {_trigger_name(log_table, name, event)} AFTER {operation} ON "{name}" '
+                              f'BEGIN {statements} END'))
+
+
+def drop_source_log(conn, log_table, tables):
+    """
+    Drop a log of the changed sources and its triggers
+
+    Parameters
+    ----------
+    conn : sqlalchemy.engine.Connection or Engine
+        Connection to the database
+    log_table : str
+        Name of the log table
+    tables : list of str
+        Names of the watched tables
+    """
+
+    for name in tables:
+        for event in TRIGGER_EVENTS:
+            conn.execute(text(f"DROP TRIGGER IF EXISTS {_trigger_name(log_table, name, event)}"))
+    conn.execute(text(f"DROP TABLE IF EXISTS {log_table}"))
+
+
+def create_change_tracking(db):
+    """
+    Start tracking changes: triggers on every table record the sources whose data is inserted, updated,
+    or deleted, and the reference tables that are modified. Any previous change log is cleared,
+    so this is typically called right after loading the database from the JSON files.
+    The change logs are derived tables, see simple.database.connect to hide them from astrodbkit2.
+    Requires SQLite.
+
+    Parameters
+    ----------
+    db : astrodbkit2.astrodb.Database
+        Database to track
+    """
+
+    tables = _tracked_tables(db)
+    with db.engine.begin() as conn:
+        drop_change_tracking(conn, db)
+        create_source_log(conn, CHANGED_SOURCES_TABLE,
+                          {name: db._primary_table_key if name == db._primary_table else db._foreign_key
+                           for name, is_reference in tables if not is_reference})
+
+        conn.execute(text(f"CREATE TABLE {CHANGED_TABLES_TABLE} (name TEXT PRIMARY KEY)"))
+        for name, is_reference in tables:
+            if not is_reference:
+                continue
+            statement = f"INSERT OR IGNORE INTO {CHANGED_TABLES_TABLE} (name) VALUES ('{name}');"
+            for event, (operation, _) in TRIGGER_EVENTS.items():
+                conn.execute(text(f'CREATE TRIGGER {_trigger_name(CHANGED_SOURCES_TABLE, name, event)} '
+                                  f'AFTER {operation} ON "{name}" BEGIN {statement} END'))
+
+
+def drop_change_tracking(conn, db):
+    """
+    Stop tracking changes, dropping the triggers and change logs
+
+    Parameters
+    ----------
+    conn : sqlalchemy.engine.Connection or Engine
+        Connection to the database
+    db : astrodbkit2.astrodb.Database
+        Database with the tracked tables
+    """
+
+    drop_source_log(conn, CHANGED_SOURCES_TABLE, [name for name, _ in _tracked_tables(db)])
+    conn.execute(text(f"DROP TABLE IF EXISTS {CHANGED_TABLES_TABLE}"))
+
+
+def has_change_tracking(db):
+    """Whether changes to the database are tracked"""
+    return inspect(db.engine).has_table(CHANGED_SOURCES_TABLE)
+
+
+def changed_sources(db):
+    """
+    Sources changed since tracking started or the changes were last cleared
+
+    Parameters
+    ----------
+    db : astrodbkit2.astrodb.Database
+        Database with change tracking
+
+    Returns
+    -------
+    Sorted list of source names, including sources that have been deleted or renamed
+    """
+
+    with db.engine.connect() as conn:
+        return [row[0] for row in conn.execute(text(f"SELECT source FROM {CHANGED_SOURCES_TABLE} ORDER BY source"))]
+
+
+def changed_tables(db):
+    """
+    Reference tables changed since tracking started or the changes were last cleared
+
+    Parameters
+    ----------
+    db : astrodbkit2.astrodb.Database
+        Database with change tracking
+
+    Returns
+    -------
+    Sorted list of table names
+    """
+
+    with db.engine.connect() as conn:
+        return [row[0] for row in conn.execute(text(f"SELECT name FROM {CHANGED_TABLES_TABLE} ORDER BY name"))]
+
+
+def clear_changes(conn, sources=None, tables=None):
+    """
+    Clear the change logs, eg once the changes have been saved
+
+    Parameters
+    ----------
+    conn : sqlalchemy.engine.Connection or Engine
+        Connection to the database
+    sources : list of str
+        Sources to clear. Default: None (all sources)
+    tables : list of str
+        Reference tables to clear. Default: None (all tables)
+    """
+
+    for log, column, values in ((CHANGED_SOURCES_TABLE, 'source', sources), (CHANGED_TABLES_TABLE, 'name', tables)):
+        if values is None:
+            conn.execute(text(f"DELETE FROM {log}"))
+        elif values:
+            conn.execute(text(f"DELETE FROM {log} WHERE {column} = :value"), [{'value': v} for v in values])
@@ -0,0 +1,98 @@
+# Connection helpers for SIMPLE databases that contain derived tables (eg, name search indexes),
+# and the helpers shared by the schema and the query modules (no dependencies beyond astrodbkit2)
+
+from astropy.table import Table
+from astrodbkit2.astrodb import Database
+
+# Derived tables are maintained from the SIMPLE tables and are not part of the JSON data.
+# Their names start with this prefix so they can be hidden from astrodbkit2
+# (inventory, save_database, and load_database expect every table to hold source data).
+DERIVED_TABLE_PREFIX = '_'
+
+# Simbad prefixes removed by astrodbkit2.utils._name_formatter, in the same order
+SIMBAD_PREFIXES = ['V* ', 'EM* ', 'NAME ', '** ', 'Cl* ', '* ']
+
+# Number of passes replacing double spaces in SQL, enough to collapse runs of up to 2**5 spaces
+WHITESPACE_PASSES = 5
+
+
+def normalized_name_sql(column):
+    """
+    SQL expression normalizing names like normalize_name, using only built-in SQL functions
+    so the triggers and indexes using it work from any client
+
+    Parameters
+    ----------
+    column : str
+        SQL expression of the name to normalize, eg other_name or new.other_name
+
+    Returns
+    -------
+    SQL expression as a string
+    """
+
+    expr = column
+    for char in ('\t', '\n', '\r'):
+        expr = f"replace({expr}, '{char}', ' ')"
+    for _ in range(WHITESPACE_PASSES):
+        expr = f"replace({expr}, '  ', ' ')"
+    for prefix in SIMBAD_PREFIXES:
+        expr = f"replace({expr}, '{prefix}', '')"
+    return f"lower(trim({expr}))"
+
+
+def _format(rows, names, fmt, dtype=None):
+    # Format result rows (tuples) as in astrodbkit2: astropy Table, pandas DataFrame, or the list of rows
+    if fmt.lower() in ('astropy', 'table', 'pandas'):
+        t = Table(rows=rows, names=names) if rows else Table(names=names, dtype=dtype or [object] * len(names))
+        return t.to_pandas() if fmt.lower() == 'pandas' else t
+    return rows
+
+
+def is_derived_table(name):
+    """Whether a table name belongs to a derived table"""
+    return name.startswith(DERIVED_TABLE_PREFIX)
+
+
+def hide_derived_tables(db):
+    """
+    Remove the derived tables from the metadata and attributes of a Database object,
+    so astrodbkit2 methods only see the SIMPLE tables. The tables are left untouched in the database.
+
+    Parameters
+    ----------
+    db : astrodbkit2.astrodb.Database
+        Database object to update
+
+    Returns
+    -------
+    List of the names of the hidden tables
+    """
+
+    hidden = sorted(name for name in db.metadata.tables if is_derived_table(name))
+    for name in hidden:
+        db.metadata.remove(db.metadata.tables[name])
+        if name in db.__dict__:
+            delattr(db, name)
+    return hidden
+
+
+def connect(connection_string, **kwargs):
+    """
+    Connect to a SIMPLE database, hiding its derived tables
+
+    Parameters
+    ----------
+    connection_string : str
+        Connection string, eg 'sqlite:///SIMPLE.db'
+    kwargs
+        Other arguments for astrodbkit2.astrodb.Database
+
+    Returns
+    -------
+    astrodbkit2.astrodb.Database
+    """
+
+    db = Database(connection_string, **kwargs)
+    hide_derived_tables(db)
+    return db
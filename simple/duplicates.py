@@ -0,0 +1,105 @@
+# Detection of candidate duplicate sources, from their positions and names, without network queries
+
+import numpy as np
+from astropy.table import Table
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+from simple.names import normalize_name
+from simple.database import _format
+from simple.spatial import _to_degrees, _unit_vectors, angular_separation, propagated_positions
+
+# Sources closer than this are candidate duplicates
+DUPLICATE_RADIUS = '2s'
+
+
+def _position_pairs(ra, dec, radius):
+    # Pairs (i, j), i < j, of positions within radius (degrees) of each other, from a KD-tree self-match
+    valid = np.flatnonzero(np.isfinite(ra) & np.isfinite(dec))
+    if len(valid) < 2:
+        return np.empty((0, 2), dtype=int)
+    tree = cKDTree(_unit_vectors(ra[valid], dec[valid]))
+    pairs = tree.query_pairs(2 * np.sin(np.radians(radius) / 2), output_type='ndarray')
+    return valid[pairs]
+
+
+def _name_pairs(db, sources):
+    # Pairs (i, j) of positions in sources (sorted) of different sources sharing a name, after normalization
+    # (see simple.names.normalize_name). Empty names are ignored.
+    # Each source is linked to the first source with the same name, which is enough to group them
+    rows = [(source, normalize_name(name)) for source, name in
+            db.query(db.Names.c.source, db.Names.c.other_name).all()]
+    rows = [row for row in rows if row[1]]
+    if not rows:
+        return np.empty((0, 2), dtype=int)
+    index = np.searchsorted(sources, np.array([source for source, _ in rows], dtype=str))
+    _, first, inverse = np.unique(np.array([name for _, name in rows], dtype=str),
+                                  return_index=True, return_inverse=True)
+    pairs = np.column_stack([index[first][inverse], index])
+    return pairs[pairs[:, 0] != pairs[:, 1]]
+
+
+def find_duplicates(db, radius=DUPLICATE_RADIUS, names=True, epoch=None, fmt='astropy'):
+    """
+    Find groups of candidate duplicate sources: sources within a radius of each other
+    (from a KD-tree self-match of all positions) or sharing a name in the Names table.
+    Sources linked through other sources (A near B, B named like C) are in the same group.
+
+    Parameters
+    ----------
+    db : astrodbkit2.astrodb.Database
+        Database to check
+    radius : float, str, or astropy.units.Quantity
+        Match radius, in degrees if a float. Strings are parsed by astropy.coordinates.Angle (eg, '2s').
+        Default: DUPLICATE_RADIUS
+    names : bool
+        Also link sources sharing a name. Default: True
+    epoch : float
+        Compare the positions propagated to this epoch with their proper motions (see
+        simple.spatial.propagated_positions), so fast moving sources observed at different epochs are found.
+        Default: None (positions as stored in Sources)
+    fmt : str
+        Format to return results in (astropy/table, pandas)
+
+    Returns
+    -------
+    Table with one row per source of each group: group (number), source, ra, dec, separation (degrees, from the
+    first source of the group), by_position and by_name (whether the source is linked to another source
+    of the group by its position, or by a name), sorted by group and source
+    """
+
+    radius = float(_to_degrees(radius))
+    if epoch is None:
+        rows = db.query(db.Sources.c.source, db.Sources.c.ra, db.Sources.c.dec).order_by(db.Sources.c.source).all()
+        t = _format([tuple(row) for row in rows], ['source', 'ra', 'dec'], 'astropy', dtype=[str, float, float])
+    else:
+        t = propagated_positions(db, epoch)
+    sources = np.array(t['source'], dtype=str)
+    ra, dec = np.array(t['ra'], dtype=float), np.array(t['dec'], dtype=float)
+
+    edges = [_position_pairs(ra, dec, radius)]
+    by_position = np.zeros(len(sources), dtype=bool)
+    by_position[edges[0].ravel()] = True
+    by_name = np.zeros(len(sources), dtype=bool)
+    if names:
+        edges.append(_name_pairs(db, sources))
+        by_name[edges[1].ravel()] = True
+    edges = np.concatenate(edges)
+
+    # Groups are the connected components with more than one source, numbered by their first source
+    graph = coo_matrix((np.ones(len(edges)), (edges[:, 0], edges[:, 1])), shape=(len(sources), len(sources)))
+    _, labels = connected_components(graph, directed=False)
+    members = np.flatnonzero(np.bincount(labels)[labels] > 1)
+    _, first, group = np.unique(labels[members], return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    group = np.argsort(order)[group]
+    first = members[first[order]][group]
+
+    result = Table()
+    result['group'] = group
+    result['source'] = sources[members]
+    result['ra'], result['dec'] = ra[members], dec[members]
+    result['separation'] = angular_separation(ra[first], dec[first], ra[members], dec[members])
+    result['by_position'], result['by_name'] = by_position[members], by_name[members]
+    result.sort(['group', 'source'])
+    return result.to_pandas() if fmt.lower() == 'pandas' else result
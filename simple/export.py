@@ -0,0 +1,201 @@
+# Batched inventory of many sources and export of the database contents to JSON files
+
+import os
+from sqlalchemy import column, table as sql_table, select, text
+from simple.database import is_derived_table
+from simple.changes import changed_sources, changed_tables, clear_changes, has_change_tracking
+from simple.serialization import write_json
+
+# Temporary table holding the sources to inventory, in the order they are returned
+INVENTORY_TABLE = '_inventory_sources'
+
+
+def inventory_tables(db):
+    """
+    Tables included in the inventory of a source, in the order of Database.inventory:
+    the primary table first, then the other (non-reference, non-derived) tables
+
+    Parameters
+    ----------
+    db : astrodbkit2.astrodb.Database
+        Database to inventory
+
+    Returns
+    -------
+    List of sqlalchemy.Table
+    """
+
+    tables = [db.metadata.tables[db._primary_table]]
+    for name, table in db.metadata.tables.items():
+        if name in db._reference_tables + [db._primary_table] or is_derived_table(name):
+            continue
+        tables.append(table)
+    return tables
+
+
+def inventory_many(db, sources=None):
+    """
+    Inventory many sources with one query per table. The sources are written to a temporary table,
+    each table is read with a single join ordered by source, and the rows are grouped per source as they stream in,
+    so only the rows of one source are held in memory at a time.
+    The results are identical to Database.inventory for each source.
+
+    Parameters
+    ----------
+    db : astrodbkit2.astrodb.Database
+        Database to inventory
+    sources : list of str
+        Sources to inventory, in the order to return them (repeated sources are returned once).
+        Default: None (all sources, sorted by name)
+
+    Yields
+    ------
+    Tuples of (source, data dictionary), with an empty dictionary for sources not in the database
+    """
+
+    key = db._primary_table_key
+    tables = inventory_tables(db)
+    inventory = sql_table(INVENTORY_TABLE, column('idx'), column('source'))
+
+    with db.engine.connect() as conn:
+        # source is declared without a type so the joins can use the primary key indexes
+        conn.execute(text(f"CREATE TEMPORARY TABLE {INVENTORY_TABLE} (idx INTEGER PRIMARY KEY, source)"))
+        try:
+            if sources is None:
+                primary = tables[0]
+                conn.execute(inventory.insert().from_select(['source'],
+                                                            select(primary.c[key]).order_by(primary.c[key])))
+            else:
+                names = list(dict.fromkeys(str(source) for source in sources))
+                if names:
+                    conn.execute(inventory.insert(), [{'source': name} for name in names])
+
+            # One cursor per table, all ordered by the position of the source in the inventory table
+            cursors = []
+            for table in tables:
+                source_column = table.c[key] if table is tables[0] else table.c[db._foreign_key]
+                query = select(inventory.c.idx, *table.columns). \
+                    join(inventory, inventory.c.source == source_column). \
+                    order_by(inventory.c.idx, *table.primary_key.columns)
+                drop = None if table is tables[0] else db._foreign_key
+                cursors.append((table.name, drop, iter(conn.execute(query)), [None]))
+
+            for idx, source in conn.execute(select(inventory.c.idx, inventory.c.source).order_by(inventory.c.idx)):
+                data = {}
+                for name, drop, cursor, pending in cursors:
+                    rows = []
+                    row = pending[0] if pending[0] is not None else next(cursor, None)
+                    while row is not None and row[0] == idx:
+                        row = dict(row._mapping)
+                        del row['idx']
+                        if drop is not None:
+                            del row[drop]
+                        rows.append(row)
+                        row = next(cursor, None)
+                    pending[0] = row
+                    if rows:
+                        data[name] = rows
+                yield source, data
+        finally:
+            conn.execute(text(f"DROP TABLE IF EXISTS {INVENTORY_TABLE}"))
+
+
+def source_filename(source):
+    """JSON file name of a source, as written by Database.save_json"""
+    return source.lower().replace(' ', '_').replace('*', '').strip() + '.json'
+
+
+def save_reference_tables(db, directory, tables=None):
+    """
+    Output reference tables into a directory as canonical JSON files (see simple.serialization.write_json),
+    one file per table, as Database.save_database. Empty tables have no file (an existing file is removed).
+
+    Parameters
+    ----------
+    db : astrodbkit2.astrodb.Database
+        Database to save
+    directory : str
+        Name of directory in which to save the output JSON
+    tables : list of str
+        Reference tables to save. Default: None (all reference tables)
+
+    Returns
+    -------
+    List of the names of the files saved
+    """
+
+    tables = db._reference_tables if tables is None else tables
+    saved = []
+    with db.engine.connect() as conn:
+        for name in tables:
+            if name not in db.metadata.tables:
+                continue
+            data = [dict(row._mapping) for row in conn.execute(db.metadata.tables[name].select())]
+            filename = name + '.json'
+            if data:
+                write_json(os.path.join(directory, filename), data, db._primary_table, db.metadata, name)
+                saved.append(filename)
+            elif os.path.exists(os.path.join(directory, filename)):
+                os.remove(os.path.join(directory, filename))
+    return saved
+
+
+def save_database(db, directory, clear_first=True, sources=None, changed_only=False):
+    """
+    Output the contents of the database into a directory as JSON files, with the same files as
+    Database.save_database, but reading the source data with inventory_many (one query per table)
+    and writing canonical JSON (see simple.serialization.write_json): files whose contents are unchanged
+    are left untouched.
+    With changed_only, only the sources and reference tables changed since the last save are written
+    (see simple.changes.create_change_tracking), and the files of deleted sources are removed.
+
+    Parameters
+    ----------
+    db : astrodbkit2.astrodb.Database
+        Database to save
+    directory : str
+        Name of directory in which to save the output JSON
+    clear_first : bool
+        Remove the other files of the directory (useful to capture DB deletions). Default: True.
+        Ignored with sources or changed_only, which only save part of the database.
+    sources : list of str
+        Only save these sources (and all the reference tables). Default: None (all sources).
+        Ignored with changed_only.
+    changed_only : bool
+        Only save the changes recorded by the change tracking, and clear them. Default: False.
+        Saving all the sources also clears the recorded changes.
+
+    Returns
+    -------
+    Number of source files written (new or changed)
+    """
+
+    if changed_only:
+        if not has_change_tracking(db):
+            raise RuntimeError('Changes are not tracked in this database, see simple.changes.create_change_tracking')
+        tables, sources = changed_tables(db), changed_sources(db)
+    else:
+        tables = None
+
+    saved = set(save_reference_tables(db, directory, tables))
+
+    count = 0
+    for source, data in inventory_many(db, sources):
+        filename = source_filename(source)
+        if data:
+            count += write_json(os.path.join(directory, filename), data, db._primary_table, db.metadata)
+            saved.add(filename)
+        elif changed_only and os.path.exists(os.path.join(directory, filename)):
+            os.remove(os.path.join(directory, filename))
+
+    if clear_first and sources is None and not changed_only:
+        for filename in os.listdir(directory):
+            if filename not in saved:
+                os.remove(os.path.join(directory, filename))
+
+    # Only the changes saved here are cleared, in case the database was modified in the meantime
+    if changed_only or (sources is None and has_change_tracking(db)):
+        with db.engine.begin() as conn:
+            clear_changes(conn, sources, tables)
+
+    return count
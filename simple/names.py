@@ -0,0 +1,203 @@
+# Name normalization and indexed name searches over the Names table
+
+import sqlite3
+from sqlalchemy import inspect, text
+from astrodbkit2.utils import _name_formatter
+from simple.database import DERIVED_TABLE_PREFIX, _format, normalized_name_sql
+
+# Full-text (trigram) index over the normalized names, kept in sync with Names by triggers.
+# The keys table gives each name a stable integer id (also the rowid in the index), used to find it on deletion.
+NAME_INDEX_TABLE = DERIVED_TABLE_PREFIX + 'NamesSearch'
+NAME_KEYS_TABLE = DERIVED_TABLE_PREFIX + 'NamesSearchKeys'
+NAME_INDEX_TRIGGERS = [NAME_INDEX_TABLE + suffix for suffix in ('_insert', '_delete', '_update')]
+# First SQLite version with the FTS5 trigram tokenizer used by the index
+NAME_INDEX_SQLITE_VERSION = (3, 34, 0)
+
+_ASCII_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+
+
+def normalize_name(name):
+    """
+    Normalize a name for matching: astrodbkit2.utils._name_formatter (whitespace collapsed,
+    Simbad prefixes removed) and lower case. Only ASCII letters are lowered, as with the SQLite lower function,
+    so the result matches normalized_name_sql.
+
+    Parameters
+    ----------
+    name : str
+        Name to normalize
+
+    Returns
+    -------
+    Normalized name, None for Simbad hidden names
+    """
+
+    if isinstance(name, bytes):
+        name = name.decode()
+    name = _name_formatter(str(name).replace('\t', ' ').replace('\n', ' ').replace('\r', ' '))
+    return None if name is None else name.translate(_ASCII_LOWER)
+
+
+def match_names(db, names, fmt='astropy'):
+    """
+    Match many names exactly (after normalization, see normalize_name) against the Names table.
+    The names are normalized once, written to a temporary table, and resolved with a single join
+    on the ix_Names_normalized_name index.
+
+    Parameters
+    ----------
+    db : astrodbkit2.astrodb.Database
+        Database to match against
+    names : list of str
+        Names to match
+    fmt : str
+        Format to return results in (astropy/table, pandas, default)
+
+    Returns
+    -------
+    Table with one row per matched name and source: index (position of the input name), name (the input name),
+    and source, sorted by index and source. Names without matches are not included.
+    """
+
+    rows = [{'idx': i, 'name': normalize_name(name)} for i, name in enumerate(names)]
+    rows = [row for row in rows if row['name']]
+
+    results = []
+    if rows:
+        with db.engine.begin() as conn:
+            # name is declared without a type: a TEXT column would add an affinity to the join comparison,
+            # which prevents SQLite from using the expression index
+            conn.execute(text("CREATE TEMPORARY TABLE _match_names (idx INTEGER, name)"))
+            try:
+                conn.execute(text("INSERT INTO _match_names (idx, name) VALUES (:idx, :name)"), rows)
+                results = conn.execute(text(f"SELECT DISTINCT m.idx, Names.source FROM _match_names AS m "
+                                            f"JOIN Names ON {normalized_name_sql('Names.other_name')} = m.name "
+                                            f"ORDER BY m.idx, Names.source")).fetchall()
+            finally:
+                conn.execute(text("DROP TABLE _match_names"))
+
+    results = [(i, str(names[i]), source) for i, source in results]
+    return _format(results, ['index', 'name', 'source'], fmt, dtype=[int, str, str])
+
+
+def name_index_supported():
+    """Whether the SQLite library used by Python supports the name index (FTS5 trigram tokenizer)"""
+    return sqlite3.sqlite_version_info >= NAME_INDEX_SQLITE_VERSION
+
+
+def create_name_index(db):
+    """
+    Create (or rebuild) the trigram full-text index over the normalized names of the Names table.
+    Triggers on Names keep the index up to date when names are added, changed, or deleted.
+    The index is stored in derived tables, see simple.database.connect to hide them from astrodbkit2.
+    Requires SQLite 3.34 or later (FTS5 trigram tokenizer).
+
+    Parameters
+    ----------
+    db : astrodbkit2.astrodb.Database
+        Database to index
+    """
+
+    if not name_index_supported():
+        raise RuntimeError(f'The name index requires SQLite {".".join(map(str, NAME_INDEX_SQLITE_VERSION))} or later '
+                           f'(FTS5 trigram tokenizer), found {sqlite3.sqlite_version}. '
+                           f'search_names works without the index.')
+
+    key = "source = {0}.source AND other_name = {0}.other_name"
+    delete = f"DELETE FROM {NAME_INDEX_TABLE} " \
+             f"WHERE rowid = (SELECT id FROM {NAME_KEYS_TABLE} WHERE {key.format('old')});" \
+             f"DELETE FROM {NAME_KEYS_TABLE} WHERE {key.format('old')};"
+    insert = f"INSERT INTO {NAME_KEYS_TABLE} (source, other_name) VALUES (new.source, new.other_name);" \
+             f"INSERT INTO {NAME_INDEX_TABLE} (rowid, name, other_name, source) " \
+             f"VALUES (last_insert_rowid(), {normalized_name_sql('new.other_name')}, new.other_name, new.source);"
+
+    with db.engine.begin() as conn:
+        drop_name_index(conn)
+        conn.execute(text(f"CREATE TABLE {NAME_KEYS_TABLE} (id INTEGER PRIMARY KEY, source TEXT, other_name TEXT, "
+                          f"UNIQUE (source, other_name))"))
+        conn.execute(text(f"CREATE VIRTUAL TABLE {NAME_INDEX_TABLE} USING fts5("
+                          f"name, other_name UNINDEXED, source UNINDEXED, tokenize='trigram')"))
+        conn.execute(text(f"INSERT INTO {NAME_KEYS_TABLE} (source, other_name) SELECT source, other_name FROM Names"))
+        conn.execute(text(f"INSERT INTO {NAME_INDEX_TABLE} (rowid, name, other_name, source) "
+                          f"SELECT id, {normalized_name_sql('other_name')}, other_name, source FROM {NAME_KEYS_TABLE}"))
+
+        triggers = {'_insert': ('AFTER INSERT', insert),
+                    '_delete': ('AFTER DELETE', delete),
+                    '_update': ('AFTER UPDATE OF source, other_name', delete + insert)}
+        for suffix, (event, statements) in triggers.items():
+            conn.execute(text(f"CREATE TRIGGER {NAME_INDEX_TABLE}{suffix} {event} ON Names "
+                              f"BEGIN {statements} END"))
+
+
+def drop_name_index(conn):
+    """
+    Drop the full-text name index and its triggers, eg before a bulk reload of Names
+
+    Parameters
+    ----------
+    conn : sqlalchemy.engine.Connection or Engine
+        Connection to the database
+    """
+
+    for trigger in NAME_INDEX_TRIGGERS:
+        conn.execute(text(f"DROP TRIGGER IF EXISTS {trigger}"))
+    conn.execute(text(f"DROP TABLE IF EXISTS {NAME_INDEX_TABLE}"))
+    conn.execute(text(f"DROP TABLE IF EXISTS {NAME_KEYS_TABLE}"))
+
+
+def has_name_index(db):
+    """Whether the database has the full-text name index"""
+    return inspect(db.engine).has_table(NAME_INDEX_TABLE)
+
+
+def search_names(db, name, limit=20, fmt='astropy'):
+    """
+    Fuzzy search for sources by name, using the full-text name index when available.
+    The normalized name is searched as a substring of the normalized names, and candidates are ranked by
+    exact matches first, then names starting with the search string, then shorter (closer) names.
+    Without the index, or for searches shorter than 3 characters, the Names table is scanned instead.
+
+    Parameters
+    ----------
+    db : astrodbkit2.astrodb.Database
+        Database to search
+    name : str
+        (Part of) the name to search for, eg '0141'
+    limit : int
+        Maximum number of sources to return. Default: 20
+    fmt : str
+        Format to return results in (astropy/table, pandas, default)
+
+    Returns
+    -------
+    Table of matched sources, with the best matching name of each source and its rank (1 is best)
+    """
+
+    query = normalize_name(name)
+    if not query:
+        return _format([], ['source', 'other_name', 'rank'], fmt, dtype=[str, str, int])
+
+    pattern = '%' + query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    if len(query) >= 3 and has_name_index(db):
+        candidates = f"SELECT name, other_name, source FROM {NAME_INDEX_TABLE} WHERE {NAME_INDEX_TABLE} MATCH :match"
+        parameters = {'match': 'name : "' + query.replace('"', '""') + '"'}
+    else:
+        candidates = f"SELECT {normalized_name_sql('other_name')} AS name, other_name, source FROM Names " \
+                     f"WHERE {normalized_name_sql('other_name')} LIKE :pattern ESCAPE '\\'"
+        parameters = {'pattern': pattern}
+
+    sql = f"SELECT source, other_name FROM ({candidates}) " \
+          f"ORDER BY name = :query DESC, substr(name, 1, length(:query)) = :query DESC, length(name), source"
+    with db.engine.connect() as conn:
+        rows = conn.execute(text(sql), dict(parameters, query=query)).fetchall()
+
+    # Keep the best name of each source
+    results, seen = [], set()
+    for source, other_name in rows:
+        if source not in seen:
+            seen.add(source)
+            results.append((source, other_name, len(results) + 1))
+            if len(results) == limit:
+                break
+
+    return _format(results, ['source', 'other_name', 'rank'], fmt, dtype=[str, str, int])
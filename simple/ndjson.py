@@ -0,0 +1,142 @@
+# Consolidated data layout: one newline-delimited JSON (NDJSON) file per table, as an alternative to one file per source
+
+import os
+import filecmp
+from itertools import chain
+from simple.build import data_tables, table_columns
+from simple.serialization import dumps_row, read_ndjson
+
+NDJSON_EXTENSION = '.ndjson'
+
+# Number of rows inserted with each executemany when loading
+BATCH_SIZE = 10000
+
+
+def _write_if_changed(filename, lines):
+    # Write the lines to a temporary file and only replace the file if its contents changed
+    temporary = filename + '.tmp'
+    with open(temporary, 'w', encoding='ascii', newline='\n') as f:
+        for line in lines:
+            f.write(line + '\n')
+    if os.path.exists(filename) and filecmp.cmp(temporary, filename, shallow=False):
+        os.remove(temporary)
+        return False
+    os.replace(temporary, filename)
+    return True
+
+
+def save_ndjson(db, directory, clear_first=True):
+    """
+    Output the contents of the database into a directory with one NDJSON file per table (eg Photometry.ndjson).
+    Each line is a row in compact canonical JSON (see simple.serialization.dumps_row), including its source,
+    and the rows are sorted by primary key, so saving the same data always gives the same files.
+    Rows of reference tables keep the order of the database, as in the files of Database.save_database.
+    The rows are streamed from the database one table at a time, and files whose contents are unchanged
+    are left untouched.
+
+    Parameters
+    ----------
+    db : astrodbkit2.astrodb.Database
+        Database to save
+    directory : str
+        Name of directory in which to save the output NDJSON
+    clear_first : bool
+        Remove the NDJSON files of tables that are empty or no longer in the database. Default: True
+
+    Returns
+    -------
+    List of the names of the files written (new or changed)
+    """
+
+    written, saved = [], set()
+    with db.engine.connect() as conn:
+        for table in data_tables(db.metadata):
+            query = table.select()
+            if table.name not in db._reference_tables:
+                query = query.order_by(*table.primary_key.columns)
+            result = conn.execute(query)
+            lines = (dumps_row(dict(row._mapping)) for row in result)
+            first = next(lines, None)
+            if first is None:
+                continue
+            filename = table.name + NDJSON_EXTENSION
+            if _write_if_changed(os.path.join(directory, filename), chain([first], lines)):
+                written.append(filename)
+            saved.add(filename)
+
+    if clear_first:
+        for filename in os.listdir(directory):
+            if filename.endswith(NDJSON_EXTENSION) and filename not in saved:
+                os.remove(os.path.join(directory, filename))
+
+    return written
+
+
+def _read_table(filename, table, columns):
+    # Rows of an NDJSON table file, validated and filled out with all the columns of the table
+    known = set(columns)
+    for number, row in read_ndjson(filename):
+        unknown = set(row) - known
+        if unknown:
+            raise RuntimeError(f'{filename}:{number}: unknown {table} columns {sorted(unknown)}')
+        yield {c: row.get(c) for c in columns}
+
+
+def load_ndjson(db, directory, batch_size=BATCH_SIZE, verbose=False):
+    """
+    Reload the entire database from a directory of NDJSON files written by save_ndjson.
+    The existing contents are cleared and each file is streamed into its table in batches,
+    in foreign key order, inside one transaction.
+    Loading the NDJSON files and saving with simple.export.save_database gives the one file per source layout
+    (and the reverse with simple.build.load_database_parallel and save_ndjson).
+
+    Parameters
+    ----------
+    db : astrodbkit2.astrodb.Database
+        Database to load
+    directory : str
+        Name of directory containing the NDJSON files
+    batch_size : int
+        Number of rows inserted at a time. Default: 10000
+    verbose : bool
+        Flag to enable diagnostic messages
+
+    Returns
+    -------
+    Dictionary of table name: number of rows loaded
+    """
+
+    verboseprint = print if verbose else lambda *a, **k: None
+
+    columns = table_columns(db.metadata)
+    unknown = sorted(file for file in os.listdir(directory)
+                     if file.endswith(NDJSON_EXTENSION) and file[:-len(NDJSON_EXTENSION)] not in columns)
+    if unknown:
+        raise RuntimeError(f'Tables not in the database: {unknown}')
+
+    counts = {}
+    with db.engine.begin() as conn:
+        for table in reversed(data_tables(db.metadata)):
+            verboseprint(f'Deleting {table.name} table')
+            conn.execute(table.delete())
+
+        for table in data_tables(db.metadata):
+            filename = os.path.join(directory, table.name + NDJSON_EXTENSION)
+            if not os.path.exists(filename):
+                verboseprint(f'{table.name}{NDJSON_EXTENSION} not found.')
+                continue
+
+            counts[table.name] = 0
+            batch = []
+            for row in _read_table(filename, table.name, columns[table.name]):
+                batch.append(row)
+                if len(batch) == batch_size:
+                    conn.execute(table.insert(), batch)
+                    counts[table.name] += len(batch)
+                    batch = []
+            if batch:
+                conn.execute(table.insert(), batch)
+                counts[table.name] += len(batch)
+            verboseprint(f'Loaded {counts[table.name]} rows into {table.name}')
+
+    return counts
@@ -0,0 +1,245 @@
+# Wide (one column per band) photometry tables, and vectorized colors and absolute magnitudes
+
+import numpy as np
+from astropy.table import Table
+from sqlalchemy import select
+from simple.adopted import ADOPTION_RULES, CHUNK_SIZE
+from simple.summary import SUMMARY_BANDS
+
+# Rules choosing the measurement of a band when a source has several, as in simple.adopted.adoption_order
+PHOTOMETRY_RULES = ['smallest_error', 'most_recent']
+
+
+def _lookup(values, keys):
+    # Position of each value in keys (-1 when missing), vectorized with a sorted copy of keys
+    values, keys = np.asarray(values), np.asarray(keys)
+    if not len(keys) or not len(values):
+        return np.full(len(values), -1)
+    order = np.argsort(keys, kind='stable')
+    position = np.clip(np.searchsorted(keys[order], values), 0, len(keys) - 1)
+    found = keys[order][position] == values
+    return np.where(found, order[position], -1)
+
+
+def color(magnitude1, error1, magnitude2, error2):
+    """
+    Colors (magnitude1 - magnitude2) and their uncertainties, for arrays of magnitudes.
+    Missing values (NaN) give NaN.
+
+    Parameters
+    ----------
+    magnitude1, error1 : array
+        Magnitudes and uncertainties in the first band
+    magnitude2, error2 : array
+        Magnitudes and uncertainties in the second band
+
+    Returns
+    -------
+    colors : numpy.ndarray
+    errors : numpy.ndarray
+    """
+
+    magnitude1, magnitude2 = np.asarray(magnitude1, dtype=float), np.asarray(magnitude2, dtype=float)
+    return magnitude1 - magnitude2, np.hypot(np.asarray(error1, dtype=float), np.asarray(error2, dtype=float))
+
+
+def absolute_magnitude(magnitude, error, parallax, parallax_error):
+    """
+    Absolute magnitudes, M = m + 5 log10(parallax / 100 mas), and their uncertainties
+    (propagated from the magnitude and parallax uncertainties), for arrays of magnitudes and parallaxes.
+    Missing values (NaN) and non-positive parallaxes give NaN.
+
+    Parameters
+    ----------
+    magnitude, error : array
+        Apparent magnitudes and uncertainties
+    parallax, parallax_error : array
+        Parallaxes and uncertainties, in milliarcseconds
+
+    Returns
+    -------
+    magnitudes : numpy.ndarray
+    errors : numpy.ndarray
+    """
+
+    magnitude, error = np.asarray(magnitude, dtype=float), np.asarray(error, dtype=float)
+    parallax, parallax_error = np.asarray(parallax, dtype=float), np.asarray(parallax_error, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        parallax = np.where(parallax > 0, parallax, np.nan)
+        magnitudes = magnitude + 5 * np.log10(parallax) - 10
+        errors = np.hypot(error, 5 / np.log(10) * parallax_error / parallax)
+    return magnitudes, errors
+
+
+def _rank_keys(rules, errors, years):
+    # Sort keys implementing the adoption rules (see simple.adopted.adoption_order), missing values last
+    keys = []
+    for rule in rules:
+        if rule == 'smallest_error':
+            keys += [np.isnan(errors), errors]
+        elif rule == 'most_recent':
+            keys += [np.isnan(years), -years]
+        else:
+            raise ValueError(f'Unknown photometry rule: {rule}')
+    return keys
+
+
+def _publication_years(conn, metadata, references):
+    # Year of the publication (from its bibcode) of each reference, NaN when unknown, and the reference codes
+    # (their positions in the sorted references, to break ties by reference)
+    publications = metadata.tables['Publications']
+    names, codes = np.unique(np.asarray(references, dtype=str), return_inverse=True)
+    bibcodes = dict(conn.execute(select(publications.c.name, publications.c.bibcode)).fetchall())
+    years = [bibcodes.get(name) or '' for name in names]
+    years = np.array([float(year[:4]) if year[:4].isdigit() else np.nan for year in years])
+    return years[codes], codes
+
+
+def _best_rows(conn, metadata, query, names, rules, error_column, float_columns, bands=None):
+    # Read the measurements of a query with source, reference, and error_column columns (and band, adopted),
+    # and choose the best measurement of each source of names (and band of bands) with vectorized sorts:
+    # adopted measurements first, then the rules, then the reference.
+    # Returns the positions of the best rows in names (and bands), and the float columns of these rows
+    result = conn.execute(query)
+    rows = result.fetchall()
+    if not rows:
+        return np.array([], dtype=int), np.array([], dtype=int), {key: np.array([]) for key in float_columns}
+    columns = dict(zip(result.keys(), zip(*rows)))
+
+    i = _lookup(np.array(columns['source'], dtype=str), names)
+    j = np.zeros(len(rows), dtype=int) if bands is None else \
+        _lookup(np.array(columns['band'], dtype=str), np.array(bands, dtype=str))
+    errors = np.array(columns[error_column], dtype=float)
+    years, reference_codes = _publication_years(conn, metadata, columns['reference'])
+    keys = [np.array([adopted is not True for adopted in columns['adopted']])] if 'adopted' in columns else []
+    keys += _rank_keys(rules, errors, years) + [reference_codes]
+
+    groups = i * (len(bands) if bands else 1) + j
+    keep = np.flatnonzero((i >= 0) & (j >= 0))
+    order = keep[np.lexsort([key[keep] for key in reversed(keys)] + [groups[keep]])]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = groups[order][1:] != groups[order][:-1]
+    best = order[first]
+    return i[best], j[best], {key: np.array(columns[key], dtype=float)[best] for key in float_columns}
+
+
+def pivot_photometry(db, bands=None, sources=None, rules=None, parallaxes=True, fmt='astropy'):
+    """
+    Wide photometry table, with one row per source and the magnitude (band) and uncertainty (band_error) of
+    each band as columns, NaN when missing. The measurements are read with a single query, and the measurement
+    of each band is chosen and placed in the table with vectorized numpy operations.
+
+    Parameters
+    ----------
+    db : astrodbkit2.astrodb.Database
+        Database to query
+    bands : list of str
+        Bands to include. Default: None (2MASS and WISE bands of simple.summary.SUMMARY_BANDS)
+    sources : list of str
+        Sources to include, in this order. Default: None (all sources, sorted by name)
+    rules : list of str
+        Rules choosing the measurement of a band when there are several (smallest_error, most_recent),
+        applied in order and then by reference, as in simple.adopted.adoption_order.
+        Default: PHOTOMETRY_RULES (smallest error, then most recent)
+    parallaxes : bool
+        Also include the parallax and parallax_error of the adopted parallax of each source
+        (or the best one, see simple.adopted.ADOPTION_RULES). Default: True
+    fmt : str
+        Format to return results in (astropy/table, pandas)
+
+    Returns
+    -------
+    Table with the source, band and band_error columns, and parallax and parallax_error columns
+    """
+
+    bands = list(SUMMARY_BANDS if bands is None else bands)
+    rules = PHOTOMETRY_RULES if rules is None else rules
+    photometry = db.metadata.tables['Photometry']
+    parallax_table = db.metadata.tables['Parallaxes']
+    query = select(photometry.c.source, photometry.c.band, photometry.c.magnitude, photometry.c.magnitude_error,
+                   photometry.c.reference).where(photometry.c.band.in_(bands))
+    parallax_query = select(parallax_table.c.source, parallax_table.c.parallax, parallax_table.c.parallax_error,
+                            parallax_table.c.adopted, parallax_table.c.reference)
+
+    with db.engine.connect() as conn:
+        if sources is None:
+            sources_table = db.metadata.tables['Sources']
+            sources = conn.execute(select(sources_table.c.source).order_by(sources_table.c.source)).scalars().all()
+        else:
+            sources = list(dict.fromkeys(str(source) for source in sources))
+            if len(sources) <= CHUNK_SIZE:
+                # Otherwise it is cheaper to read every source, the others are dropped by _best_rows
+                query = query.where(photometry.c.source.in_(sources))
+                parallax_query = parallax_query.where(parallax_table.c.source.in_(sources))
+
+        names = np.array(sources, dtype=str)
+        i, j, best = _best_rows(conn, db.metadata, query, names, rules, 'magnitude_error',
+                                ['magnitude', 'magnitude_error'], bands)
+        if parallaxes:
+            config = ADOPTION_RULES['Parallaxes']
+            parallax_i, _, best_parallax = _best_rows(conn, db.metadata, parallax_query, names, config['rules'],
+                                                      config['error_column'], ['parallax', 'parallax_error'])
+
+    magnitudes = np.full((len(names), len(bands)), np.nan)
+    errors = np.full((len(names), len(bands)), np.nan)
+    magnitudes[i, j] = best['magnitude']
+    errors[i, j] = best['magnitude_error']
+
+    t = Table()
+    t['source'] = names
+    for k, band in enumerate(bands):
+        t[band] = magnitudes[:, k]
+        t[band + '_error'] = errors[:, k]
+
+    if parallaxes:
+        for column in ('parallax', 'parallax_error'):
+            t[column] = np.full(len(names), np.nan)
+            t[column][parallax_i] = best_parallax[column]
+
+    return t.to_pandas() if fmt.lower() == 'pandas' else t
+
+
+def add_colors(t, pairs):
+    """
+    Add color columns (band1-band2, and band1-band2_error for the uncertainty) to a wide photometry table
+
+    Parameters
+    ----------
+    t : astropy.table.Table or pandas.DataFrame
+        Wide photometry table, see pivot_photometry
+    pairs : list of tuple
+        Pairs of bands, eg [('WISE_W1', 'WISE_W2')]
+
+    Returns
+    -------
+    The table, with the new columns
+    """
+
+    for band1, band2 in pairs:
+        name = f'{band1}-{band2}'
+        t[name], t[name + '_error'] = color(t[band1], t[band1 + '_error'], t[band2], t[band2 + '_error'])
+    return t
+
+
+def add_absolute_magnitudes(t, bands):
+    """
+    Add absolute magnitude columns (M_band, and M_band_error for the uncertainty) to a wide photometry table,
+    using its parallax and parallax_error columns
+
+    Parameters
+    ----------
+    t : astropy.table.Table or pandas.DataFrame
+        Wide photometry table with parallaxes, see pivot_photometry
+    bands : list of str
+        Bands, eg ['WISE_W1', 'WISE_W2']
+
+    Returns
+    -------
+    The table, with the new columns
+    """
+
+    for band in bands:
+        name = 'M_' + band
+        t[name], t[name + '_error'] = absolute_magnitude(t[band], t[band + '_error'],
+                                                        t['parallax'], t['parallax_error'])
+    return t
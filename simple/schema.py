@@ -1,8 +1,24 @@
 # Schema for the SIMPLE database
 
-from sqlalchemy import Boolean, Column, Float, ForeignKey, Integer, String, BigInteger, Enum, Date, DateTime
+from sqlalchemy import Boolean, Column, Float, ForeignKey, Integer, String, BigInteger, Enum, Date, DateTime, Index, \
+    CheckConstraint, text
 import enum
+import warnings
+from sqlalchemy.exc import SAWarning
 from astrodbkit2.astrodb import Base
+from simple.database import normalized_name_sql
+
+# SQLAlchemy can not reflect expression indexes (ix_Names_normalized_name) and warns each time a Database is created
+warnings.filterwarnings('ignore', message='Skipped unsupported reflection of expression-based index', category=SAWarning)
+
+# Data quality rules enforced by the database are named CHECK constraints (ck_<table>_<column>), so bad rows are
+# rejected at insert time with the name of the rule. See simple.validation for the rules checked after loading.
+
+
+def adopted_index(table_name):
+    # At most one adopted measurement per source. Partial indexes are supported by SQLite and PostgreSQL.
+    return Index(f'ix_{table_name}_adopted', 'source', unique=True,
+                 sqlite_where=text('adopted'), postgresql_where=text('adopted'))
 
 
 # -------------------------------------------------------------------------------------------------------------------
@@ -23,12 +39,20 @@ class Telescopes(Base):
     name = Column(String(30), primary_key=True, nullable=False)
     reference = Column(String(30), ForeignKey('Publications.name', onupdate='cascade'))
 
+    __table_args__ = (
+        Index('ix_Telescopes_reference', 'reference'),
+    )
+
 
 class Instruments(Base):
     __tablename__ = 'Instruments'
     name = Column(String(30), primary_key=True, nullable=False)
     reference = Column(String(30), ForeignKey('Publications.name', onupdate='cascade'))
 
+    __table_args__ = (
+        Index('ix_Instruments_reference', 'reference'),
+    )
+
 
 # -------------------------------------------------------------------------------------------------------------------
 # Hard-coded enumerations
@@ -73,6 +97,13 @@ class Sources(Base):
     reference = Column(String(30), ForeignKey('Publications.name', onupdate='cascade'), nullable=False)
     comments = Column(String(1000))
 
+    __table_args__ = (
+        Index('ix_Sources_dec_ra', 'dec', 'ra'),  # positional queries, see simple.spatial
+        Index('ix_Sources_reference', 'reference'),  # reference lookups and foreign key checks
+        CheckConstraint('ra >= 0 AND ra <= 360', name='ck_Sources_ra'),
+        CheckConstraint('dec >= -90 AND dec <= 90', name='ck_Sources_dec'),
+    )
+
 
 class Names(Base):
     __tablename__ = 'Names'
@@ -80,6 +111,11 @@ class Names(Base):
                     nullable=False, primary_key=True)
     other_name = Column(String(100), primary_key=True, nullable=False)
 
+    __table_args__ = (
+        Index('ix_Names_other_name', 'other_name'),  # name lookups, as in search_object
+        Index('ix_Names_normalized_name', text(normalized_name_sql('other_name'))),  # see simple.names.match_names
+    )
+
 
 class Photometry(Base):
     __tablename__ = 'Photometry'
@@ -96,6 +132,14 @@ class Photometry(Base):
     comments = Column(String(1000))
     reference = Column(String(30), ForeignKey('Publications.name', onupdate='cascade'), primary_key=True)
 
+    __table_args__ = (
+        Index('ix_Photometry_band_source', 'band', 'source'),  # queries by band
+        Index('ix_Photometry_telescope', 'telescope'),
+        Index('ix_Photometry_instrument', 'instrument'),
+        Index('ix_Photometry_reference', 'reference'),
+        CheckConstraint('magnitude >= 0 AND magnitude < 99', name='ck_Photometry_magnitude'),  # 99 flags missing values
+    )
+
 
 class Parallaxes(Base):
     # Table to store parallax values in milliarcseconds
@@ -108,6 +152,11 @@ class Parallaxes(Base):
     comments = Column(String(1000))
     reference = Column(String(30), ForeignKey('Publications.name', onupdate='cascade'), primary_key=True)
 
+    __table_args__ = (
+        Index('ix_Parallaxes_reference', 'reference'),
+        adopted_index('Parallaxes'),
+    )
+
 
 class ProperMotions(Base):
     # Table to store proper motions, in milliarcseconds per year
@@ -121,6 +170,12 @@ class ProperMotions(Base):
     comments = Column(String(1000))
     reference = Column(String(30), ForeignKey('Publications.name', ondelete='cascade'), primary_key=True)
 
+    __table_args__ = (
+        Index('ix_ProperMotions_reference', 'reference'),
+        CheckConstraint('mu_ra IS NOT NULL', name='ck_ProperMotions_mu_ra'),
+        CheckConstraint('mu_dec IS NOT NULL', name='ck_ProperMotions_mu_dec'),
+    )
+
 
 class RadialVelocities(Base):
     # Table to store radial velocities, in km/sec
@@ -132,6 +187,11 @@ class RadialVelocities(Base):
     comments = Column(String(1000))
     reference = Column(String(30), ForeignKey('Publications.name', ondelete='cascade'), primary_key=True)
 
+    __table_args__ = (
+        Index('ix_RadialVelocities_reference', 'reference'),
+        CheckConstraint('radial_velocity IS NOT NULL', name='ck_RadialVelocities_radial_velocity'),
+    )
+
 
 class SpectralTypes(Base):
     # Table to store spectral types, as strings
@@ -146,6 +206,11 @@ class SpectralTypes(Base):
     comments = Column(String(1000))
     reference = Column(String(30), ForeignKey('Publications.name', ondelete='cascade'), primary_key=True)
 
+    __table_args__ = (
+        Index('ix_SpectralTypes_reference', 'reference'),
+        adopted_index('SpectralTypes'),
+    )
+
 
 class Gravities(Base):
     # Table to store gravity measurements
@@ -156,3 +221,7 @@ class Gravities(Base):
     regime = Column(Enum(Regime, create_constraint=True), primary_key=True)  # restricts to a few values: Optical, Infrared
     comments = Column(String(1000))
     reference = Column(String(30), ForeignKey('Publications.name', ondelete='cascade'), primary_key=True)
+
+    __table_args__ = (
+        Index('ix_Gravities_reference', 'reference'),
+    )
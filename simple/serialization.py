@@ -0,0 +1,269 @@
+# Canonical JSON writer and fast reader for the files of the data directory
+
+import os
+import json
+import math
+from datetime import date, datetime
+from decimal import Decimal
+from json.encoder import encode_basestring_ascii
+from astrodbkit2 import PRIMARY_TABLE
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+INDENT = ' ' * 4
+
+
+def _sort_value(value):
+    # Sort key of a value, valid across types: nulls first, then numbers, then strings
+    if value is None:
+        return 0, 0
+    if isinstance(value, (bool, int, float)):
+        return (0, 0) if value != value else (1, value)
+    return 2, str(value)
+
+
+def canonical_data(data, primary_table=PRIMARY_TABLE, metadata=None, table=None):
+    """
+    Put the contents of a JSON file in canonical order, the order of the files written by Database.save_json:
+    the primary table first, then the other tables in schema order, the keys of the rows in schema column order,
+    and the rows of the source tables in primary key order. Rows of reference tables keep their order,
+    as they are saved in the order of the database.
+    Without metadata, the tables, keys and rows keep their order, after the primary table.
+
+    Parameters
+    ----------
+    data : dict or list
+        Contents of a source file (dictionary of table name: list of rows)
+        or of a reference table file (list of rows)
+    primary_table : str
+        Name of the primary table, first in source files. Default: Sources
+    metadata : sqlalchemy.MetaData
+        Schema of the database. Default: None (keep the order of data)
+    table : str
+        Name of the reference table, for a reference table file. Default: None
+
+    Returns
+    -------
+    Data in canonical order
+    """
+
+    def rows(value, name, sort):
+        schema = metadata.tables.get(name) if metadata is not None else None
+        if schema is None:
+            return list(value)
+        columns = {column: i for i, column in enumerate(schema.columns.keys())}
+        value = [{key: row[key] for key in sorted(row, key=lambda key: columns.get(key, len(columns)))}
+                 for row in value]
+        keys = [column.name for column in schema.primary_key.columns]
+        if sort and len(value) > 1:
+            value.sort(key=lambda row: [_sort_value(row.get(key)) for key in keys])
+        return value
+
+    if isinstance(data, list):
+        return rows(data, table, False)
+
+    order = {name: i for i, name in enumerate(metadata.tables)} if metadata is not None else {}
+    tables = sorted(data, key=lambda name: (name != primary_table, order.get(name, len(order))))
+    return {name: rows(data[name], name, True) for name in tables}
+
+
+def _float(value):
+    # NaN and infinities are not valid JSON, and are stored as NULL in the database
+    value = float(value)
+    return float.__repr__(value) if math.isfinite(value) else 'null'
+
+
+_ENCODERS = {type(None): lambda value: 'null',
+             str: encode_basestring_ascii,
+             bool: lambda value: 'true' if value else 'false',
+             int: int.__repr__,
+             float: _float,
+             Decimal: _float,
+             date: lambda value: encode_basestring_ascii(value.isoformat()),
+             datetime: lambda value: encode_basestring_ascii(value.isoformat())}
+
+
+def _scalar(value):
+    # Canonical JSON representation of a row value, also for subclasses of the supported types
+    encoder = _ENCODERS.get(type(value))
+    if encoder is None:
+        for kind, kind_encoder in _ENCODERS.items():
+            if isinstance(value, kind):
+                return kind_encoder(value)
+        raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+    return encoder(value)
+
+
+def _encode_rows(rows, level):
+    # Same layout as json.dumps(rows, indent=4) for a list of rows (flat dictionaries), nested at the given level
+    if not rows:
+        return '[]'
+    row_pad = '\n' + INDENT * (level + 1)
+    value_pad = row_pad + INDENT
+    encoded = []
+    for row in rows:
+        if row:
+            try:
+                items = [encode_basestring_ascii(key) + ': ' + _ENCODERS[type(value)](value)
+                         for key, value in row.items()]
+            except KeyError:
+                items = [encode_basestring_ascii(key) + ': ' + _scalar(value) for key, value in row.items()]
+            encoded.append('{' + value_pad + (',' + value_pad).join(items) + row_pad + '}')
+        else:
+            encoded.append('{}')
+    return '[' + row_pad + (',' + row_pad).join(encoded) + '\n' + INDENT * level + ']'
+
+
+def dumps(data, primary_table=PRIMARY_TABLE, metadata=None, table=None):
+    """
+    Serialize the contents of a JSON file in canonical form (see canonical_data), indented by 4 spaces.
+    Floats use the shortest representation that round-trips, and datetimes their ISO format,
+    so saving the same data always gives the same bytes.
+
+    Parameters
+    ----------
+    data : dict or list
+        Contents of a source file or of a reference table file
+    primary_table : str
+        Name of the primary table, first in source files. Default: Sources
+    metadata : sqlalchemy.MetaData
+        Schema of the database. Default: None (keep the order of data)
+    table : str
+        Name of the reference table, for a reference table file. Default: None
+
+    Returns
+    -------
+    JSON string
+    """
+
+    data = canonical_data(data, primary_table, metadata, table)
+    if isinstance(data, list):
+        return _encode_rows(data, 0)
+    if not data:
+        return '{}'
+    items = [encode_basestring_ascii(name) + ': ' + _encode_rows(rows, 1) for name, rows in data.items()]
+    return '{\n' + INDENT + (',\n' + INDENT).join(items) + '\n}'
+
+
+def write_json(filename, data, primary_table=PRIMARY_TABLE, metadata=None, table=None):
+    """
+    Write the contents of a JSON file in canonical form (see dumps).
+    The file is left untouched if it already has these contents, so its modification time only changes with its data.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the JSON file
+    data : dict or list
+        Contents of a source file or of a reference table file
+    primary_table : str
+        Name of the primary table, first in source files. Default: Sources
+    metadata : sqlalchemy.MetaData
+        Schema of the database. Default: None (keep the order of data)
+    table : str
+        Name of the reference table, for a reference table file. Default: None
+
+    Returns
+    -------
+    Whether the file was written
+    """
+
+    contents = dumps(data, primary_table, metadata, table).encode('ascii')
+    if os.path.exists(filename) and os.path.getsize(filename) == len(contents):
+        with open(filename, 'rb') as f:
+            if f.read() == contents:
+                return False
+    with open(filename, 'wb') as f:
+        f.write(contents)
+    return True
+
+
+def _parse_dates(row):
+    # Same conversion as astrodbkit2.utils.datetime_json_parser, only trying strings that can be ISO dates
+    for key, value in row.items():
+        if isinstance(value, str) and len(value) >= 7 and value[:4].isdigit():
+            try:
+                row[key] = datetime.fromisoformat(value)
+            except ValueError:
+                pass
+    return row
+
+
+def read_json(filename, parse_dates=True):
+    """
+    Read a JSON file of the data directory, with orjson when it is installed
+
+    Parameters
+    ----------
+    filename : str
+        Name of the JSON file
+    parse_dates : bool
+        Convert ISO date strings to datetimes, as astrodbkit2.utils.datetime_json_parser. Default: True
+
+    Returns
+    -------
+    Contents of the file
+    """
+
+    with open(filename, 'rb') as f:
+        contents = f.read()
+    try:
+        data = orjson.loads(contents) if orjson is not None else json.loads(contents)
+    except ValueError:
+        # orjson rejects NaN, which the json module writes for missing float values
+        data = json.loads(contents)
+
+    if parse_dates:
+        for rows in (data.values() if isinstance(data, dict) else [data]):
+            for row in rows if isinstance(rows, list) else []:
+                if isinstance(row, dict):
+                    _parse_dates(row)
+    return data
+
+
+def dumps_row(row):
+    """
+    Serialize a row (flat dictionary) as compact canonical JSON on a single line, with its keys sorted by name
+
+    Parameters
+    ----------
+    row : dict
+        Row to serialize
+
+    Returns
+    -------
+    JSON string, without a newline
+    """
+
+    return '{' + ','.join(encode_basestring_ascii(key) + ':' + _scalar(row[key]) for key in sorted(row)) + '}'
+
+
+def read_ndjson(filename, parse_dates=True):
+    """
+    Read a newline-delimited JSON file of rows, one row at a time, with orjson when it is installed
+
+    Parameters
+    ----------
+    filename : str
+        Name of the file
+    parse_dates : bool
+        Convert ISO date strings to datetimes, as astrodbkit2.utils.datetime_json_parser. Default: True
+
+    Yields
+    ------
+    Tuples of (line number, row dictionary), skipping blank lines
+    """
+
+    loads = orjson.loads if orjson is not None else json.loads
+    with open(filename, 'rb') as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                row = loads(line)
+            except ValueError:
+                row = json.loads(line)
+            yield number, _parse_dates(row) if parse_dates else row
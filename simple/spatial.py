@@ -0,0 +1,424 @@
+# Positional (cone search) queries against the Sources table
+
+import numpy as np
+from scipy.spatial import cKDTree
+import astropy.units as u
+from astropy.coordinates import Angle
+from astropy.table import Table, vstack
+from sqlalchemy import and_, func, or_, select
+from simple import adopted
+from simple.database import _format
+
+# Number of cones combined into a single query by cone_search_many
+CHUNK_SIZE = 100
+
+# Proper motions (ProperMotions table) are in milliarcseconds per year, positions in degrees
+MAS_PER_DEGREE = 3.6e6
+PROPER_MOTION_COLUMNS = ['mu_ra', 'mu_ra_error', 'mu_dec', 'mu_dec_error']
+
+# Rules choosing the proper motion of a source when it has several, see simple.adopted.adoption_order
+PROPER_MOTION_RULES = ['smallest_error', 'most_recent']
+
+
+def _to_degrees(value):
+    # Convert an angle given as float (degrees), astropy Quantity/Angle, or string (eg, '2s') to degrees
+    if isinstance(value, (str, u.Quantity)):
+        return Angle(value).deg
+    return np.asarray(value, dtype=float)
+
+
+def angular_separation(ra1, dec1, ra2, dec2):
+    """
+    Angular separation between positions, using the Vincenty formula. All values in degrees.
+
+    Parameters
+    ----------
+    ra1, dec1 : float or numpy.ndarray
+        First position(s)
+    ra2, dec2 : float or numpy.ndarray
+        Second position(s), broadcast against the first
+
+    Returns
+    -------
+    Separation in degrees
+    """
+
+    ra1, dec1, ra2, dec2 = [np.radians(x) for x in (ra1, dec1, ra2, dec2)]
+    dra = ra2 - ra1
+    sin_dra, cos_dra = np.sin(dra), np.cos(dra)
+    sin_d1, cos_d1 = np.sin(dec1), np.cos(dec1)
+    sin_d2, cos_d2 = np.sin(dec2), np.cos(dec2)
+
+    num1 = cos_d2 * sin_dra
+    num2 = cos_d1 * sin_d2 - sin_d1 * cos_d2 * cos_dra
+    denominator = sin_d1 * sin_d2 + cos_d1 * cos_d2 * cos_dra
+
+    return np.degrees(np.arctan2(np.hypot(num1, num2), denominator))
+
+
+def propagate_positions(ra, dec, epoch, mu_ra, mu_dec, target_epoch, mu_ra_error=None, mu_dec_error=None):
+    """
+    Propagate positions to another epoch with their proper motions, for arrays of positions.
+    Sources move along great circles at constant angular speed (parallax and radial velocity are ignored),
+    which is valid at any position, including near the poles.
+    Positions without an epoch or proper motion are returned unchanged, with NaN uncertainties.
+
+    Parameters
+    ----------
+    ra, dec : array
+        Positions, in degrees
+    epoch : array
+        Epochs of the positions, in decimal years
+    mu_ra, mu_dec : array
+        Proper motions, in mas/yr (mu_ra includes the cos(dec) factor)
+    target_epoch : float or array
+        Epoch to propagate to, in decimal years
+    mu_ra_error, mu_dec_error : array
+        Uncertainties of the proper motions, in mas/yr. Default: None (NaN position uncertainties)
+
+    Returns
+    -------
+    ra, dec : numpy.ndarray
+        Propagated positions, in degrees
+    ra_error, dec_error : numpy.ndarray
+        Uncertainties of the propagated positions due to the proper motion uncertainties, in mas
+        (ra_error includes the cos(dec) factor)
+    """
+
+    ra, dec, epoch, mu_ra, mu_dec, target_epoch = np.broadcast_arrays(
+        *[np.asarray(x, dtype=float) for x in (ra, dec, epoch, mu_ra, mu_dec, target_epoch)])
+    moved = np.isfinite(epoch) & np.isfinite(mu_ra) & np.isfinite(mu_dec) & np.isfinite(target_epoch)
+    dt = np.where(moved, target_epoch - epoch, 0.)
+    mu_ra, mu_dec = np.where(moved, mu_ra, 0.), np.where(moved, mu_dec, 0.)
+
+    # Rotate the position vector towards the direction of motion, in the plane tangent to the sky
+    alpha, delta = np.radians(ra), np.radians(dec)
+    position = np.stack([np.cos(delta) * np.cos(alpha), np.cos(delta) * np.sin(alpha), np.sin(delta)])
+    east = np.stack([-np.sin(alpha), np.cos(alpha), np.zeros_like(alpha)])
+    north = np.stack([-np.sin(delta) * np.cos(alpha), -np.sin(delta) * np.sin(alpha), np.cos(delta)])
+    mu = np.hypot(mu_ra, mu_dec)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        direction = np.where(mu > 0, (east * mu_ra + north * mu_dec) / mu, 0.)
+    angle = np.radians(mu * dt / MAS_PER_DEGREE)
+    position = position * np.cos(angle) + direction * np.sin(angle)
+
+    new_ra = np.where(moved, np.degrees(np.arctan2(position[1], position[0])) % 360, ra)
+    new_dec = np.where(moved, np.degrees(np.arcsin(np.clip(position[2], -1, 1))), dec)
+
+    errors = []
+    for error in (mu_ra_error, mu_dec_error):
+        error = np.full(ra.shape, np.nan) if error is None else np.asarray(error, dtype=float)
+        errors.append(np.where(moved, np.abs(dt) * error, np.nan))
+    return new_ra, new_dec, errors[0], errors[1]
+
+
+def _motion_query(db, columns, where=None):
+    # Query of columns of Sources, followed by the epoch and best proper motion of each source
+    # (see PROPER_MOTION_RULES), for the sources matching an optional filter on Sources
+    table = db.metadata.tables['Sources']
+    sources = None if where is None else select(table.c.source).where(where)
+    best = adopted.best_measurement(db.metadata.tables['ProperMotions'], PROPER_MOTION_COLUMNS,
+                                    PROPER_MOTION_RULES, 'mu_ra_error', sources=sources)
+    query = select(*columns, table.c.epoch.label('position_epoch'), *[best.c[c] for c in PROPER_MOTION_COLUMNS]). \
+        select_from(table.outerjoin(best, best.c.source == table.c.source))
+    return query if where is None else query.where(where)
+
+
+def _read_propagated(db, epoch, columns, ra_index, dec_index, where=None):
+    # Rows of _motion_query (without the motion columns), their positions propagated to epoch
+    # (see propagate_positions), and the epochs of these positions (NaN when unknown)
+    with db.engine.connect() as conn:
+        rows = conn.execute(_motion_query(db, columns, where)).fetchall()
+    n = len(columns)
+    values = np.array([row[n:] for row in rows], dtype=float).reshape(-1, 5)
+    ra = np.array([row[ra_index] for row in rows], dtype=float)
+    dec = np.array([row[dec_index] for row in rows], dtype=float)
+    positions = propagate_positions(ra, dec, values[:, 0], values[:, 1], values[:, 3], epoch,
+                                    values[:, 2], values[:, 4])
+    moved = np.isfinite(values[:, [0, 1, 3]]).all(axis=1)
+    return [tuple(row[:n]) for row in rows], positions, np.where(moved, epoch, values[:, 0])
+
+
+def _motion_margin(db, epoch):
+    # Largest distance (degrees) that any source can move between its epoch and the given epoch
+    proper_motions = db.metadata.tables['ProperMotions']
+    sources = db.metadata.tables['Sources']
+    with db.engine.connect() as conn:
+        mu2 = conn.execute(select(func.max(proper_motions.c.mu_ra * proper_motions.c.mu_ra +
+                                           proper_motions.c.mu_dec * proper_motions.c.mu_dec))).scalar()
+        first, last = conn.execute(select(func.min(sources.c.epoch), func.max(sources.c.epoch))).one()
+    if mu2 is None or first is None:
+        return 0.
+    return np.sqrt(mu2) * max(abs(epoch - first), abs(epoch - last)) / MAS_PER_DEGREE
+
+
+def propagated_positions(db, epoch, sources=None, fmt='astropy'):
+    """
+    Positions of the sources at an epoch: Sources is joined with the best proper motion of each source
+    (see PROPER_MOTION_RULES) in a single query, and all positions are propagated at once
+    with propagate_positions. Sources without an epoch or proper motion keep their position.
+
+    Parameters
+    ----------
+    db : astrodbkit2.astrodb.Database
+        Database to query
+    epoch : float
+        Epoch to propagate to, in decimal years
+    sources : list of str
+        Only include these sources. Default: None (all sources)
+    fmt : str
+        Format to return results in (astropy/table, pandas)
+
+    Returns
+    -------
+    Table with the source, ra, dec (degrees), ra_error, dec_error (mas, from the proper motion uncertainties),
+    and epoch (the target epoch, or the epoch of the position when it could not be propagated) columns,
+    sorted by source
+    """
+
+    table = db.metadata.tables['Sources']
+    where = None
+    if sources is not None and len(set(sources)) <= adopted.CHUNK_SIZE:
+        where = table.c.source.in_(sorted(set(sources)))
+    rows, (ra, dec, ra_error, dec_error), epochs = _read_propagated(db, epoch, [table.c.source, table.c.ra,
+                                                                                table.c.dec], 1, 2, where)
+
+    t = Table()
+    t['source'] = np.array([row[0] for row in rows], dtype=str)
+    t['ra'], t['dec'], t['ra_error'], t['dec_error'] = ra, dec, ra_error, dec_error
+    t['epoch'] = epochs
+    if sources is not None and where is None:
+        t = t[np.isin(t['source'], np.asarray(list(sources), dtype=str))]
+    t.sort('source')
+    return t.to_pandas() if fmt.lower() == 'pandas' else t
+
+
+def _cone_filter(table, ra, dec, radius):
+    # Bounding box filter on (dec, ra) for a cone, so the ix_Sources_dec_ra index can be used.
+    # The RA range is widened with declination and split in two when it wraps around 0/360.
+    dec_min, dec_max = dec - radius, dec + radius
+    dec_filter = table.c.dec.between(max(dec_min, -90.), min(dec_max, 90.))
+
+    cos_dec = np.cos(np.radians(dec))
+    if dec_min <= -90 or dec_max >= 90 or np.sin(np.radians(radius)) >= cos_dec:
+        # Cone contains a pole, all RA are possible
+        return dec_filter
+
+    # Maximum RA offset of a cone, plus some margin for rounding
+    delta = np.degrees(np.arcsin(np.sin(np.radians(radius)) / cos_dec)) * (1 + 1e-9) + 1e-9
+    ra_min, ra_max = (ra - delta) % 360, (ra + delta) % 360
+    if ra_min <= ra_max:
+        ra_filter = table.c.ra.between(ra_min, ra_max)
+    else:
+        ra_filter = or_(table.c.ra >= ra_min, table.c.ra <= ra_max)
+
+    return and_(dec_filter, ra_filter)
+
+
+def cone_search(db, ra, dec, radius, fmt='astropy', epoch=None):
+    """
+    Find the sources within a radius of a position.
+    Uses the (dec, ra) index on Sources to only examine sources near the position.
+
+    Parameters
+    ----------
+    db : astrodbkit2.astrodb.Database
+        Database to search
+    ra, dec : float
+        Position to search around, in degrees
+    radius : float, str, or astropy.units.Quantity
+        Search radius, in degrees if a float. Strings are parsed by astropy.coordinates.Angle (eg, '2s')
+    fmt : str
+        Format to return results in (astropy/table, pandas, default).
+        The default format (list of tuples) skips building a table, for the fastest lookups.
+    epoch : float
+        Epoch of the position, in decimal years. When given, the sources are matched at their positions
+        propagated to this epoch with their proper motions, see propagated_positions.
+        Default: None (positions as stored in Sources)
+
+    Returns
+    -------
+    Table of the matched Sources rows with a separation column (degrees), sorted by separation
+    """
+
+    radius = float(_to_degrees(radius))
+    table = db.metadata.tables['Sources']
+    names = table.columns.keys()
+
+    if epoch is None:
+        rows = db.query(table).filter(_cone_filter(table, ra, dec, radius)).all()
+        source_ra = np.array([row.ra for row in rows], dtype=float)
+        source_dec = np.array([row.dec for row in rows], dtype=float)
+    else:
+        # Widen the cone by the largest motion, then match the propagated positions
+        where = _cone_filter(table, ra, dec, radius + _motion_margin(db, epoch))
+        rows, (source_ra, source_dec, _, _), _ = _read_propagated(db, epoch, list(table.columns),
+                                                                  names.index('ra'), names.index('dec'), where)
+    separation = angular_separation(ra, dec, source_ra, source_dec)
+    order = [i for i in np.argsort(separation, kind='stable') if separation[i] <= radius]
+    rows = [tuple(rows[i]) + (float(separation[i]),) for i in order]
+
+    return _format(rows, names + ['separation'], fmt, dtype=[object] * len(names) + [float])
+
+
+def cone_search_many(db, ra, dec, radius, fmt='astropy', epoch=None):
+    """
+    Find the sources within a radius of many positions.
+    Cones are combined into a few indexed queries and the separations are computed with numpy.
+
+    Parameters
+    ----------
+    db : astrodbkit2.astrodb.Database
+        Database to search
+    ra, dec : array-like
+        Positions to search around, in degrees
+    radius : float, str, astropy.units.Quantity, or array-like
+        Search radius, either one for all positions or one per position. Degrees if float.
+    fmt : str
+        Format to return results in (astropy/table, pandas)
+    epoch : float
+        Epoch of the positions, in decimal years. When given, the sources are matched at their positions
+        propagated to this epoch with their proper motions, see propagated_positions.
+        Default: None (positions as stored in Sources)
+
+    Returns
+    -------
+    Table of the matched Sources rows with an index column (position of the input coordinate)
+    and a separation column (degrees), sorted by index and separation
+    """
+
+    ra = np.atleast_1d(np.asarray(ra, dtype=float))
+    dec = np.atleast_1d(np.asarray(dec, dtype=float))
+    radius = np.broadcast_to(_to_degrees(radius), ra.shape)
+    table = db.metadata.tables['Sources']
+    names = table.columns.keys()
+    margin = 0. if epoch is None else _motion_margin(db, epoch)
+
+    results = []
+    for start in range(0, len(ra), CHUNK_SIZE):
+        chunk = slice(start, start + CHUNK_SIZE)
+        filters = or_(*[_cone_filter(table, r, d, rad + margin)
+                        for r, d, rad in zip(ra[chunk], dec[chunk], radius[chunk])])
+        if epoch is None:
+            rows = db.query(table).filter(filters).all()
+        else:
+            rows, (source_ra, source_dec, _, _), _ = _read_propagated(db, epoch, list(table.columns),
+                                                                      names.index('ra'), names.index('dec'), filters)
+        if not rows:
+            continue
+
+        # Separation of every candidate to every cone of the chunk
+        candidates = Table(rows=rows, names=names)
+        if epoch is None:
+            source_ra, source_dec = np.array(candidates['ra'], dtype=float), np.array(candidates['dec'], dtype=float)
+        separation = angular_separation(ra[chunk, np.newaxis], dec[chunk, np.newaxis],
+                                        source_ra[np.newaxis, :], source_dec[np.newaxis, :])
+        index, match = np.nonzero(separation <= radius[chunk, np.newaxis])
+        t = candidates[match]
+        t['index'] = index + start
+        t['separation'] = separation[index, match]
+        results.append(t)
+
+    if results:
+        t = vstack(results)
+        t.sort(['index', 'separation'])
+        t = t[['index'] + names + ['separation']]
+    else:
+        t = Table(names=['index'] + names + ['separation'],
+                  dtype=[int] + [object] * len(names) + [float])
+
+    return t.to_pandas() if fmt.lower() == 'pandas' else t
+
+
+def _unit_vectors(ra, dec):
+    # Cartesian unit vectors for positions in degrees
+    ra, dec = np.radians(ra), np.radians(dec)
+    return np.column_stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)])
+
+
+def crossmatch(db, catalog, radius, ra_col='ra', dec_col='dec', name_col=None, epoch=None):
+    """
+    Match an input catalog against the Sources table in one pass.
+    All source positions are read with a single query and matched with a KD-tree,
+    and, if a name column is given, names are matched (case-insensitive) against the Names table.
+    Each input row is then classified by its number of distinct candidate sources:
+    matched (one), unmatched (none), or ambiguous (more than one).
+
+    Parameters
+    ----------
+    db : astrodbkit2.astrodb.Database
+        Database to match against
+    catalog : astropy.table.Table
+        Input catalog
+    radius : float, str, or astropy.units.Quantity
+        Match radius, in degrees if a float. Strings are parsed by astropy.coordinates.Angle (eg, '2s')
+    ra_col, dec_col : str
+        Names of the RA and Dec columns of the catalog, in degrees. Default: ra, dec
+    name_col : str
+        Name of the column with source names. Default: None (positional match only)
+    epoch : float
+        Epoch of the catalog positions, in decimal years. When given, the sources are matched at their positions
+        propagated to this epoch with their proper motions, see propagated_positions.
+        Default: None (positions as stored in Sources)
+
+    Returns
+    -------
+    results : dict
+        matched : indices of catalog rows with a single candidate source
+        source : the matched source for each of those rows
+        separation : separation (degrees) between the catalog position and the matched source, also for rows
+            matched by name only (so it can exceed radius), NaN when the row or the source has no position
+        unmatched : indices of catalog rows without candidates
+        ambiguous : indices of catalog rows with several candidates
+        candidates : the list of candidate sources for each of the ambiguous rows, sorted by name
+        candidate_separations : the separations (degrees) of these candidates, as for separation
+    """
+
+    radius = float(_to_degrees(radius))
+    n_rows = len(catalog)
+    candidates = [set() for _ in range(n_rows)]
+
+    # Positional match
+    columns = [db.Sources.c.source, db.Sources.c.ra, db.Sources.c.dec]
+    if epoch is None:
+        rows = db.query(*columns).all()
+        source_ra = np.array([row[1] for row in rows], dtype=float)
+        source_dec = np.array([row[2] for row in rows], dtype=float)
+    else:
+        rows, (source_ra, source_dec, _, _), _ = _read_propagated(db, epoch, columns, 1, 2)
+    source_names = np.array([row[0] for row in rows], dtype=object)
+    in_tree = np.nonzero(np.isfinite(source_ra) & np.isfinite(source_dec))[0]
+
+    ra = np.ma.filled(np.ma.asarray(catalog[ra_col], dtype=float), np.nan)
+    dec = np.ma.filled(np.ma.asarray(catalog[dec_col], dtype=float), np.nan)
+    positions = np.nonzero(np.isfinite(ra) & np.isfinite(dec))[0]
+    if len(in_tree) > 0 and len(positions) > 0:
+        tree = cKDTree(_unit_vectors(source_ra[in_tree], source_dec[in_tree]))
+        chord = 2 * np.sin(np.radians(radius) / 2)
+        for i, matches in zip(positions, tree.query_ball_point(_unit_vectors(ra[positions], dec[positions]), chord)):
+            candidates[i].update(in_tree[matches])
+
+    # Name match
+    if name_col is not None:
+        index = {s: i for i, s in enumerate(source_names)}
+        names = {}
+        for source, other_name in db.query(db.Names.c.source, db.Names.c.other_name).all():
+            names.setdefault(other_name.lower(), set()).add(index[source])
+        for i, name in enumerate(catalog[name_col]):
+            candidates[i].update(names.get(str(name).lower(), ()))
+
+    n_candidates = np.array([len(c) for c in candidates], dtype=int)
+    matched = np.nonzero(n_candidates == 1)[0]
+    ambiguous = np.nonzero(n_candidates > 1)[0]
+    match_index = np.array([next(iter(candidates[i])) for i in matched], dtype=int)
+    candidate_index = [np.array(sorted(candidates[i], key=lambda j: source_names[j]), dtype=int) for i in ambiguous]
+
+    return {'matched': matched,
+            'source': source_names[match_index].astype(str) if len(matched) else np.array([], dtype=str),
+            'separation': angular_separation(ra[matched], dec[matched],
+                                             source_ra[match_index], source_dec[match_index]),
+            'unmatched': np.nonzero(n_candidates == 0)[0],
+            'ambiguous': ambiguous,
+            'candidates': [list(source_names[index].astype(str)) for index in candidate_index],
+            'candidate_separations': [angular_separation(ra[i], dec[i], source_ra[index], source_dec[index])
+                                      for i, index in zip(ambiguous, candidate_index)]}
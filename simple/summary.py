@@ -0,0 +1,267 @@
+# Denormalized summary of each source (coordinates, best measurements, photometry), and its materialized table
+
+from functools import lru_cache
+from sqlalchemy import Column, Enum, Index, MetaData, String, Table, column, func, inspect, select, text
+from sqlalchemy import table as sql_table
+from astrodbkit2.astrodb import Base
+import simple.schema  # noqa: F401, populates Base with the SIMPLE tables
+from simple.adopted import ADOPTION_RULES, CHUNK_SIZE, adoption_order, best_measurement
+from simple.changes import create_source_log, drop_source_log
+from simple.database import DERIVED_TABLE_PREFIX
+from simple.database import _format
+from simple.spatial import PROPER_MOTION_RULES
+
+# Columns of Sources included in the summary
+SOURCE_COLUMNS = ['source', 'ra', 'dec', 'epoch', 'shortname']
+
+# Best measurement of each source included in the summary, as summary column: table column.
+# The adopted measurement is used when there is one, otherwise the measurements are ranked with the rules of
+# ADOPTION_RULES (or the rules given here, see simple.adopted.adoption_order).
+SUMMARY_MEASUREMENTS = {
+    'Parallaxes': {'columns': {'parallax': 'parallax', 'parallax_error': 'parallax_error',
+                               'parallax_reference': 'reference'}},
+    'ProperMotions': {'columns': {'mu_ra': 'mu_ra', 'mu_ra_error': 'mu_ra_error', 'mu_dec': 'mu_dec',
+                                  'mu_dec_error': 'mu_dec_error', 'pm_reference': 'reference'},
+                      'rules': PROPER_MOTION_RULES, 'error_column': 'mu_ra_error'},
+    'RadialVelocities': {'columns': {'radial_velocity': 'radial_velocity',
+                                     'radial_velocity_error': 'radial_velocity_error', 'rv_reference': 'reference'},
+                         'rules': ['smallest_error', 'most_recent'], 'error_column': 'radial_velocity_error'},
+    'SpectralTypes': {'columns': {'spectral_type_string': 'spectral_type_string',
+                                  'spectral_type_code': 'spectral_type_code',
+                                  'spectral_type_error': 'spectral_type_error',
+                                  'spectral_type_regime': 'regime', 'spectral_type_reference': 'reference'}},
+    'Gravities': {'columns': {'gravity': 'gravity', 'gravity_regime': 'regime', 'gravity_reference': 'reference'},
+                  'rules': ['preferred_regime', 'most_recent'],
+                  'regimes': ADOPTION_RULES['SpectralTypes']['regimes']},
+}
+
+# Bands of Photometry pivoted into summary columns (band, and band_error for the uncertainty).
+# When a band has several measurements, the one with the smallest error (then the most recent) is used.
+SUMMARY_BANDS = ['2MASS_J', '2MASS_H', '2MASS_Ks', 'WISE_W1', 'WISE_W2', 'WISE_W3', 'WISE_W4']
+
+# Number of rows of each source in these tables, as summary column: table
+SUMMARY_COUNTS = {'n_names': 'Names', 'n_photometry': 'Photometry'}
+
+# Materialized summary, and the log of the sources changed since its last refresh (filled by triggers)
+SUMMARY_TABLE = DERIVED_TABLE_PREFIX + 'SourceSummary'
+SUMMARY_LOG_TABLE = DERIVED_TABLE_PREFIX + 'SourceSummaryChanges'
+SUMMARY_INDEXES = [['dec', 'ra'], ['spectral_type_code'], ['parallax']]
+
+
+def summary_query(metadata, sources=None):
+    """
+    Query of the summary of each source: the SOURCE_COLUMNS of Sources, the best measurements of
+    SUMMARY_MEASUREMENTS, the photometry of SUMMARY_BANDS, and the counts of SUMMARY_COUNTS, sorted by source
+
+    Parameters
+    ----------
+    metadata : sqlalchemy.MetaData
+        Metadata with the tables to query, eg db.metadata
+    sources : list of str or sqlalchemy Select
+        Only include these sources, eg a query of source names. Default: None (all sources)
+
+    Returns
+    -------
+    sqlalchemy Select
+    """
+
+    sources_table = metadata.tables['Sources']
+    columns = [sources_table.c[c] for c in SOURCE_COLUMNS]
+    joined = sources_table
+
+    for name, config in SUMMARY_MEASUREMENTS.items():
+        best = best_measurement(metadata.tables[name], list(config['columns'].values()), config.get('rules'),
+                                config.get('error_column'), config.get('regimes'), sources)
+        joined = joined.outerjoin(best, best.c.source == sources_table.c.source)
+        columns += [best.c[column_name].label(label) for label, column_name in config['columns'].items()]
+
+    photometry = metadata.tables['Photometry']
+    order = adoption_order(photometry, ['smallest_error', 'most_recent'], 'magnitude_error')
+    for band in SUMMARY_BANDS:
+        for label, value in ((band, photometry.c.magnitude), (band + '_error', photometry.c.magnitude_error)):
+            columns.append(select(value).where(photometry.c.source == sources_table.c.source,
+                                                photometry.c.band == band).
+                           order_by(*order).limit(1).scalar_subquery().label(label))
+
+    for label, name in SUMMARY_COUNTS.items():
+        table = metadata.tables[name]
+        columns.append(select(func.count()).where(table.c.source == sources_table.c.source).
+                       scalar_subquery().label(label))
+
+    query = select(*columns).select_from(joined)
+    if sources is not None:
+        query = query.where(sources_table.c.source.in_(sources))
+    return query.order_by(sources_table.c.source)
+
+
+def source_summary(db, sources=None, fmt='astropy'):
+    """
+    Summary of each source, with one row per source: coordinates, best parallax, proper motion,
+    radial velocity, spectral type, and gravity, 2MASS and WISE photometry, and the numbers of names and
+    photometry measurements, computed with a single query (see read_summary for the materialized summary)
+
+    Parameters
+    ----------
+    db : astrodbkit2.astrodb.Database
+        Database to query
+    sources : list of str
+        Only include these sources. Default: None (all sources)
+    fmt : str
+        Format to return results in (astropy/table, pandas, default)
+
+    Returns
+    -------
+    Table of the summary, sorted by source
+    """
+
+    query = summary_query(db.metadata, sources)
+    with db.engine.connect() as conn:
+        rows = [tuple(row) for row in conn.execute(query)]
+    names = [column.name for column in query.selected_columns]
+    return _format(rows, names, fmt)
+
+
+def _watched_tables():
+    # Tables whose changes modify the summary of a source
+    return list(dict.fromkeys(['Sources'] + list(SUMMARY_MEASUREMENTS) + ['Photometry'] + list(SUMMARY_COUNTS.values())))
+
+
+@lru_cache(maxsize=None)
+def summary_table():
+    """
+    Table of the materialized summary, with the columns of summary_query (enumerations are stored as strings),
+    source as primary key, and indexes on SUMMARY_INDEXES. It can be used to query the summary directly, eg
+    select(summary_table()).where(summary_table().c.spectral_type_code >= 70)
+
+    Returns
+    -------
+    sqlalchemy.Table
+    """
+
+    columns = []
+    for selected in summary_query(Base.metadata).selected_columns:
+        column_type = String(100) if isinstance(selected.type, Enum) else selected.type
+        columns.append(Column(selected.name, column_type, primary_key=selected.name == 'source'))
+    indexes = [Index(f"ix_{SUMMARY_TABLE}_{'_'.join(index)}", *index) for index in SUMMARY_INDEXES]
+    return Table(SUMMARY_TABLE, MetaData(), *columns, *indexes)
+
+
+def _log_table():
+    return sql_table(SUMMARY_LOG_TABLE, column('source'))
+
+
+def create_summary_table(db):
+    """
+    Create (or rebuild) the materialized summary of each source (see summary_query), and the triggers logging
+    the sources changed since its last refresh (see refresh_summary).
+    The summary is stored in derived tables, see simple.database.connect to hide them from astrodbkit2.
+    Requires SQLite.
+
+    Parameters
+    ----------
+    db : astrodbkit2.astrodb.Database
+        Database to summarize
+
+    Returns
+    -------
+    Number of sources in the summary
+    """
+
+    table = summary_table()
+    with db.engine.begin() as conn:
+        drop_summary_table(conn)
+        table.create(conn)
+        create_source_log(conn, SUMMARY_LOG_TABLE, {name: 'source' for name in _watched_tables()})
+        return conn.execute(table.insert().from_select([c.name for c in table.columns],
+                                                       summary_query(db.metadata))).rowcount
+
+
+def drop_summary_table(conn):
+    """
+    Drop the materialized summary, its change log, and triggers
+
+    Parameters
+    ----------
+    conn : sqlalchemy.engine.Connection or Engine
+        Connection to the database
+    """
+
+    drop_source_log(conn, SUMMARY_LOG_TABLE, _watched_tables())
+    conn.execute(text(f"DROP TABLE IF EXISTS {SUMMARY_TABLE}"))
+
+
+def has_summary_table(db):
+    """Whether the database has the materialized summary"""
+    return inspect(db.engine).has_table(SUMMARY_TABLE)
+
+
+def refresh_summary(db, full=False):
+    """
+    Bring the materialized summary up to date, only recomputing the sources changed since the last refresh.
+    Changes to Publications (used to rank measurements by date) are not logged: refresh with full=True after them.
+
+    Parameters
+    ----------
+    db : astrodbkit2.astrodb.Database
+        Database with the materialized summary
+    full : bool
+        Recompute the summary of every source. Default: False
+
+    Returns
+    -------
+    Number of sources refreshed
+    """
+
+    table = summary_table()
+    log = _log_table()
+    names = [c.name for c in table.columns]
+    with db.engine.begin() as conn:
+        if full:
+            conn.execute(table.delete())
+            count = conn.execute(table.insert().from_select(names, summary_query(db.metadata))).rowcount
+        else:
+            count = conn.execute(select(func.count()).select_from(log)).scalar()
+            if count:
+                changed = select(log.c.source)
+                conn.execute(table.delete().where(table.c.source.in_(changed)))
+                conn.execute(table.insert().from_select(names, summary_query(db.metadata, changed)))
+        conn.execute(log.delete())
+    return count
+
+
+def read_summary(db, sources=None, refresh=True, fmt='astropy'):
+    """
+    Read the materialized summary of each source, see source_summary for its contents.
+    The summary is first refreshed for the sources changed since the last refresh.
+
+    Parameters
+    ----------
+    db : astrodbkit2.astrodb.Database
+        Database with the materialized summary (see create_summary_table)
+    sources : list of str
+        Only read these sources. Default: None (all sources)
+    refresh : bool
+        Refresh the summary first (see refresh_summary). Default: True
+    fmt : str
+        Format to return results in (astropy/table, pandas, default)
+
+    Returns
+    -------
+    Table of the summary, sorted by source
+    """
+
+    if not has_summary_table(db):
+        raise RuntimeError('The database has no materialized summary, see simple.summary.create_summary_table')
+    if refresh:
+        refresh_summary(db)
+
+    table = summary_table()
+    with db.engine.connect() as conn:
+        if sources is None:
+            rows = [tuple(row) for row in conn.execute(select(table).order_by(table.c.source))]
+        else:
+            sources = sorted(set(sources))
+            rows = [tuple(row) for start in range(0, len(sources), CHUNK_SIZE)
+                    for row in conn.execute(select(table).where(table.c.source.in_(sources[start:start + CHUNK_SIZE])).
+                                            order_by(table.c.source))]
+    return _format(rows, [c.name for c in table.columns], fmt)
@@ -0,0 +1,318 @@
+# Validation of the contents of a SIMPLE database: rules declared once, checked with one query per table
+
+import os
+import json
+import subprocess
+from sqlalchemy import case, exists, func, inspect, or_, select
+from astrodbkit2 import REFERENCE_TABLES
+from simple.build import read_source_file
+from simple.database import _format
+
+# Tables whose reference column must point to an existing publication
+REFERENCING_TABLES = ['Sources', 'Photometry', 'Parallaxes', 'ProperMotions', 'RadialVelocities', 'SpectralTypes',
+                      'Gravities']
+
+# Above this number of changed sources, validate is as fast checking all the rows (and avoids long IN lists)
+MAX_SCOPED_SOURCES = 500
+
+
+def _unknown_reference(c, tables):
+    publications = tables['Publications']
+    return ~exists().where(publications.c.name == c.reference)
+
+
+def _unused_publication(c, tables):
+    return ~or_(*[exists().where(tables[name].c.reference == c.name) for name in REFERENCING_TABLES])
+
+
+def _adopted_count(c):
+    # Number of adopted measurements of the source, NULL (so not checked) if no measurement has an adopted flag
+    return func.sum(c.adopted).over(partition_by=c.source)
+
+
+# Validation rules, as name: rule. Each rule applies to the rows of a table and has:
+#   level: error (invalid data) or warning (incomplete data)
+#   description: what a violation means
+#   condition: function of (columns, tables) giving the SQL condition true for the rows violating the rule,
+#       where columns are the columns of the table (plus those of windows) and tables are the database tables
+#   windows (optional): dictionary of column name: function of the table columns giving a window function,
+#       for rules on groups of rows (eg, the measurements of a source)
+#   inputs (optional): reference tables read by the condition, so all the rows are checked again when they change
+#   constraints (optional): names of the CHECK constraints of simple.schema rejecting the violating rows at insert
+#       time, so the rule is only checked for databases without them (eg, built with an older schema)
+# All the rules of a table are checked with a single query, see validate.
+# Rules on the data tables only involve the rows of one source, so they can be checked for some sources only,
+# and rules on a reference table are checked when the table changes (see validate).
+VALIDATION_RULES = {
+    'coordinates': {
+        'table': 'Sources', 'level': 'error', 'description': 'RA or Dec missing or out of range',
+        'condition': lambda c, tables: or_(c.ra.is_(None), c.ra < 0, c.ra > 360,
+                                           c.dec.is_(None), c.dec < -90, c.dec > 90)},
+    'missing_names': {
+        'table': 'Sources', 'level': 'error', 'description': 'Source without entries in Names',
+        'condition': lambda c, tables: ~exists().where(tables['Names'].c.source == c.source)},
+    'missing_source_name': {
+        'table': 'Sources', 'level': 'error', 'description': 'Source without a Names entry for its own name',
+        'condition': lambda c, tables: ~exists().where(tables['Names'].c.source == c.source,
+                                                       tables['Names'].c.other_name == c.source)},
+    'missing_doi': {
+        'table': 'Publications', 'level': 'warning', 'description': 'Publication without DOI',
+        'condition': lambda c, tables: c.doi.is_(None)},
+    'missing_bibcode': {
+        'table': 'Publications', 'level': 'warning', 'description': 'Publication without bibcode',
+        'condition': lambda c, tables: c.bibcode.is_(None)},
+    'unused_publication': {
+        'table': 'Publications', 'level': 'warning', 'description': 'Publication not referenced by any data',
+        'condition': _unused_publication},
+    'magnitude_range': {
+        'table': 'Photometry', 'level': 'error', 'description': 'Magnitude negative or 99 and above',
+        'constraints': ['ck_Photometry_magnitude'],
+        'condition': lambda c, tables: or_(c.magnitude < 0, c.magnitude >= 99)},
+    'adopted_parallax': {
+        'table': 'Parallaxes', 'level': 'error', 'description': 'Source without exactly one adopted parallax',
+        'windows': {'n_adopted': _adopted_count},
+        'condition': lambda c, tables: c.n_adopted != 1},
+    'missing_proper_motion': {
+        'table': 'ProperMotions', 'level': 'error', 'description': 'Proper motion without mu_ra or mu_dec',
+        'constraints': ['ck_ProperMotions_mu_ra', 'ck_ProperMotions_mu_dec'],
+        'condition': lambda c, tables: or_(c.mu_ra.is_(None), c.mu_dec.is_(None))},
+    'missing_radial_velocity': {
+        'table': 'RadialVelocities', 'level': 'error', 'description': 'Radial velocity without value',
+        'constraints': ['ck_RadialVelocities_radial_velocity'],
+        'condition': lambda c, tables: c.radial_velocity.is_(None)},
+    'missing_spectral_type': {
+        'table': 'SpectralTypes', 'level': 'error',
+        'description': 'Spectral type without spectral_type_string or spectral_type_code',
+        'condition': lambda c, tables: or_(c.spectral_type_string.is_(None), c.spectral_type_code.is_(None))},
+    'adopted_spectral_type': {
+        'table': 'SpectralTypes', 'level': 'error', 'description': 'Source without exactly one adopted spectral type',
+        'windows': {'n_adopted': _adopted_count},
+        'condition': lambda c, tables: c.n_adopted != 1},
+    'missing_gravity': {
+        'table': 'Gravities', 'level': 'error', 'description': 'Gravity without value',
+        'condition': lambda c, tables: c.gravity.is_(None)},
+}
+VALIDATION_RULES.update({
+    f'unknown_reference_{name}': {
+        'table': name, 'level': 'error', 'description': 'Reference not in Publications',
+        'inputs': ['Publications'], 'condition': _unknown_reference} for name in REFERENCING_TABLES})
+
+
+def validation_query(tables, table_name, rules, sources=None):
+    """
+    Query checking all the rules of a table with a single scan: it returns the primary key of each row
+    violating at least one rule, followed by one flag (0 or 1) per rule
+
+    Parameters
+    ----------
+    tables : dict
+        Tables of the database, eg db.metadata.tables
+    table_name : str
+        Name of the table to check
+    rules : list of dict
+        Rules of the table, see VALIDATION_RULES
+    sources : list of str
+        Only check the rows of these sources, found with the index on the source column.
+        Default: None (all the rows)
+
+    Returns
+    -------
+    sqlalchemy Select
+    """
+
+    table = tables[table_name]
+    windows = {}
+    for rule in rules:
+        windows.update({name: window(table.c) for name, window in rule.get('windows', {}).items()})
+    if windows or sources is not None:
+        # Windows are partitioned by source, so selecting the sources first does not change them
+        query = select(table, *[window.label(name) for name, window in windows.items()])
+        if sources is not None:
+            query = query.where(table.c.source.in_(sources))
+        table = query.subquery()
+
+    conditions = [rule['condition'](table.c, tables) for rule in rules]
+    key = [table.c[column.name] for column in tables[table_name].primary_key]
+    flags = [case((condition, 1), else_=0) for condition in conditions]
+    return select(*key, *flags).where(or_(*conditions)).order_by(*key)
+
+
+def _rule_scope(rule, changes, reference_tables):
+    # Rows to check for a rule after some changes: 'all', 'sources' (the rows of the changed sources), or None
+    if {rule['table'], *rule.get('inputs', [])} & set(changes.get('tables', [])):
+        return 'all'
+    if rule['table'] in reference_tables or not changes.get('sources'):
+        return None
+    return 'sources' if len(changes['sources']) <= MAX_SCOPED_SOURCES else 'all'
+
+
+def check_constraints(db):
+    """
+    Names of the CHECK constraints of a database
+
+    Parameters
+    ----------
+    db : astrodbkit2.astrodb.Database
+        Database to inspect
+
+    Returns
+    -------
+    Set of constraint names
+    """
+
+    inspector = inspect(db.engine)
+    return {constraint['name'] for table in inspector.get_table_names()
+            for constraint in inspector.get_check_constraints(table)}
+
+
+def validate(db, tables=None, rules=None, changes=None, enforced=False, reference_tables=REFERENCE_TABLES,
+             fmt='astropy'):
+    """
+    Check the rules of VALIDATION_RULES against a database, with one query per table
+
+    Parameters
+    ----------
+    db : astrodbkit2.astrodb.Database
+        Database to validate
+    tables : list of str
+        Only check the rules of these tables. Default: None (all tables with rules)
+    rules : list of str
+        Only check these rules. Default: None (all rules)
+    changes : dict
+        Only check what these changes can break, with keys sources (list of changed sources) and
+        tables (list of changed reference tables, eg Publications), as returned by changes_from_files
+        and changes_from_git. Rules on the data tables are checked for the changed sources only,
+        and rules on the reference tables (eg, unused publications) only if the table changed.
+        All the rows are checked again if a reference table they point to changed (eg, unknown references).
+        Default: None (check everything)
+    enforced : bool
+        Also check the rules enforced by the CHECK constraints of the database (see simple.schema), eg for rows
+        inserted with SQLite's ignore_check_constraints pragma. Default: False
+    reference_tables : list
+        List of reference tables, whose rules are only checked when they change. Default: astrodbkit2.REFERENCE_TABLES
+    fmt : str
+        Format to return results in (astropy/table, pandas, default)
+
+    Returns
+    -------
+    Table with one row per violation: rule, level, table, key (the primary key of the row, eg source=...,
+    reference=...), and description, sorted by table, rule, and key
+    """
+
+    constraints = set() if enforced else check_constraints(db)
+    selected = {}
+    for name, rule in VALIDATION_RULES.items():
+        if 'constraints' in rule and set(rule['constraints']) <= constraints:
+            continue
+        if (rules is None or name in rules) and (tables is None or rule['table'] in tables):
+            scope = 'all' if changes is None else _rule_scope(rule, changes, reference_tables)
+            if scope is not None:
+                selected.setdefault((rule['table'], scope), {})[name] = rule
+
+    results = []
+    with db.engine.connect() as conn:
+        for (table_name, scope), table_rules in selected.items():
+            sources = sorted(changes['sources']) if scope == 'sources' else None
+            query = validation_query(db.metadata.tables, table_name, list(table_rules.values()), sources=sources)
+            key_names = [column.name for column in db.metadata.tables[table_name].primary_key]
+            for row in conn.execute(query):
+                key = ', '.join(f'{name}={value}' for name, value in zip(key_names, row))
+                for (name, rule), flag in zip(table_rules.items(), row[len(key_names):]):
+                    if flag:
+                        results.append((name, rule['level'], table_name, key, rule['description']))
+
+    results.sort(key=lambda result: (result[2], result[0], result[3]))
+    return _format(results, ['rule', 'level', 'table', 'key', 'description'], fmt, dtype=[str] * 5)
+
+
+def _reference_table(filename, reference_tables):
+    # Name of the reference table stored in a JSON file (eg, data/Publications.json), None for a source file
+    name = os.path.basename(filename)[:-len('.json')]
+    return name if name in reference_tables else None
+
+
+def changes_from_files(filenames, reference_tables=REFERENCE_TABLES):
+    """
+    Changes made by a set of modified JSON files of the data directory, for validate
+
+    Parameters
+    ----------
+    filenames : list of str
+        Names of the changed JSON files. Files that no longer exist are skipped: use changes_from_git
+        to also validate what their removal can break (eg, publications no longer used).
+    reference_tables : list
+        List of reference tables. Default: astrodbkit2.REFERENCE_TABLES
+
+    Returns
+    -------
+    Dictionary with the sorted lists of changed sources and changed reference tables (sources, tables)
+    """
+
+    sources, tables = set(), set()
+    for filename in filenames:
+        if not filename.endswith('.json') or not os.path.exists(filename):
+            continue
+        table = _reference_table(filename, reference_tables)
+        if table is not None:
+            tables.add(table)
+        else:
+            sources.add(read_source_file(filename)[0])
+    return {'sources': sorted(sources), 'tables': sorted(tables)}
+
+
+def _git(*args):
+    return subprocess.run(['git', *args], check=True, capture_output=True, text=True).stdout
+
+
+def _git_source(revision, filename):
+    # Source of a JSON file at a revision (the working tree if None), or None if the file does not exist there
+    if revision is None:
+        return read_source_file(filename)[0] if os.path.exists(filename) else None
+    try:
+        data = json.loads(_git('show', f'{revision}:{filename}'))
+    except subprocess.CalledProcessError:
+        return None
+    return data['Sources'][0]['source']
+
+
+def changes_from_git(revisions, directory='data', reference_tables=REFERENCE_TABLES):
+    """
+    Changes made to the JSON files of the data directory between git revisions, for validate.
+    Run from the root of the repository.
+
+    Parameters
+    ----------
+    revisions : str
+        Revision (eg, origin/main) to compare the working tree to, or range of revisions as in git diff:
+        A..B (changes from A to B) or A...B (changes on B since it diverged from A, as in a pull request)
+    directory : str
+        Name of the data directory. Default: data
+    reference_tables : list
+        List of reference tables. Default: astrodbkit2.REFERENCE_TABLES
+
+    Returns
+    -------
+    Dictionary with the sorted lists of changed sources and changed reference tables (sources, tables),
+    including the sources of removed files
+    """
+
+    if '...' in revisions:
+        base, head = [revision or 'HEAD' for revision in revisions.split('...')]
+        base = _git('merge-base', base, head).strip()
+    elif '..' in revisions:
+        base, head = [revision or 'HEAD' for revision in revisions.split('..')]
+    else:
+        base, head = revisions, None
+
+    filenames = _git('diff', '--name-only', '--no-renames', base, *([head] if head else []), '--', directory).split()
+    sources, tables = set(), set()
+    for filename in filenames:
+        if not filename.endswith('.json'):
+            continue
+        table = _reference_table(filename, reference_tables)
+        if table is not None:
+            tables.add(table)
+        else:
+            # Both the old and new source, if the file renames it
+            sources.update({_git_source(base, filename), _git_source(head, filename)} - {None})
+    return {'sources': sorted(sources), 'tables': sorted(tables)}
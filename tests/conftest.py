@@ -0,0 +1,118 @@
+# Shared fixtures: the database is built once per session (per worker with pytest-xdist)
+# and each test module gets its own copy, made with the SQLite backup API
+
+import sqlite3
+import pytest
+from simple.schema import *
+from astrodbkit2.astrodb import create_database, Database
+
+DB_PATH = 'data'
+
+
+def pytest_addoption(parser):
+    parser.addoption('--network', action='store_true', help='also run the tests querying online services (Simbad)')
+    parser.addoption('--changed-since', metavar='REVISIONS',
+                     help='only validate the data changed in git since a revision or range (eg, origin/main...HEAD)')
+
+
+def pytest_configure(config):
+    # Same filter as in simple/schema.py, as pytest resets the warning filters for each test
+    config.addinivalue_line('filterwarnings', 'ignore:Skipped unsupported reflection of expression-based index')
+    config.addinivalue_line('markers', 'network: test querying online services, only run with --network')
+
+
+def pytest_collection_modifyitems(config, items):
+    # Tests querying online services are slow and depend on the network, so they are skipped by default
+    if config.getoption('--network'):
+        return
+    skip = pytest.mark.skip(reason='queries online services, run with --network')
+    for item in items:
+        if 'network' in item.keywords:
+            item.add_marker(skip)
+
+
+def clone_database(snapshot, filename):
+    """Copy a SQLite database file with the backup API and connect to the copy"""
+    source = sqlite3.connect(str(snapshot))
+    target = sqlite3.connect(str(filename))
+    with target:
+        source.backup(target)
+    source.close()
+    target.close()
+    return Database('sqlite:///' + str(filename))
+
+
+def close_database(db):
+    db.session.close()
+    db.engine.dispose()
+
+
+@pytest.fixture(scope="session")
+def schema_snapshot(tmp_path_factory):
+    # Empty database with the SIMPLE schema
+    # Because we've imported simple.schema, we will be using that schema for the database
+    filename = tmp_path_factory.mktemp('snapshots') / 'schema.db'
+    create_database('sqlite:///' + str(filename))
+    return filename
+
+
+@pytest.fixture(scope="session")
+def data_snapshot(tmp_path_factory, schema_snapshot):
+    # Database with the contents of the data directory, loaded only once per session
+    # Loading takes care of finding serious issues (key/column violations)
+    filename = tmp_path_factory.mktemp('snapshots') / 'data.db'
+    db = clone_database(schema_snapshot, filename)
+    db.load_database(DB_PATH, verbose=False)
+    close_database(db)
+    return filename
+
+
+@pytest.fixture(scope="session")
+def fake_snapshot(tmp_path_factory, schema_snapshot):
+    # Database with a few fake sources, shared by the tests of the analyses (adopted measurements,
+    # photometry, summary): each test module adds the rows it needs to its copy
+    filename = tmp_path_factory.mktemp('snapshots') / 'fake.db'
+    db = clone_database(schema_snapshot, filename)
+    db.Publications.insert().execute([{'name': 'Old', 'bibcode': '2001ApJ...1....1A'},
+                                      {'name': 'New', 'bibcode': '2020ApJ...1....1A'}])
+    db.Sources.insert().execute([{'source': f'Fake {i}', 'ra': i, 'dec': -i, 'reference': 'Old'} for i in range(3)])
+    db.Parallaxes.insert().execute([
+        {'source': 'Fake 0', 'parallax': 10, 'parallax_error': 1., 'reference': 'Old', 'adopted': True},
+        {'source': 'Fake 0', 'parallax': 11, 'parallax_error': 0.5, 'reference': 'New', 'adopted': False}])
+    db.SpectralTypes.insert().execute([
+        {'source': 'Fake 0', 'spectral_type_string': 'T1', 'spectral_type_code': 81, 'regime': 'infrared',
+         'reference': 'New'},
+        {'source': 'Fake 0', 'spectral_type_string': 'L9', 'spectral_type_code': 79, 'regime': 'optical',
+         'reference': 'Old'}])
+    db.Telescopes.insert().execute([{'name': 'WISE'}])
+    db.Photometry.insert().execute([
+        {'source': 'Fake 1', 'band': 'WISE_W1', 'magnitude': 14.5, 'magnitude_error': 0.1, 'telescope': 'WISE',
+         'reference': 'Old'},
+        {'source': 'Fake 1', 'band': 'WISE_W1', 'magnitude': 14.2, 'magnitude_error': 0.05, 'telescope': 'WISE',
+         'reference': 'New'}])
+    close_database(db)
+    return filename
+
+
+@pytest.fixture(scope="module")
+def empty_db(request, tmp_path_factory, schema_snapshot):
+    # Empty database, private to the test module
+    db = clone_database(schema_snapshot, tmp_path_factory.mktemp(request.module.__name__) / 'empty.db')
+    yield db
+    close_database(db)
+
+
+@pytest.fixture(scope="module")
+def data_db(request, tmp_path_factory, data_snapshot):
+    # Database loaded with the data directory, private to the test module so it can be modified
+    db = clone_database(data_snapshot, tmp_path_factory.mktemp(request.module.__name__) / 'data.db')
+    yield db
+    close_database(db)
+
+
+@pytest.fixture(scope="module")
+def fake_db(request, tmp_path_factory, fake_snapshot):
+    # Database with the fake sources of fake_snapshot, private to the test module
+    db = clone_database(fake_snapshot, tmp_path_factory.mktemp(request.module.__name__) / 'fake.db')
+    yield db
+    close_database(db)
@@ -0,0 +1,69 @@
+# Tests for the recomputation of adopted measurements
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+from simple.schema import *
+from simple.adopted import recompute_adopted, update_adopted
+from tests.conftest import clone_database, close_database
+
+
+@pytest.fixture
+def db(tmp_path, fake_snapshot):
+    # Fake sources (see conftest.py), copied for each test as the tests change the adopted flags
+    db = clone_database(fake_snapshot, tmp_path / 'adopted.db')
+
+    db.Publications.insert().execute([{'name': 'Unknown', 'bibcode': None}])
+    db.Parallaxes.insert().execute([
+        {'source': 'Fake 0', 'parallax': 12, 'parallax_error': None, 'reference': 'Unknown', 'adopted': None},
+        {'source': 'Fake 1', 'parallax': 20, 'parallax_error': None, 'reference': 'Old', 'adopted': None},
+        {'source': 'Fake 1', 'parallax': 21, 'parallax_error': 3., 'reference': 'Unknown', 'adopted': None},
+        {'source': 'Fake 2', 'parallax': 30, 'parallax_error': 0.1, 'reference': 'Old', 'adopted': None}])
+    db.SpectralTypes.insert().execute([
+        {'source': 'Fake 1', 'spectral_type_string': 'T5', 'regime': 'infrared', 'reference': 'Old'}])
+
+    yield db
+
+    close_database(db)
+
+
+def adopted(db, table):
+    t = db.query(table).filter(table.c.adopted.is_(True)).table()
+    return sorted(zip(t['source'], t['reference']))
+
+
+def test_recompute_adopted(db):
+    # Only the given sources are updated
+    recompute_adopted(db, sources=['Fake 0', 'Fake 1'])
+    assert adopted(db, db.Parallaxes) == [('Fake 0', 'New'), ('Fake 1', 'Unknown')]
+    assert adopted(db, db.SpectralTypes) == [('Fake 0', 'Old'), ('Fake 1', 'Old')]
+
+    # All sources
+    recompute_adopted(db)
+    assert adopted(db, db.Parallaxes) == [('Fake 0', 'New'), ('Fake 1', 'Unknown'), ('Fake 2', 'Old')]
+    assert len(db.query(db.Parallaxes).filter(db.Parallaxes.c.adopted.is_(False)).table()) == 3
+
+
+def test_adopted_index(db):
+    # A second adopted measurement of a source is rejected (see simple.schema)
+    with pytest.raises(IntegrityError, match='UNIQUE constraint failed: Parallaxes.source'):
+        db.Parallaxes.update().where(db.Parallaxes.c.reference == 'New').values(adopted=True).execute()
+    db.Parallaxes.update().where(db.Parallaxes.c.reference == 'New').values(adopted=False).execute()
+
+
+def test_update_adopted_rules(db):
+    with db.engine.begin() as conn:
+        update_adopted(conn, db.SpectralTypes, rules=['preferred_regime'], regimes=['infrared'])
+        update_adopted(conn, db.Parallaxes, ['Fake 0'], rules=['most_recent'])
+    assert adopted(db, db.SpectralTypes) == [('Fake 0', 'New'), ('Fake 1', 'Old')]
+    assert adopted(db, db.Parallaxes) == [('Fake 0', 'New')]
+
+    # One adopted measurement per regime, without the index allowing one per source (see simple.schema)
+    with db.engine.begin() as conn:
+        conn.execute(text('DROP INDEX ix_SpectralTypes_adopted'))
+        update_adopted(conn, db.SpectralTypes, partition_by=('source', 'regime'))
+    assert adopted(db, db.SpectralTypes) == [('Fake 0', 'New'), ('Fake 0', 'Old'), ('Fake 1', 'Old')]
+
+    with pytest.raises(ValueError, match='Unknown adoption rule'):
+        with db.engine.begin() as conn:
+            update_adopted(conn, db.Parallaxes, rules=['best'])
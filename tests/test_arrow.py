@@ -0,0 +1,46 @@
+# Tests for the columnar (Arrow and Parquet) snapshots, which require pyarrow
+
+import pytest
+
+# Skip the whole module when the optional dependency is not installed
+pa = pytest.importorskip('pyarrow')
+
+from simple.schema import *
+from simple.arrow import export_snapshot, read_snapshot, SUMMARY_NAME
+from simple.summary import source_summary
+
+
+@pytest.fixture(scope="module")
+def db(data_db):
+    # Copy of the database loaded from the data directory, private to this module (see conftest.py)
+    return data_db
+
+
+@pytest.mark.parametrize('fmt', ['arrow', 'parquet'])
+def test_export_snapshot(db, tmp_path, fmt):
+    counts = export_snapshot(db, str(tmp_path), fmt=fmt, batch_size=500)
+    assert counts['Photometry'] == db.query(db.Photometry).count()
+    assert counts[SUMMARY_NAME] == db.query(db.Sources).count()
+
+    # Same contents as the database, with the types of the schema
+    photometry = read_snapshot(str(tmp_path), 'Photometry')
+    assert photometry.num_rows == counts['Photometry']
+    assert photometry.schema.field('magnitude').type == pa.float64()
+    expected = db.query(db.Photometry).pandas().sort_values(['source', 'band', 'reference'])
+    assert photometry.column('magnitude').to_pylist() == list(expected['magnitude'])
+
+    spectral_types = read_snapshot(str(tmp_path), 'SpectralTypes', columns=['source', 'regime', 'adopted'])
+    assert spectral_types.column_names == ['source', 'regime', 'adopted']
+    assert pa.types.is_dictionary(spectral_types.schema.field('regime').type)
+    assert spectral_types.schema.field('adopted').type == pa.bool_()
+
+    summary = read_snapshot(str(tmp_path), SUMMARY_NAME)
+    assert summary.column_names == source_summary(db).colnames
+    assert pa.types.is_dictionary(summary.schema.field('gravity').type)
+
+
+def test_read_snapshot_missing(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        read_snapshot(str(tmp_path), 'Photometry')
+    with pytest.raises(ValueError):
+        export_snapshot(None, str(tmp_path), fmt='csv')
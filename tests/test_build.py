@@ -0,0 +1,128 @@
+# Tests for the database build utilities
+
+import os
+import json
+import shutil
+import pytest
+from simple.schema import *
+from sqlalchemy import text
+from simple.build import write_manifest, manifest_is_current, load_database_incremental, load_database_parallel, \
+    create_indexes
+from astrodbkit2.astrodb import create_database, Database
+
+DB_PATH = 'data'
+SOURCE_FILES = ['2mass_j00001354+2554180.json', '2mass_j00011217+1535355.json',
+                '2mass_j00034227-2822410.json', '2mass_j00040288-6410358.json']
+
+
+# Utility functions
+# -----------------------------------------------------------------------------------------
+def new_database(filename):
+    if os.path.exists(filename):
+        os.remove(filename)
+    connection_string = 'sqlite:///' + filename
+    create_database(connection_string)
+    return Database(connection_string)
+
+
+def database_contents(db):
+    # Sorted contents of every table, for comparing two databases
+    return {table.name: sorted(str(tuple(row)) for row in db.query(table).all())
+            for table in db.metadata.sorted_tables}
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    # Small copy of the data directory that can be modified by the tests
+    directory = tmp_path / 'data'
+    directory.mkdir()
+    for file in ['Publications.json', 'Telescopes.json'] + SOURCE_FILES[:3]:
+        shutil.copy(os.path.join(DB_PATH, file), directory)
+    return directory
+
+
+def test_incremental_load(tmp_path, data_dir):
+    manifest_file = str(tmp_path / 'manifest.json')
+    db = new_database(str(tmp_path / 'incremental.db'))
+    db.load_database(str(data_dir))
+    write_manifest(str(data_dir), manifest_file)
+    assert manifest_is_current(manifest_file)
+
+    # No changes
+    changes = load_database_incremental(db, str(data_dir), manifest_file)
+    assert changes == {'added': [], 'changed': [], 'removed': []}
+
+    # Add, change, and remove source files and update a reference table
+    shutil.copy(os.path.join(DB_PATH, SOURCE_FILES[3]), data_dir)
+    os.remove(data_dir / SOURCE_FILES[1])
+    with open(data_dir / SOURCE_FILES[0]) as f:
+        data = json.load(f)
+    data['Names'].append({'other_name': 'Fake name'})
+    data['Photometry'] = data['Photometry'][:2]
+    with open(data_dir / SOURCE_FILES[0], 'w') as f:
+        json.dump(data, f, indent=4)
+    with open(data_dir / 'Publications.json') as f:
+        data = json.load(f)
+    data[0]['description'] = 'Updated description'
+    data.append({'name': 'Fake23', 'bibcode': None, 'doi': None, 'description': None})
+    with open(data_dir / 'Publications.json', 'w') as f:
+        json.dump(data, f, indent=4)
+
+    changes = load_database_incremental(db, str(data_dir), manifest_file)
+    assert changes == {'added': [SOURCE_FILES[3]],
+                       'changed': [SOURCE_FILES[0], 'Publications.json'],
+                       'removed': [SOURCE_FILES[1]]}
+
+    # The result should match a full load of the modified directory
+    reference_db = new_database(str(tmp_path / 'full.db'))
+    reference_db.load_database(str(data_dir))
+    assert database_contents(db) == database_contents(reference_db)
+
+    for d in (db, reference_db):
+        d.session.close()
+        d.engine.dispose()
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_load_database_parallel(tmp_path, data_dir, processes):
+    db = new_database(str(tmp_path / 'parallel.db'))
+    load_database_parallel(db, str(data_dir), processes=processes)
+
+    reference_db = new_database(str(tmp_path / 'full.db'))
+    reference_db.load_database(str(data_dir))
+    assert database_contents(db) == database_contents(reference_db)
+
+    # Invalid files are reported and nothing is loaded
+    with open(data_dir / 'bad.json', 'w') as f:
+        json.dump({'Sources': [{'source': 'Bad', 'reference': 'Knap04'}], 'Fake': [{'x': 1}]}, f)
+    with pytest.raises(RuntimeError, match='table Fake is not in the database'):
+        load_database_parallel(db, str(data_dir), processes=processes)
+    assert database_contents(db) == database_contents(reference_db)
+    os.remove(data_dir / 'bad.json')
+
+    # Including unknown columns of the reference tables
+    publications = json.loads((data_dir / 'Publications.json').read_text())
+    publications[0]['bibcod'] = publications[0].pop('bibcode')
+    (data_dir / 'Publications.json').write_text(json.dumps(publications))
+    with pytest.raises(RuntimeError, match=r"unknown Publications columns \['bibcod'\]"):
+        load_database_parallel(db, str(data_dir), processes=processes)
+    assert database_contents(db) == database_contents(reference_db)
+
+    for d in (db, reference_db):
+        d.session.close()
+        d.engine.dispose()
+
+
+def test_create_indexes(tmp_path):
+    # Indexes missing from an older database are added
+    db = new_database(str(tmp_path / 'indexes.db'))
+    assert create_indexes(db) == []
+    with db.engine.begin() as conn:
+        conn.execute(text('DROP INDEX ix_Names_other_name'))
+        conn.execute(text('DROP INDEX ix_Names_normalized_name'))
+        conn.execute(text('DROP INDEX ix_Photometry_band_source'))
+    assert create_indexes(db) == ['ix_Names_normalized_name', 'ix_Names_other_name', 'ix_Photometry_band_source']
+    assert create_indexes(db) == []
+
+    db.session.close()
+    db.engine.dispose()
@@ -1,37 +1,16 @@
 # Tests to verify database contents
 
-import os
 import pytest
 from simple.schema import *
-from astrodbkit2.astrodb import create_database, Database
-
-
-DB_NAME = 'temp.db'
-DB_PATH = 'data'
 
 
 # Load the database for use in individual tests
 @pytest.fixture(scope="module")
-def db():
-    # Create a fresh temporary database and assert it exists
-    # Because we've imported simple.schema, we will be using that schema for the database
-
-    if os.path.exists(DB_NAME):
-        os.remove(DB_NAME)
-    connection_string = 'sqlite:///' + DB_NAME
-    create_database(connection_string)
-    assert os.path.exists(DB_NAME)
-
-    # Connect to the new database and confirm it has the Sources table
-    db = Database(connection_string)
-    assert db
-    assert 'source' in [c.name for c in db.Sources.columns]
-
-    # Load the database contents
-    # This should take care of finding serious issues (key/column violations)
-    db.load_database(DB_PATH, verbose=False)
-
-    return db
+def db(data_db):
+    # Copy of the database loaded once per session from the data directory (see conftest.py)
+    # Confirm it has the Sources table
+    assert 'source' in [c.name for c in data_db.Sources.columns]
+    return data_db
 
 
 # Utility functions
@@ -0,0 +1,50 @@
+# Tests for the detection of candidate duplicate sources
+
+import numpy as np
+import pytest
+from simple.schema import *
+from simple.duplicates import find_duplicates
+
+
+@pytest.fixture(scope="module")
+def db(empty_db):
+    # Empty database private to this module (see conftest.py), with a few fake sources
+    db = empty_db
+    db.Publications.insert().execute([{'name': 'Ref 1'}])
+    db.Sources.insert().execute([
+        {'source': 'A', 'ra': 10., 'dec': 10., 'epoch': None, 'reference': 'Ref 1'},
+        {'source': 'B', 'ra': 10. + 1 / 3600, 'dec': 10., 'epoch': None, 'reference': 'Ref 1'},  # 1 arcsec from A
+        {'source': 'C', 'ra': 200., 'dec': -30., 'epoch': None, 'reference': 'Ref 1'},
+        {'source': 'D', 'ra': 100., 'dec': 45., 'epoch': None, 'reference': 'Ref 1'},  # same name as C
+        {'source': 'E', 'ra': 359.9999, 'dec': 0., 'epoch': 2000., 'reference': 'Ref 1'},
+        {'source': 'F', 'ra': 19.5 / 3600, 'dec': 0., 'epoch': 2020., 'reference': 'Ref 1'},  # E, 20 years later
+        {'source': 'G', 'ra': 50., 'dec': 50., 'epoch': None, 'reference': 'Ref 1'},
+        {'source': 'H', 'ra': 60., 'dec': 50., 'epoch': None, 'reference': 'Ref 1'}])
+    db.Names.insert().execute([{'source': source, 'other_name': source} for source in 'ABCDEFGH'] +
+                              [{'source': 'C', 'other_name': 'Alias'}, {'source': 'D', 'other_name': ' alias'},
+                               {'source': 'G', 'other_name': ''}, {'source': 'H', 'other_name': ''}])
+    db.ProperMotions.insert().execute([{'source': 'E', 'mu_ra': 1000., 'mu_ra_error': 1., 'mu_dec': 0.,
+                                        'mu_dec_error': 1., 'reference': 'Ref 1'}])
+    return db
+
+
+def groups(t):
+    return [sorted(t['source'][t['group'] == group]) for group in sorted(set(t['group']))]
+
+
+def test_find_duplicates(db):
+    t = find_duplicates(db)
+    assert t.colnames == ['group', 'source', 'ra', 'dec', 'separation', 'by_position', 'by_name']
+    # Empty names do not link sources
+    assert groups(t) == [['A', 'B'], ['C', 'D']]
+    assert np.allclose(t['separation'][:2] * 3600, [0, np.cos(np.radians(10))])
+    assert list(t['by_position']) == [True, True, False, False]
+    assert list(t['by_name']) == [False, False, True, True]
+
+    assert groups(find_duplicates(db, '0.5s', names=False)) == []
+    # Sources linked through another source
+    assert groups(find_duplicates(db, 200.)) == [['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H']]
+
+    # Fast moving source, with positions at different epochs
+    t = find_duplicates(db, epoch=2020., names=False, fmt='pandas')
+    assert groups(t) == [['A', 'B'], ['E', 'F']]
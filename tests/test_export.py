@@ -0,0 +1,107 @@
+# Tests for the batched inventory and the JSON export
+
+import os
+import json
+import filecmp
+import pytest
+from simple.schema import *
+from simple.export import inventory_many, save_database, source_filename
+from simple.serialization import canonical_data
+from simple.changes import create_change_tracking, drop_change_tracking, changed_sources, changed_tables
+
+
+@pytest.fixture(scope="module")
+def db(data_db):
+    # Copy of the database loaded from the data directory, private to this module (see conftest.py)
+    return data_db
+
+
+def test_inventory_many(db):
+    # Same results as Database.inventory, for every source
+    results = list(inventory_many(db))
+    sources = [row[0] for row in db.query(db.Sources.c.source).all()]
+    assert [source for source, _ in results] == sorted(sources)
+    for source, data in results:
+        assert data == db.inventory(source)
+
+    # Requested order is kept, repeated sources are returned once, and missing sources are empty
+    names = [sources[5], 'Not a source', sources[2], sources[5]]
+    results = list(inventory_many(db, names))
+    assert [source for source, _ in results] == names[:3]
+    assert results[1][1] == {}
+    assert results[0][1] == db.inventory(sources[5])
+    assert list(inventory_many(db, [])) == []
+
+
+def test_save_database(db, tmp_path):
+    # Same files as Database.save_database, byte for byte
+    expected, output = tmp_path / 'expected', tmp_path / 'output'
+    expected.mkdir()
+    output.mkdir()
+    db.save_database(str(expected))
+    (output / 'old_source.json').write_text('{}')
+    count = save_database(db, str(output))
+
+    files = sorted(os.listdir(expected))
+    assert sorted(os.listdir(output)) == files
+    assert count == db.query(db.Sources).count()
+    for file in files:
+        assert filecmp.cmp(expected / file, output / file, shallow=False), file
+        with open(expected / file) as f:
+            data = json.load(f)
+        assert canonical_data(data, db._primary_table, db.metadata, file[:-5]) == data
+
+    # Saving again leaves the files untouched
+    mtimes = {file: os.stat(output / file).st_mtime_ns for file in files}
+    assert save_database(db, str(output)) == 0
+    assert {file: os.stat(output / file).st_mtime_ns for file in files} == mtimes
+
+    # Saving selected sources only
+    source = db.query(db.Sources.c.source).first()[0]
+    selected = tmp_path / 'selected'
+    selected.mkdir()
+    assert save_database(db, str(selected), sources=[source]) == 1
+    assert filecmp.cmp(output / source_filename(source), selected / source_filename(source), shallow=False)
+
+    # Saving selected sources into a populated directory leaves the other files
+    (output / source_filename(source)).unlink()
+    assert save_database(db, str(output), sources=[source]) == 1
+    assert sorted(os.listdir(output)) == files
+
+
+def test_save_database_changed_only(db, tmp_path):
+    output = tmp_path / 'output'
+    output.mkdir()
+    with pytest.raises(RuntimeError):
+        save_database(db, str(output), changed_only=True)
+
+    save_database(db, str(output))
+    create_change_tracking(db)
+    assert changed_sources(db) == [] and changed_tables(db) == []
+
+    # Add a name, change a parallax, delete a source, and add a publication
+    sources = [row[0] for row in db.query(db.Parallaxes.c.source).distinct().order_by(db.Parallaxes.c.source).limit(3)]
+    db.Names.insert().execute([{'source': sources[0], 'other_name': 'Changed name'}])
+    db.Parallaxes.update().where(db.Parallaxes.c.source == sources[1]).values(comments='changed').execute()
+    for table in db.metadata.sorted_tables[::-1]:
+        if 'source' in table.columns:
+            table.delete().where(table.c.source == sources[2]).execute()
+    db.Publications.insert().execute([{'name': 'Chan99', 'description': 'Changed publication'}])
+    assert changed_sources(db) == sorted(sources)
+    assert changed_tables(db) == ['Publications']
+
+    # Only the changed files are written, and the result is the same as a full save
+    assert save_database(db, str(output), changed_only=True) == 2
+    assert not (output / source_filename(sources[2])).exists()
+    assert changed_sources(db) == [] and changed_tables(db) == []
+
+    expected = tmp_path / 'expected'
+    expected.mkdir()
+    save_database(db, str(expected))
+    files = sorted(os.listdir(expected))
+    assert sorted(os.listdir(output)) == files
+    match, mismatch, errors = filecmp.cmpfiles(expected, output, files, shallow=False)
+    assert mismatch == [] and errors == []
+
+    with db.engine.begin() as conn:
+        drop_change_tracking(conn, db)
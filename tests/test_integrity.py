@@ -1,105 +1,86 @@
 # Test to verify database integrity
 
 import os
+import numpy as np
 import pytest
-from sqlalchemy import func
 from simple.schema import *
-from astrodbkit2.astrodb import create_database, Database, or_
+from astrodbkit2 import REFERENCE_TABLES
 from astropy.table import unique
 from astroquery.simbad import Simbad
 from astrodbkit2.utils import _name_formatter
+from simple.names import match_names
+from simple.duplicates import find_duplicates
+from simple.validation import validate, changes_from_git, VALIDATION_RULES
 
-DB_NAME = 'temp.db'
 DB_PATH = 'data'
 
+# Groups of sources found by find_duplicates that are known to be distinct objects, eg resolved binaries
+KNOWN_DUPLICATES = [{'TWA 27', 'TWA 27B'},
+                    {'2MASS J14162408+1348263', 'ULAS J141623.94+134836.3'}]  # companion at the primary position
+
 
 # Load the database for use in individual tests
 @pytest.fixture(scope="module")
-def db():
-    # Create a fresh temporary database and assert it exists
-    # Because we've imported simple.schema, we will be using that schema for the database
+def db(data_db):
+    # Copy of the database loaded once per session from the data directory (see conftest.py)
+    # Confirm it has the Sources table
+    assert 'source' in [c.name for c in data_db.Sources.columns]
+    return data_db
 
-    if os.path.exists(DB_NAME):
-        os.remove(DB_NAME)
-    connection_string = 'sqlite:///' + DB_NAME
-    create_database(connection_string)
-    assert os.path.exists(DB_NAME)
 
-    # Connect to the new database and confirm it has the Sources table
-    db = Database(connection_string)
-    assert db
-    assert 'source' in [c.name for c in db.Sources.columns]
+@pytest.fixture(scope="module")
+def report(request, db):
+    # All the validation rules, checked once with one query per table (see simple/validation.py),
+    # only for the data changed since some git revisions with --changed-since (eg, origin/main...HEAD)
+    revisions = request.config.getoption('--changed-since')
+    return validate(db, changes=changes_from_git(revisions, DB_PATH) if revisions else None)
 
-    return db
+
+def violations(report, *rules):
+    # Violations of some rules, printed if there are any
+    t = report[np.isin(report['rule'], rules)]
+    if len(t) > 0:
+        print(f'\n{len(t)} {", ".join(rules)} violations:')
+        print(t)
+    return t
 
 
 def test_data_load(db):
-    # Test that all data can be loaded into the database
-    # This should take care of finding serious issues (key/column violations)
-    db.load_database(DB_PATH, verbose=False)
+    # Test that all data was loaded into the database
+    # Loading takes care of finding serious issues (key/column violations), see conftest.py
+    n_sources = len([f for f in os.listdir(DB_PATH)
+                     if f.endswith('.json') and f[:-len('.json')] not in REFERENCE_TABLES])
+    assert db.query(db.Sources).count() == n_sources
 
 
-def test_reference_uniqueness(db):
+def test_reference_uniqueness(db, report):
     # Verify that all Publications.name values are unique
     t = db.query(db.Publications.c.name).astropy()
     assert len(t) == len(unique(t, keys='name')), 'Duplicated Publications found'
 
-    # Verify that DOI are supplied
-    t = db.query(db.Publications.c.name).filter(db.Publications.c.doi.is_(None)).astropy()
-    if len(t) > 0:
-        print(f'\n{len(t)} publications lacking DOI:')
-        print(t)
-
-    # Verify that Bibcodes are supplied
-    t = db.query(db.Publications.c.name).filter(db.Publications.c.bibcode.is_(None)).astropy()
-    if len(t) > 0:
-        print(f'\n{len(t)} publications lacking Bibcodes:')
-        print(t)
+    # Verify that DOI and Bibcodes are supplied
+    violations(report, 'missing_doi')
+    violations(report, 'missing_bibcode')
 
 
-def test_references(db):
+def test_references(report):
     # Verify that all data point to an existing Publication
-
-    ref_list = []
-    table_list = ['Sources', 'Photometry']
-    for table in table_list:
-        # Get list of unique references
-        t = db.query(db.metadata.tables[table].c.reference).distinct().astropy()
-        ref_list = ref_list + t['reference'].tolist()
-
-    # Getting unique set
-    ref_list = list(set(ref_list))
-
-    # Confirm that all are in Publications
-    t = db.query(db.Publications.c.name).filter(db.Publications.c.name.in_(ref_list)).astropy()
-    assert len(t) == len(ref_list), 'Some references were not matched'
+    t = violations(report, *[rule for rule in VALIDATION_RULES if rule.startswith('unknown_reference')])
+    assert len(t) == 0, 'Some references were not matched'
 
     # List out publications that have not been used
-    t = db.query(db.Publications.c.name).filter(db.Publications.c.name.notin_(ref_list)).astropy()
-    if len(t) > 0:
-        print(f'\n{len(t)} publications not referenced by {table_list}')
-        print(t)
+    violations(report, 'unused_publication')
 
 
-def test_coordinates(db):
+def test_coordinates(report):
     # Verify that all sources have valid coordinates
-    t = db.query(db.Sources.c.source, db.Sources.c.ra, db.Sources.c.dec).filter(
-        or_(db.Sources.c.ra.is_(None), db.Sources.c.ra < 0, db.Sources.c.ra > 360,
-            db.Sources.c.dec.is_(None), db.Sources.c.dec < -90, db.Sources.c.dec > 90)).astropy()
-
-    if len(t) > 0:
-        print(f'\n{len(t)} Sources failed coordinate checks')
-        print(t)
-
+    t = violations(report, 'coordinates')
     assert len(t) == 0, f'{len(t)} Sources failed coordinate checks'
 
 
-def test_source_names(db):
+def test_source_names(report):
     # Verify that all sources have at least one entry in Names table
-    sql_text = "SELECT Sources.source	FROM Sources LEFT JOIN Names " \
-             "ON Names.source=Sources.source WHERE Names.source IS NULL"
-    missing_names = db.sql_query(sql_text, fmt='astropy')
-    assert len(missing_names) == 0
+    assert len(violations(report, 'missing_names')) == 0
 
 
 def test_source_uniqueness(db):
@@ -121,42 +102,10 @@ def test_source_uniqueness(db):
     assert len(duplicate_names) == 0
 
 
-def test_names_table(db):
-    # Verify that all Sources contain at least one entry in the Names table
-    name_list = db.query(db.Sources.c.source).astropy()
-    name_list = name_list['source'].tolist()
-    source_name_counts = db.query(db.Names.c.source).\
-        filter(db.Names.c.source.in_(name_list)).\
-        distinct().\
-        count()
-    assert len(name_list) == source_name_counts, 'ERROR: There are Sources without entries in the Names table'
-
+def test_names_table(report):
     # Verify that each Source contains an entry in Names with Names.source = Names.other_source
-    valid_name_counts = db.query(db.Names.c.source).\
-        filter(db.Names.c.source == db.Names.c.other_name).\
-        distinct().\
-        count()
-
-    # If the number of valid names don't match the number of sources, then there are cases that are missing
-    # The script below will gather them and print them out
-    if len(name_list) != valid_name_counts:
-        # Create a temporary table that groups entries in the Names table by their source name
-        # with a column containing a concatenation of all known names
-        t = db.query(db.Names.c.source,
-                     func.group_concat(db.Names.c.other_name).label('names')).\
-            group_by(db.Names.c.source).\
-            astropy()
-
-        # Get the list of entries whose source name are not present in the 'other_names' column
-        # Then return the Names table results so we can see what the DB has for these entries
-        results = [row['source'] for row in t if row['source'] not in row['names'].split(',')]
-        print('\nEntries in Names without Names.source == Names.other_name:')
-        print(db.query(db.Names).
-              filter(db.Names.c.source.in_(results)).
-              astropy())
-
-    assert len(name_list) == valid_name_counts, \
-        'ERROR: There are entries in Names without Names.source == Names.other_name'
+    t = violations(report, 'missing_source_name')
+    assert len(t) == 0, 'ERROR: There are entries in Names without Names.source == Names.other_name'
 
 
 def test_source_uniqueness2(db):
@@ -168,8 +117,21 @@ def test_source_uniqueness2(db):
     assert len(duplicate_names) == 0
 
 
+def test_source_duplicates(db):
+    # Confirm that there are no duplicates with different names, offline:
+    # sources close to each other or sharing a name are candidate duplicates (see simple.duplicates)
+    t = find_duplicates(db)
+    groups = [set(t['source'][t['group'] == group]) for group in sorted(set(t['group']))]
+    new_groups = [group for group in groups if group not in KNOWN_DUPLICATES]
+    for group in new_groups:
+        print(f'\nCandidate duplicates: {sorted(group)}')
+        print(t[np.isin(t['source'], list(group))])
+    assert len(new_groups) == 0, 'Candidate duplicate sources found, see simple.duplicates.find_duplicates'
+
+
+@pytest.mark.network
 def test_source_simbad(db):
-    # Query Simbad and confirm that there are no duplicates with different names
+    # Query Simbad and confirm that there are no duplicates with different names (run with --network)
 
     # Get list of all source names
     results = db.query(db.Sources.c.source).all()
@@ -181,139 +143,68 @@ def test_source_simbad(db):
     simbad_results = Simbad.query_objects(name_list)
 
     # Get a nicely formatted list of Simbad names for each input row
-    duplicate_count = 0
-    for row in simbad_results[['TYPED_ID', 'IDS']].iterrows():
+    simbad_names, simbad_rows = [], []
+    for i, row in enumerate(simbad_results[['TYPED_ID', 'IDS']].iterrows()):
         try:
             name, ids = row[0].decode("utf-8"), row[1].decode("utf-8")
         except AttributeError:
             # Catch decoding error
             name, ids = row[0], row[1]
 
-        simbad_names = [_name_formatter(s) for s in ids.split('|')
-                        if _name_formatter(s) != '' and _name_formatter(s) is not None]
-
-        if len(simbad_names) == 0:
+        names = [s for s in (_name_formatter(s) for s in ids.split('|')) if s]
+        if len(names) == 0:
             print(f'No Simbad names for {name}')
             continue
+        simbad_names += names
+        simbad_rows += [(i, name)] * len(names)
+
+    # Match all Simbad names against the database at once and find the inputs matching more than one source
+    t = match_names(db, simbad_names)
+    sources = {}
+    for index, source in zip(t['index'], t['source']):
+        sources.setdefault(simbad_rows[index], set()).add(source)
 
-        # Examine DB for each input, displaying results when more than one source matches
-        t = db.search_object(simbad_names, output_table='Sources', fmt='astropy', fuzzy_search=False)
-        if len(t) > 1:
-            print(f'Multiple matches for {name}: {simbad_names}')
-            print(db.query(db.Names).filter(db.Names.c.source.in_(t['source'])).astropy())
+    duplicate_count = 0
+    for (i, name), matches in sorted(sources.items()):
+        if len(matches) > 1:
+            print(f'Multiple matches for {name}: {sorted(matches)}')
+            print(db.query(db.Names).filter(db.Names.c.source.in_(matches)).astropy())
             duplicate_count += 1
 
     assert duplicate_count == 0, 'Duplicate sources identified via Simbad queries'
 
 
-def test_photometry(db):
-    # Tests for Photometry table
-
+def test_photometry(report):
     # Check that no negative magnitudes have been provided,
     # nor any that are larger than 99 (if missing/limits, just use None)
-    t = db.query(db.Photometry). \
-        filter(or_(db.Photometry.c.magnitude < 0,
-                   db.Photometry.c.magnitude >= 99)). \
-        astropy()
-    if len(t) > 0:
-        print('\nInvalid magnitudes present')
-        print(t)
-    assert len(t) == 0
-
+    assert len(violations(report, 'magnitude_range')) == 0
 
-def test_parallaxes(db):
-    # Tests against the Parallaxes table
 
+def test_parallaxes(report):
     # While there may be many parallax measurements for a single source,
     # there should be one and only one marked as adopted
-    t = db.query(db.Parallaxes.c.source,
-                 func.sum(db.Parallaxes.c.adopted).label('adopted_counts')). \
-        group_by(db.Parallaxes.c.source). \
-        having(func.sum(db.Parallaxes.c.adopted) != 1). \
-        astropy()
-    if len(t) > 0:
-        print("\nParallax entries with incorrect 'adopted' labels")
-        print(t)
-    assert len(t) == 0
-
+    assert len(violations(report, 'adopted_parallax')) == 0
 
-def test_propermotions(db):
-    # Tests against the ProperMotions table
 
+def test_propermotions(report):
     # There should be no entries in the ProperMotions table without both mu_ra and mu_dec
-    t = db.query(db.ProperMotions.c.source).\
-        filter(or_(db.ProperMotions.c.mu_ra.is_(None),
-                   db.ProperMotions.c.mu_dec.is_(None))).\
-        astropy()
-    if len(t) > 0:
-        print('\nEntries found without proper motion values')
-        print(t)
-    assert len(t) == 0
-
+    assert len(violations(report, 'missing_proper_motion')) == 0
 
-def test_radialvelocities(db):
-    # Tests against the RadialVelocities table
 
+def test_radialvelocities(report):
     # There should be no entries in the RadialVelocities table without rv values
-    t = db.query(db.RadialVelocities.c.source).\
-        filter(db.RadialVelocities.c.radial_velocity.is_(None)).\
-        astropy()
-    if len(t) > 0:
-        print('\nEntries found without radial velocity values')
-        print(t)
-    assert len(t) == 0
+    assert len(violations(report, 'missing_radial_velocity')) == 0
 
 
-def test_spectraltypes(db):
-    # Tests against the SpectralTypes table
-
-    # There should be no entries in the SpectralTypes table without a spectral type string
-    t = db.query(db.SpectralTypes.c.source). \
-        filter(db.SpectralTypes.c.spectral_type_string.is_(None)). \
-        astropy()
-    if len(t) > 0:
-        print('\nEntries found without spectral type strings')
-        print(t)
-    assert len(t) == 0
-
-    # There should be no entries in the SpectralTypes table without a spectral type code
-    t = db.query(db.SpectralTypes.c.source). \
-        filter(db.SpectralTypes.c.spectral_type_code.is_(None)). \
-        astropy()
-    if len(t) > 0:
-        print('\nEntries found without spectral type codes')
-        print(t)
-    assert len(t) == 0
+def test_spectraltypes(report):
+    # There should be no entries in the SpectralTypes table without a spectral type string or code
+    assert len(violations(report, 'missing_spectral_type')) == 0
 
     # While there may be many spectral type measurements for a single source,
     # there should be one and only one marked as adopted
-    t = db.query(db.SpectralTypes.c.source,
-                 func.sum(db.SpectralTypes.c.adopted).label('adopted_counts')). \
-        group_by(db.SpectralTypes.c.source). \
-        having(func.sum(db.SpectralTypes.c.adopted) != 1). \
-        astropy()
-    if len(t) > 0:
-        print("\nSpectral Type entries with incorrect 'adopted' labels")
-        print(t)
-    assert len(t) == 0
-
+    assert len(violations(report, 'adopted_spectral_type')) == 0
 
-def test_gravities(db):
-    # Tests against the Gravities table
 
+def test_gravities(report):
     # There should be no entries in the Gravities table without a gravity measurement
-    t = db.query(db.Gravities.c.source). \
-        filter(db.Gravities.c.gravity.is_(None)). \
-        astropy()
-    if len(t) > 0:
-        print('\nEntries found without gravity values')
-        print(t)
-    assert len(t) == 0
-
-
-def test_remove_database(db):
-    # Clean up temporary database
-    db.session.close()
-    db.engine.dispose()
-    if os.path.exists(DB_NAME):
-        os.remove(DB_NAME)
+    assert len(violations(report, 'missing_gravity')) == 0
@@ -0,0 +1,96 @@
+# Tests for name normalization and name searches
+
+import pytest
+from sqlalchemy import text
+from simple.schema import *
+from simple.database import connect
+from simple.build import load_database_parallel
+from simple.names import normalize_name, normalized_name_sql, match_names, create_name_index, drop_name_index, \
+    has_name_index, name_index_supported, search_names, NAME_INDEX_TABLE
+
+NAMES = ['2MASS J01415823-4633574', '  2MASS   J0141+18 ', 'V* V1298 Tau', 'NAME Luhman\t16', 'Cl* Fake  * 1', 'wise 0855']
+
+
+@pytest.fixture(scope="module")
+def db(data_db):
+    # Copy of the database loaded from the data directory, private to this module (see conftest.py)
+    return data_db
+
+
+def test_normalize_name(db):
+    assert normalize_name('  V* 2MASS   J0141 ') == '2mass j0141'
+    assert normalize_name('HIDDEN name') is None
+
+    # The SQL expression gives the same results
+    with db.engine.connect() as conn:
+        for name in NAMES:
+            assert conn.execute(text(f"SELECT {normalized_name_sql(':name')}"), {'name': name}).scalar() == \
+                   normalize_name(name)
+
+
+def test_match_names(db):
+    t = match_names(db, ['2mass  j01415823-4633574', 'Fake name', None, 'V* 2MASS J01415823-4633574'])
+    assert list(t['index']) == [0, 3]
+    assert list(t['source']) == ['2MASS J01415823-4633574'] * 2
+    assert t['name'][0] == '2mass  j01415823-4633574'
+    assert len(match_names(db, [])) == 0
+
+    # Every source matches its own name, so duplicates across the whole catalog are found with one query
+    sources = [row[0] for row in db.query(db.Sources.c.source).all()]
+    t = match_names(db, sources, fmt='pandas')
+    assert len(t) == len(sources)
+    assert (t['name'] == t['source']).all()
+
+
+def test_search_names(db):
+    # Without the index, the Names table is scanned
+    assert not has_name_index(db)
+    expected = set(db.search_object('0141', fmt='astropy')['source'])
+    t = search_names(db, '0141', limit=1000)
+    assert set(t['source']) == expected
+    assert list(t['rank']) == list(range(1, len(t) + 1))
+
+    # The index gives the same results and finds exact matches first
+    if not name_index_supported():
+        with pytest.raises(RuntimeError, match='requires SQLite 3.34.0'):
+            create_name_index(db)
+        pytest.skip('SQLite without the FTS5 trigram tokenizer')
+    create_name_index(db)
+    assert has_name_index(db)
+    assert set(search_names(db, '0141', limit=1000)['source']) == expected
+    assert search_names(db, ' 2mass  j01415823-4633574', fmt='default')[0] == \
+           ('2MASS J01415823-4633574', '2MASS J01415823-4633574', 1)
+    assert len(search_names(db, '0141', limit=2)) == 2
+    assert len(search_names(db, 'zzzzzz')) == 0
+
+
+@pytest.mark.skipif(not name_index_supported(), reason='SQLite without the FTS5 trigram tokenizer')
+def test_name_index_sync(db):
+    # Names added, changed, or deleted are reflected in the index
+    with db.engine.begin() as conn:
+        conn.execute(db.Names.insert().values(source='2MASS J01415823-4633574', other_name='V* My  Fake Alias'))
+    assert list(search_names(db, 'my fake al')['source']) == ['2MASS J01415823-4633574']
+
+    with db.engine.begin() as conn:
+        conn.execute(db.Names.update().where(db.Names.c.other_name == 'V* My  Fake Alias').
+                     values(other_name='Another Alias'))
+    assert len(search_names(db, 'my fake al')) == 0
+    assert list(search_names(db, 'another alias')['other_name']) == ['Another Alias']
+
+    with db.engine.begin() as conn:
+        conn.execute(db.Names.delete().where(db.Names.c.other_name == 'Another Alias'))
+    assert len(search_names(db, 'another alias')) == 0
+
+    # The index tables are hidden from astrodbkit2
+    other = connect(str(db.engine.url))
+    assert NAME_INDEX_TABLE not in other.metadata.tables
+    assert len(other.inventory('2MASS J01415823-4633574')['Names']) > 0
+    other.session.close()
+    other.engine.dispose()
+
+    # Reloading the database keeps the index in sync
+    load_database_parallel(db, 'data', processes=1)
+    assert set(search_names(db, '0141', limit=1000)['source']) == set(db.search_object('0141', fmt='astropy')['source'])
+
+    drop_name_index(db.engine)
+    assert not has_name_index(db)
@@ -0,0 +1,44 @@
+# Tests for the NDJSON data layout, with one file per table
+
+import os
+import filecmp
+import pytest
+from simple.schema import *
+from simple.export import save_database
+from simple.ndjson import save_ndjson, load_ndjson
+
+
+def test_ndjson_round_trip(data_db, empty_db, tmp_path):
+    directory = tmp_path / 'tables'
+    directory.mkdir()
+    (directory / 'Modes.ndjson').write_text('')
+    written = save_ndjson(data_db, str(directory))
+    assert sorted(written) == sorted(os.listdir(directory))
+    assert 'Sources.ndjson' in written and 'Modes.ndjson' not in written
+    assert save_ndjson(data_db, str(directory)) == []
+
+    counts = load_ndjson(empty_db, str(directory))
+    assert counts['Sources'] == data_db.query(data_db.Sources).count()
+    assert counts['Photometry'] == data_db.query(data_db.Photometry).count()
+
+    # Same files in the one file per source layout
+    expected, output = tmp_path / 'expected', tmp_path / 'output'
+    expected.mkdir()
+    output.mkdir()
+    save_database(data_db, str(expected))
+    save_database(empty_db, str(output))
+    files = sorted(os.listdir(expected))
+    assert sorted(os.listdir(output)) == files
+    match, mismatch, errors = filecmp.cmpfiles(expected, output, files, shallow=False)
+    assert mismatch == [] and errors == []
+
+
+def test_load_ndjson_errors(empty_db, tmp_path):
+    (tmp_path / 'Sources.ndjson').write_text('{"source": "Fake 1", "ra": 1.0, "color": "red"}\n')
+    with pytest.raises(RuntimeError, match='unknown Sources columns'):
+        load_ndjson(empty_db, str(tmp_path))
+
+    (tmp_path / 'Sources.ndjson').unlink()
+    (tmp_path / 'Fake.ndjson').write_text('')
+    with pytest.raises(RuntimeError, match='not in the database'):
+        load_ndjson(empty_db, str(tmp_path))
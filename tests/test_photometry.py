@@ -0,0 +1,77 @@
+# Tests for the wide photometry table, colors, and absolute magnitudes
+
+import numpy as np
+import pytest
+from simple.schema import *
+from simple.photometry import pivot_photometry, add_colors, add_absolute_magnitudes, color, absolute_magnitude
+
+
+@pytest.fixture(scope="module")
+def db(fake_db):
+    # Fake sources private to this module (see conftest.py), with more photometry
+    db = fake_db
+    db.Parallaxes.insert().execute([
+        {'source': 'Fake 2', 'parallax': -1, 'parallax_error': 2., 'reference': 'Old', 'adopted': True}])
+    db.Photometry.insert().execute([
+        {'source': 'Fake 0', 'band': 'WISE_W1', 'magnitude': 14.5, 'magnitude_error': 0.03, 'telescope': 'WISE',
+         'reference': 'Old'},
+        {'source': 'Fake 0', 'band': 'WISE_W2', 'magnitude': 14.1, 'magnitude_error': 0.04, 'telescope': 'WISE',
+         'reference': 'Old'},
+        {'source': 'Fake 2', 'band': 'WISE_W1', 'magnitude': 15.0, 'magnitude_error': None, 'telescope': 'WISE',
+         'reference': 'Old'},
+        {'source': 'Fake 2', 'band': 'WISE_W2', 'magnitude': 14.8, 'magnitude_error': 0.1, 'telescope': 'WISE',
+         'reference': 'Old'},
+        {'source': 'Fake 2', 'band': 'WISE_W2', 'magnitude': 14.6, 'magnitude_error': 0.1, 'telescope': 'WISE',
+         'reference': 'New'}])
+    return db
+
+
+def test_pivot_photometry(db):
+    t = pivot_photometry(db, bands=['WISE_W1', 'WISE_W2'])
+    assert t.colnames == ['source', 'WISE_W1', 'WISE_W1_error', 'WISE_W2', 'WISE_W2_error',
+                          'parallax', 'parallax_error']
+    assert list(t['source']) == ['Fake 0', 'Fake 1', 'Fake 2']
+    # Smallest error first, then most recent, missing values are NaN
+    np.testing.assert_array_equal(t['WISE_W1'], [14.5, 14.2, 15.0])
+    np.testing.assert_array_equal(t['WISE_W1_error'], [0.03, 0.05, np.nan])
+    np.testing.assert_array_equal(t['WISE_W2'], [14.1, np.nan, 14.6])
+    # Adopted parallax
+    np.testing.assert_array_equal(t['parallax'], [10, np.nan, -1])
+
+    # Requested sources, in order, including unknown ones
+    t = pivot_photometry(db, bands=['WISE_W1'], sources=['Fake 1', 'Unknown', 'Fake 0'], parallaxes=False,
+                         fmt='pandas')
+    assert list(t.columns) == ['source', 'WISE_W1', 'WISE_W1_error']
+    assert list(t['source']) == ['Fake 1', 'Unknown', 'Fake 0']
+    np.testing.assert_array_equal(t['WISE_W1'], [14.2, np.nan, 14.5])
+
+    # Most recent first
+    t = pivot_photometry(db, bands=['WISE_W2'], rules=['most_recent'], parallaxes=False)
+    np.testing.assert_array_equal(t['WISE_W2'], [14.1, np.nan, 14.6])
+    with pytest.raises(ValueError):
+        pivot_photometry(db, rules=['preferred_regime'])
+
+
+def test_colors_and_absolute_magnitudes(db):
+    t = pivot_photometry(db, bands=['WISE_W1', 'WISE_W2'])
+    add_colors(t, [('WISE_W1', 'WISE_W2')])
+    add_absolute_magnitudes(t, ['WISE_W1'])
+
+    np.testing.assert_allclose(t['WISE_W1-WISE_W2'], [0.4, np.nan, 0.4])
+    np.testing.assert_allclose(t['WISE_W1-WISE_W2_error'], [0.05, np.nan, np.nan])
+    # 10 mas is 100 pc, non-positive and missing parallaxes give NaN
+    np.testing.assert_allclose(t['M_WISE_W1'], [14.5 - 5, np.nan, np.nan])
+    np.testing.assert_allclose(t['M_WISE_W1_error'], [np.hypot(0.03, 5 / np.log(10) * 0.1), np.nan, np.nan])
+
+
+def test_vectorized():
+    # Arrays of any shape, eg a magnitude matrix with a parallax column
+    magnitudes = np.array([[10., 11.], [12., np.nan]])
+    errors = np.full((2, 2), 0.1)
+    m, e = absolute_magnitude(magnitudes, errors, np.array([[100.], [0.]]), np.array([[0.], [1.]]))
+    np.testing.assert_allclose(m, [[10., 11.], [np.nan, np.nan]])
+    np.testing.assert_allclose(e, [[0.1, 0.1], [np.nan, np.nan]])
+
+    c, e = color([10., np.nan], [0.3, 0.3], [9., 9.], [0.4, 0.4])
+    np.testing.assert_allclose(c, [1., np.nan])
+    np.testing.assert_allclose(e, [0.5, 0.5])
@@ -0,0 +1,83 @@
+# Tests for the canonical JSON writer and the fast reader
+
+import json
+import math
+from datetime import datetime
+from astrodbkit2.utils import datetime_json_parser
+from simple.schema import Base
+from simple.serialization import canonical_data, dumps, write_json, read_json, dumps_row, read_ndjson
+
+DATA = {'Photometry': [{'band': 'WISE.W1', 'magnitude': 15.25, 'source': 'Fake 1'},
+                       {'band': '2MASS.J', 'magnitude': 16.0, 'source': 'Fake 1'}],
+        'Names': [{'other_name': 'Fake 1 α', 'source': 'Fake 1'}],
+        'Sources': [{'source': 'Fake 1', 'ra': 1e-07, 'dec': float('nan'), 'epoch': None, 'shortname': '0001+1234',
+                     'reference': 'Ref 1'}],
+        'Versions': [{'adopted': True, 'count': 3, 'end_date': datetime(2021, 1, 2, 3, 4, 5)}]}
+
+
+def test_canonical_data():
+    # Order of Database.save_json: primary table first, then schema order, with rows in primary key order
+    data = canonical_data(DATA, metadata=Base.metadata)
+    assert list(data) == ['Sources', 'Names', 'Photometry', 'Versions']
+    assert list(data['Sources'][0]) == ['source', 'ra', 'dec', 'epoch', 'shortname', 'reference']
+    assert list(data['Photometry'][0]) == ['source', 'band', 'magnitude']
+    assert [row['band'] for row in data['Photometry']] == ['2MASS.J', 'WISE.W1']
+
+    # Order of the input does not matter
+    shuffled = {key: [{k: row[k] for k in reversed(row)} for row in value[::-1]]
+                for key, value in reversed(DATA.items())}
+    assert canonical_data(shuffled, metadata=Base.metadata) == data
+    shuffled = {key: value[::-1] for key, value in reversed(DATA.items())}
+    assert dumps(shuffled, metadata=Base.metadata) == dumps(DATA, metadata=Base.metadata)
+
+    # Rows of reference tables keep their order
+    publications = [{'reference': 'Ref 2', 'name': 'Ref 2'}, {'name': 'Ref 1'}]
+    assert canonical_data(publications, metadata=Base.metadata, table='Publications') == \
+        [{'name': 'Ref 2', 'reference': 'Ref 2'}, {'name': 'Ref 1'}]
+
+    # Without a schema, only the primary table is moved first
+    data = canonical_data(DATA)
+    assert list(data) == ['Sources', 'Photometry', 'Names', 'Versions']
+    assert data['Photometry'] == DATA['Photometry']
+
+
+def test_dumps():
+    # Same layout as json.dumps with an indent of 4, with invalid floats as null
+    text = dumps(DATA)
+    expected = canonical_data(DATA)
+    expected['Sources'][0]['dec'] = None
+    assert text == json.dumps(expected, indent=4, default=lambda x: x.isoformat())
+    assert '"ra": 1e-07' in text and '"adopted": true' in text and '\\u03b1' in text
+
+    data = json.loads(text, object_hook=datetime_json_parser)
+    assert data['Versions'][0]['end_date'] == DATA['Versions'][0]['end_date']
+    assert dumps(data) == text
+    assert dumps([]) == '[]' and dumps({}) == '{}'
+
+
+def test_write_read_json(tmp_path):
+    filename = tmp_path / 'fake_1.json'
+    assert write_json(filename, DATA, metadata=Base.metadata)
+    assert not write_json(filename, {key: value[::-1] for key, value in DATA.items()}, metadata=Base.metadata)
+
+    data = read_json(filename)
+    with open(filename) as f:
+        assert data == json.load(f, object_hook=datetime_json_parser)
+    assert isinstance(data['Versions'][0]['end_date'], datetime)
+    assert read_json(filename, parse_dates=False)['Versions'][0]['end_date'] == '2021-01-02T03:04:05'
+    assert data['Sources'][0]['dec'] is None and not math.isnan(data['Sources'][0]['ra'])
+
+    # Files written by the json module, with NaN values
+    filename.write_text(json.dumps([{'name': 'Ref 1', 'value': float('nan')}]))
+    assert math.isnan(read_json(filename)[0]['value'])
+
+
+def test_ndjson_rows(tmp_path):
+    row = DATA['Versions'][0]
+    assert dumps_row(row) == '{"adopted":true,"count":3,"end_date":"2021-01-02T03:04:05"}'
+
+    filename = tmp_path / 'Photometry.ndjson'
+    filename.write_text('\n'.join(dumps_row(row) for row in DATA['Photometry'] + DATA['Versions']) + '\n\n')
+    rows = list(read_ndjson(filename))
+    assert [number for number, _ in rows] == [1, 2, 3]
+    assert [row for _, row in rows] == DATA['Photometry'] + DATA['Versions']
@@ -0,0 +1,162 @@
+# Tests for positional queries
+
+import numpy as np
+import pytest
+from simple.schema import *
+from simple.spatial import angular_separation, cone_search, cone_search_many, crossmatch, propagate_positions, \
+    propagated_positions
+from astrodbkit2.astrodb import create_database, Database
+from astropy.table import Table
+
+N_SOURCES = 2000
+
+
+@pytest.fixture(scope="module")
+def db(tmp_path_factory):
+    # Database of random fake sources, plus some placed near RA=0 and the poles
+    filename = str(tmp_path_factory.mktemp('spatial') / 'spatial.db')
+    connection_string = 'sqlite:///' + filename
+    create_database(connection_string)
+    db = Database(connection_string)
+
+    rng = np.random.default_rng(42)
+    ra = np.concatenate([rng.uniform(0, 360, N_SOURCES), [0.0001, 359.9999, 10., 190.]])
+    dec = np.concatenate([np.degrees(np.arcsin(rng.uniform(-1, 1, N_SOURCES))), [12., 12., 89.999, 89.999]])
+    db.Publications.insert().execute([{'name': 'Ref 1'}])
+    db.Sources.insert().execute([{'source': f'Fake {i}', 'ra': r, 'dec': d, 'reference': 'Ref 1'}
+                                 for i, (r, d) in enumerate(zip(ra, dec))])
+    db.Names.insert().execute([{'source': 'Fake 0', 'other_name': 'Fake 0'},
+                               {'source': 'Fake 0', 'other_name': 'Alias 0'},
+                               {'source': 'Fake 1', 'other_name': 'Alias 1'}])
+
+    # A fast moving source, 1 arcsec/yr to the east, with a less precise proper motion from another reference
+    db.Publications.insert().execute([{'name': 'Ref 2'}])
+    db.Sources.insert().execute([{'source': 'Mover', 'ra': 150., 'dec': 0., 'epoch': 2000., 'reference': 'Ref 1'}])
+    db.ProperMotions.insert().execute([
+        {'source': 'Mover', 'mu_ra': 1000., 'mu_ra_error': 1., 'mu_dec': 0., 'mu_dec_error': 2., 'reference': 'Ref 1'},
+        {'source': 'Mover', 'mu_ra': 900., 'mu_ra_error': 50., 'mu_dec': 0., 'mu_dec_error': 50.,
+         'reference': 'Ref 2'}])
+
+    yield db
+
+    db.session.close()
+    db.engine.dispose()
+
+
+def brute_force(db, ra, dec, radius):
+    t = db.query(db.Sources).table()
+    sep = angular_separation(ra, dec, np.array(t['ra']), np.array(t['dec']))
+    return set(t['source'][sep <= radius])
+
+
+def test_angular_separation():
+    assert np.isclose(angular_separation(0, 0, 1, 0), 1)
+    assert np.isclose(angular_separation(359.5, 0, 0.5, 0), 1)
+    assert np.isclose(angular_separation(0, 89, 180, 89), 2)
+
+
+@pytest.mark.parametrize('ra, dec, radius', [(120., 30., 5.), (0., 12., 0.01), (359.99, 12., 0.01),
+                                             (100., 89.99, 0.02), (200., -45., 20.)])
+def test_cone_search(db, ra, dec, radius):
+    t = cone_search(db, ra, dec, radius)
+    assert set(t['source']) == brute_force(db, ra, dec, radius)
+    assert np.all(np.diff(t['separation']) >= 0)
+
+
+def test_cone_search_units(db):
+    t = cone_search(db, 0., 12., '0.2s')
+    assert len(t) == 0
+    t = cone_search(db, 0., 12., '2s')
+    assert sorted(t['source']) == [f'Fake {N_SOURCES}', f'Fake {N_SOURCES + 1}']
+    rows = cone_search(db, 0., 12., 2 / 3600., fmt='default')
+    assert [row[0] for row in rows] == list(t['source'])
+
+
+def test_cone_search_many(db):
+    ra = np.array([120., 0., 100., 5.])
+    dec = np.array([30., 12., 89.99, -80.])
+    radius = np.array([5., 0.01, 0.02, 0.])
+    t = cone_search_many(db, ra, dec, radius)
+    for i in range(len(ra)):
+        assert set(t['source'][t['index'] == i]) == brute_force(db, ra[i], dec[i], radius[i])
+
+    t = cone_search_many(db, [5.], [-80.], 1e-6, fmt='pandas')
+    assert len(t) == 0
+
+
+def test_crossmatch(db):
+    sources = db.query(db.Sources).filter(db.Sources.c.source.in_(['Fake 0', 'Fake 7'])).table()
+    sources.sort('source')
+    catalog = Table({'ra': [sources['ra'][0] + 1e-4, sources['ra'][1], 0., 33.3, np.nan],
+                     'dec': [sources['dec'][0], sources['dec'][1], 12., -33.3, np.nan],
+                     'name': ['Fake 0', 'New 1', 'New 2', 'alias 1', 'ALIAS 0']})
+
+    # Positional matching only
+    results = crossmatch(db, catalog, '2s')
+    assert list(results['matched']) == [0, 1]
+    assert list(results['source']) == ['Fake 0', 'Fake 7']
+    assert np.allclose(results['separation'], [1e-4 * np.cos(np.radians(sources['dec'][0])), 0])
+    assert list(results['unmatched']) == [3, 4]
+    assert list(results['ambiguous']) == [2]
+    assert results['candidates'] == [[f'Fake {N_SOURCES}', f'Fake {N_SOURCES + 1}']]
+    assert np.all(results['candidate_separations'][0] * 3600 < 2)
+
+    # Including names
+    results = crossmatch(db, catalog, '2s', name_col='name')
+    assert list(results['matched']) == [0, 1, 3, 4]
+    assert list(results['source']) == ['Fake 0', 'Fake 7', 'Fake 1', 'Fake 0']
+    assert results['separation'][2] * 3600 > 2  # matched by name only
+    assert np.isnan(results['separation'][3])
+    assert len(results['unmatched']) == 0
+
+
+def test_propagate_positions():
+    # 1 arcsec/yr for 10 years
+    ra, dec, ra_error, dec_error = propagate_positions([0., 359.9999, 0., 10.], [0., 0., 89.9999, 30.], 2000.,
+                                                       [1000., 1000., 0., np.nan], [0., 0., 1000., 1000.], 2010.,
+                                                       [1., 1., 1., 1.], [2., 2., 2., 2.])
+    assert np.allclose(ra[:2], [10 / 3600, (359.9999 + 10 / 3600) % 360])
+    assert np.allclose(dec[:2], 0)
+    # Across the pole
+    assert np.isclose(angular_separation(0., 89.9999, ra[2], dec[2]), 10 / 3600)
+    assert np.isclose(ra[2], 180.)
+    # Without a proper motion, the position is unchanged
+    assert (ra[3], dec[3]) == (10., 30.)
+    assert np.allclose(ra_error, [10, 10, 10, np.nan], equal_nan=True)
+    assert np.allclose(dec_error, [20, 20, 20, np.nan], equal_nan=True)
+
+    # Broadcasting, and backwards in time
+    ra, dec, ra_error, dec_error = propagate_positions(0., 0., [2000., np.nan], 0., -1000., 1990.)
+    assert np.allclose(dec, [10 / 3600, 0])
+    assert np.all(np.isnan(ra_error))
+
+
+def test_propagated_positions(db):
+    t = propagated_positions(db, 2020., sources=['Mover', 'Fake 0', 'Unknown'])
+    assert list(t['source']) == ['Fake 0', 'Mover']
+    # Most precise proper motion
+    assert np.allclose(t['ra'], [db.query(db.Sources.c.ra).filter(db.Sources.c.source == 'Fake 0').scalar(),
+                                 150. + 20 / 3600])
+    assert np.allclose(t['ra_error'], [np.nan, 20.], equal_nan=True)
+    assert np.allclose(t['dec_error'], [np.nan, 40.], equal_nan=True)
+    assert np.allclose(t['epoch'], [np.nan, 2020.], equal_nan=True)
+    assert len(propagated_positions(db, 2020., fmt='pandas')) == N_SOURCES + 5
+
+
+def test_epoch_matching(db):
+    ra, dec = 150. + 20 / 3600, 0.
+    assert 'Mover' not in cone_search(db, ra, dec, '1s')['source']
+    t = cone_search(db, ra, dec, '1s', epoch=2020.)
+    assert list(t['source']) == ['Mover']
+    assert t['separation'][0] < 1e-9
+    # Stored positions are returned
+    assert t['ra'][0] == 150.
+
+    t = cone_search_many(db, [ra, 150.], [dec, dec], '1s', epoch=2020.)
+    assert list(t['index']) == [0]
+    assert list(t['source']) == ['Mover']
+
+    results = crossmatch(db, Table({'ra': [ra, 150.], 'dec': [dec, dec]}), '1s', epoch=2020.)
+    assert list(results['matched']) == [0]
+    assert list(results['source']) == ['Mover']
+    assert list(results['unmatched']) == [1]
@@ -0,0 +1,90 @@
+# Tests for the per-source summary
+
+import pytest
+from simple.schema import *
+from simple.database import connect
+from simple.summary import source_summary, create_summary_table, refresh_summary, read_summary, summary_table, \
+    SOURCE_COLUMNS, SUMMARY_MEASUREMENTS, SUMMARY_BANDS, SUMMARY_COUNTS, SUMMARY_TABLE
+
+
+@pytest.fixture(scope="module")
+def db(fake_db):
+    # Fake sources private to this module (see conftest.py), with measurements of every kind
+    db = fake_db
+    db.Names.insert().execute([{'source': 'Fake 0', 'other_name': name} for name in ('Fake 0', 'Other 0')])
+    db.Parallaxes.insert().execute([
+        {'source': 'Fake 1', 'parallax': 20, 'parallax_error': 2., 'reference': 'Old', 'adopted': None},
+        {'source': 'Fake 1', 'parallax': 21, 'parallax_error': 1., 'reference': 'New', 'adopted': None}])
+    db.ProperMotions.insert().execute([
+        {'source': 'Fake 1', 'mu_ra': 100, 'mu_ra_error': 5, 'mu_dec': -50, 'mu_dec_error': 5, 'reference': 'Old'}])
+    db.Gravities.insert().execute([{'source': 'Fake 2', 'gravity': 'vlg', 'regime': 'nir', 'reference': 'Old'}])
+    db.Photometry.insert().execute([
+        {'source': 'Fake 1', 'band': 'WISE_W2', 'magnitude': 13.9, 'magnitude_error': None, 'telescope': 'WISE',
+         'reference': 'Old'}])
+    return db
+
+
+def test_source_summary(db):
+    t = source_summary(db)
+    expected = SOURCE_COLUMNS + [c for config in SUMMARY_MEASUREMENTS.values() for c in config['columns']] + \
+        [c for band in SUMMARY_BANDS for c in (band, band + '_error')] + list(SUMMARY_COUNTS)
+    assert t.colnames == expected
+    assert list(t['source']) == ['Fake 0', 'Fake 1', 'Fake 2']
+
+    # Adopted measurement first, otherwise the adoption rules
+    assert list(t['parallax']) == [10, 21, None]
+    assert list(t['parallax_reference']) == ['Old', 'New', None]
+    assert list(t['spectral_type_string']) == ['L9', None, None]
+    assert list(t['mu_ra']) == [None, 100, None]
+    assert list(t['gravity']) == [None, None, 'vlg']
+    assert list(t['WISE_W1']) == [None, 14.2, None]
+    assert list(t['WISE_W1_error']) == [None, 0.05, None]
+    assert list(t['WISE_W2']) == [None, 13.9, None]
+    assert list(t['n_names']) == [2, 0, 0]
+    assert list(t['n_photometry']) == [0, 3, 0]
+
+    # Selected sources
+    t = source_summary(db, sources=['Fake 1', 'Not a source'], fmt='pandas')
+    assert list(t['source']) == ['Fake 1'] and list(t['parallax']) == [21]
+
+
+def test_materialized_summary(db):
+    with pytest.raises(RuntimeError):
+        read_summary(db)
+
+    assert create_summary_table(db) == 3
+    hidden = connect(str(db.engine.url))
+    assert SUMMARY_TABLE not in hidden.metadata.tables
+    hidden.engine.dispose()
+
+    def same_as_query():
+        return [tuple(row) for row in read_summary(db, refresh=False)] == [tuple(row) for row in source_summary(db)]
+
+    assert same_as_query()
+    assert read_summary(db).colnames == source_summary(db).colnames
+    assert refresh_summary(db) == 0
+
+    # Only the changed sources are refreshed
+    db.Parallaxes.update().where(db.Parallaxes.c.source == 'Fake 1').values(adopted=False).execute()
+    db.Parallaxes.update().where(db.Parallaxes.c.reference == 'Old').where(db.Parallaxes.c.source == 'Fake 1'). \
+        values(adopted=True).execute()
+    db.Sources.insert().execute([{'source': 'Fake 3', 'ra': 3, 'dec': -3, 'reference': 'New'}])
+    db.Names.delete().where(db.Names.c.other_name == 'Other 0').execute()
+    assert not same_as_query()
+    assert refresh_summary(db) == 3
+    assert same_as_query()
+
+    t = read_summary(db, sources=['Fake 1', 'Fake 3', 'Fake 4'])
+    assert list(t['source']) == ['Fake 1', 'Fake 3']
+    assert list(t['parallax']) == [20, None]
+
+    # Deleted sources are removed from the summary
+    db.Sources.delete().where(db.Sources.c.source == 'Fake 3').execute()
+    assert list(read_summary(db)['source']) == ['Fake 0', 'Fake 1', 'Fake 2']
+    assert refresh_summary(db, full=True) == 3
+
+    # The summary table is indexed for queries
+    with db.engine.connect() as conn:
+        table = summary_table()
+        rows = conn.execute(table.select().where(table.c.dec.between(-1.5, -0.5))).fetchall()
+    assert [row.source for row in rows] == ['Fake 1']
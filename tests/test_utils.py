@@ -1,34 +1,21 @@
 # Test to verify funtions in utils
 
 import os
+import json
 import pytest
+from sqlalchemy.exc import IntegrityError
 from simple.schema import *
-from astrodbkit2.astrodb import create_database, Database
 from scripts.ingests.utils import *
 from astropy.table import Table
 
-DB_NAME = 'temp.db'
-DB_PATH = 'data'
-
 
 # Load the database for use in individual tests
 @pytest.fixture(scope="module")
-def db():
-    # Create a fresh temporary database and assert it exists
-    # Because we've imported simple.schema, we will be using that schema for the database
-
-    if os.path.exists(DB_NAME):
-        os.remove(DB_NAME)
-    connection_string = 'sqlite:///' + DB_NAME
-    create_database(connection_string)
-    assert os.path.exists(DB_NAME)
-
-    # Connect to the new database and confirm it has the Sources table
-    db = Database(connection_string)
-    assert db
-    assert 'source' in [c.name for c in db.Sources.columns]
-
-    return db
+def db(empty_db):
+    # Empty database with the SIMPLE schema, private to this module (see conftest.py)
+    # Confirm it has the Sources table
+    assert 'source' in [c.name for c in empty_db.Sources.columns]
+    return empty_db
 
 
 # Create fake astropy Table of data to load
@@ -53,10 +40,91 @@ def test_setup_db(db):
     db.Sources.insert().execute(source_data)
 
 
-@pytest.mark.xfail()
-def test_check_names_simbad():
-    # TODO: set up Simbad mocking to avoid real calls; ideally also avoid user input
-    assert False
+class FakeSimbad:
+    # Recorded stand-in for Simbad, counting the queries it receives
+    objects = Table({'main_id': ['Fake 1', 'Fake 2', 'Fake 3', 'Fake 4', 'Fake 5'],
+                     'ra': [10., 20., 30., 40., 40.0002],
+                     'dec': [-10., -20., -30., -40., -40.],
+                     'otype': ['BD*', 'BD*', 'BD*', 'BD*', 'PM*']})
+    aliases = {'fake 1': 0, 'alias 1': 0, 'fake 2': 1}
+
+    def __init__(self):
+        self.n_queries = 0
+
+    def query_objects(self, names):
+        self.n_queries += 1
+        rows = [(name, self.objects['main_id'][self.aliases[name.lower()]]) for name in names
+                if name.lower() in self.aliases]
+        return Table(rows=rows, names=['user_specified_id', 'main_id']) if rows else None
+
+    def query_region(self, coordinates, radius):
+        self.n_queries += 1
+        return self.objects.copy()
+
+
+def test_check_names_simbad(tmp_path):
+    # Names resolved by name (2), position (1), not at all (1), one and two objects nearby
+    names = ['Alias 1', 'FAKE 2', 'New 3', 'New 6', 'New 1']
+    ra = [0., 0., 30.0001, 50., 10.]
+    dec = [0., 0., -30., -50., -10.]
+    cache_file = str(tmp_path / 'simbad_cache.json')
+
+    service = FakeSimbad()
+    resolver = SimbadResolver(cache_file=cache_file, chunk_size=2, service=service)
+    resolved = check_names_simbad(names, ra, dec, radius='2s', resolver=resolver)
+    assert resolved == ['Fake 1', 'Fake 2', 'Fake 3', 'New 6', 'Fake 1']
+    assert service.n_queries == 5  # 3 chunks of names, 2 chunks of positions
+    assert os.path.exists(cache_file)
+
+    # Everything is answered from the on-disk cache
+    service = FakeSimbad()
+    resolver = SimbadResolver(cache_file=cache_file, service=service)
+    assert resolver.resolve(names, ra, dec, radius='2s') == resolved
+    assert service.n_queries == 0
+
+    regions = resolver.query_regions([40.00005], [-40.])
+    assert service.n_queries == 1
+    assert [x['main_id'] for x in regions[0]] == ['Fake 4', 'Fake 5']
+
+    # Expired entries are queried again
+    resolver = SimbadResolver(cache_file=cache_file, ttl=0, service=service)
+    resolver.query_names(names)
+    assert service.n_queries == 2
+
+
+def test_ambiguity_policies(db, tmp_path, monkeypatch):
+    # Two objects (Fake 4 and Fake 5) are within 2 arcsec of the position
+    names, ra, dec = ['New 4'], [40.00005], [-40.]
+    resolver = SimbadResolver(cache_file=None, service=FakeSimbad())
+
+    assert resolver.resolve(names, ra, dec, policy=nearest_policy) == ['Fake 4']
+    assert resolver.resolve(names, ra, dec, policy=otype_policy(['PM*', 'BD*'])) == ['Fake 5']
+    assert resolver.resolve(names, ra, dec, policy=otype_policy(['WD*'], fallback=nearest_policy)) == ['Fake 4']
+
+    # Names are compared after normalization (case, whitespace, Simbad prefixes)
+    db.Names.insert().execute([{'source': 'Fake 3', 'other_name': 'FAKE\t 5'}])
+    assert resolver.resolve(names, ra, dec, policy=known_names_policy(db)) == ['Fake 5']
+
+    # Deferred ambiguities are written to the review file and can be resolved from it later
+    review_file = str(tmp_path / 'review.json')
+    assert resolver.resolve(names, ra, dec, policy=defer_policy, review_file=review_file) == [None]
+    with open(review_file) as f:
+        entries = json.load(f)
+    assert [entry['ingest_name'] for entry in entries] == ['New 4']
+    assert [x['main_id'] for x in entries[0]['candidates']] == ['Fake 4', 'Fake 5']
+    assert resolver.resolve(names, ra, dec, policy=review_policy(review_file)) == [None]
+
+    entries[0]['selection'] = 'Fake 5'
+    with open(review_file, 'w') as f:
+        json.dump(entries, f)
+    assert resolver.resolve(names, ra, dec, policy=review_policy(review_file)) == ['Fake 5']
+
+    # By default, ambiguities are deferred to simbad_review.json in the working directory, without asking
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr('builtins.input', lambda *args: pytest.fail('input() called'))
+    assert check_names_simbad(names, ra, dec, resolver=resolver) == [None]
+    with open(tmp_path / SIMBAD_REVIEW_FILE) as f:
+        assert [entry['ingest_name'] for entry in json.load(f)] == ['New 4']
 
 
 def test_convert_spt_string_to_code():
@@ -64,9 +132,38 @@ def test_convert_spt_string_to_code():
     assert convert_spt_string_to_code(['M5.6']) == [65.6]
     assert convert_spt_string_to_code(['T0.1']) == [80.1]
     assert convert_spt_string_to_code(['Y2pec']) == [92]
-
-
-def test_ingest_parallaxes(db, t):
+    assert convert_spt_string_to_code(['T', '>L', 'Lpec']) == [80, 70, 70]
+    # Ranges and composite types get the code of their first type, prefixes are skipped
+    assert convert_spt_string_to_code(['L4-5', 'L7/T3', 'd/sdM4']) == [74, 77, 64]
+    assert np.isnan(convert_spt_string_to_code(['Fake'])[0])
+
+
+def test_parse_spectral_types():
+    t = parse_spectral_types(Table({'spt': ['sdM4', '≥Y4', 'L2:', 'L0blue', 'L1-L3', 'M9.5V', 'L4γ', 'Fake', 'L2:']})['spt'])
+    assert list(t['spectral_type_code'][:7]) == [64, 94, 72, 70, 71, 69.5, 74]
+    assert list(t['prefix'][:2]) == ['sd', '≥']
+    assert list(t['uncertain']) == [False, False, True, False, False, False, False, False, True]
+    assert list(t['peculiarity'][[3, 6]]) == ['blue', 'γ']
+    assert t['luminosity_class'][5] == 'V'
+    assert t['spectral_type_error'][4] == 2
+    assert list(t['failed']) == [False] * 7 + [True, False]
+
+    # Range, composite (not averaged), and combined prefix
+    t = parse_spectral_types(['L4-5', 'L7/T3', 'd/sdM4'])
+    assert list(t['spectral_type_code']) == [74, 77, 64]
+    assert t['spectral_type_error'][0] == 1 and np.isnan(t['spectral_type_error'][1])
+    assert list(t['second_type']) == ['L5', 'T3', '']
+    assert list(t['composite']) == [False, True, False]
+    assert t['prefix'][2] == 'd/sd'
+
+
+def test_convert_spt_code_to_string():
+    assert list(convert_spt_code_to_string([65.5, 70, 92, 79.99, np.nan, 120])) == ['M5.5', 'L0', 'Y2', 'T0', '', '']
+    codes = convert_spt_string_to_code(['M0', 'L3.5', 'T8', 'Y1'])
+    assert list(convert_spt_code_to_string(codes)) == ['M0', 'L3.5', 'T8', 'Y1']
+
+
+def test_ingest_parallaxes(db, t, capsys):
     # Test ingest of parallax data
     ingest_parallaxes(db, t['source'], t['plx'], t['plx_err'], t['plx_ref'], verbose=False, norun=False)
 
@@ -77,3 +174,51 @@ def test_ingest_parallaxes(db, t):
     assert results['source'][0] == 'Fake 3'
     assert results['parallax'][0] == 155
     assert results['parallax_error'][0] == 0.6
+
+    # A new measurement with a smaller error becomes the adopted one
+    ingest_parallaxes(db, ['fake 1', 'Fake 2'], [114, 146], [0.1, 0.9], ['Ref 2', 'Ref 2'])
+    results = db.query(db.Parallaxes).filter(db.Parallaxes.c.adopted.is_(True)).table()
+    assert sorted(zip(results['source'], results['reference'])) == [('Fake 1', 'Ref 2'), ('Fake 2', 'Ref 1'),
+                                                                     ('Fake 3', 'Ref 2')]
+
+    # Dry run and unknown sources leave the database unchanged
+    rows = ingest_parallaxes(db, ['Fake 3'], [156], [0.01], ['Ref 1'], norun=True)
+    assert rows == [{'source': 'Fake 3', 'parallax': 156, 'parallax_error': 0.01, 'reference': 'Ref 1',
+                     'adopted': True}]
+    capsys.readouterr()
+    ingest_parallaxes(db, ['Fake 3', 'Fake 3'], [156, 157], [0.01, 0.02], ['Ref 2', 'Ref 2'], norun=True)
+    output = capsys.readouterr().out.splitlines()
+    assert len(output) == 2 and 'UNIQUE constraint failed' in output[0]
+    assert output[1].endswith('(same primary key as a previous row)')
+    with pytest.raises(RuntimeError, match='not found in the database: Fake 9'):
+        ingest_parallaxes(db, ['Fake 3', 'Fake 9'], [156, 1], [0.01, 1], ['Ref 1', 'Ref 1'])
+    assert len(db.query(db.Parallaxes).table()) == 5
+
+
+def test_ingest_proper_motions_radial_velocities(db, t, capsys):
+    # NaN is stored as NULL, rejected by the schema for mu_dec: nothing is added
+    with pytest.raises(IntegrityError, match='ck_ProperMotions_mu_dec'):
+        ingest_proper_motions(db, t['source'], [1, 2, 3], [0.1, 0.2, 0.3], [-1, -2, np.nan], [0.1, 0.2, 0.3],
+                              t['plx_ref'])
+    assert len(db.query(db.ProperMotions).table()) == 0
+
+    # A dry run reports the rejected rows instead of failing
+    capsys.readouterr()
+    rows = ingest_proper_motions(db, t['source'], [1, 2, 3], [0.1, 0.2, 0.3], [-1, -2, np.nan], [0.1, 0.2, 0.3],
+                                 t['plx_ref'], norun=True)
+    assert len(rows) == 3
+    output = capsys.readouterr().out.splitlines()
+    assert len(output) == 1 and output[0].startswith("Rejected by the database: {'source': 'Fake 3'")
+    assert 'ck_ProperMotions_mu_dec' in output[0]
+    assert len(db.query(db.ProperMotions).table()) == 0
+
+    ingest_proper_motions(db, t['source'], [1, 2, 3], [0.1, 0.2, np.nan], [-1, -2, -3], [0.1, 0.2, 0.3],
+                          t['plx_ref'])
+    results = db.query(db.ProperMotions).table()
+    assert len(results) == 3
+    assert list(results['mu_ra']) == [1, 2, 3]
+    assert results['mu_ra_error'][2] is None  # NaN stored as NULL
+
+    ingest_radial_velocities(db, t['source'][:2], [10., -5.], [1., 2.], ['Ref 1', 'Ref 1'])
+    results = db.query(db.RadialVelocities).table()
+    assert list(results['radial_velocity']) == [10, -5]
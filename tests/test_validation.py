@@ -0,0 +1,135 @@
+# Tests for the validation rules
+
+import json
+import subprocess
+import pytest
+from sqlalchemy import text
+from simple.schema import *
+from simple.validation import validate, validation_query, check_constraints, changes_from_files, changes_from_git, \
+    VALIDATION_RULES
+
+
+@pytest.fixture(scope="module")
+def db(empty_db):
+    # Empty database private to this module (see conftest.py), with a few fake sources breaking some rules
+    db = empty_db
+    db.Publications.insert().execute([{'name': 'Ref 1', 'bibcode': '2001ApJ...1....1A', 'doi': '10.1/1'},
+                                      {'name': 'Unused', 'bibcode': None, 'doi': '10.1/2'}])
+    db.Sources.insert().execute([{'source': 'Good', 'ra': 10., 'dec': 10., 'reference': 'Ref 1'},
+                                 {'source': 'Unnamed', 'ra': 10., 'dec': 10., 'reference': 'Ref 1'}])
+    db.Names.insert().execute([{'source': 'Good', 'other_name': 'Good'}])
+    db.Photometry.insert().execute([{'source': 'Good', 'band': 'WISE_W1', 'magnitude': 14.5, 'reference': 'Ref 1'}])
+    db.Parallaxes.insert().execute([{'source': 'Good', 'parallax': 10, 'reference': 'Ref 1', 'adopted': True}])
+    # Rows rejected by the schema (see simple.schema), inserted as in a database built with an older schema
+    with db.engine.connect() as conn:
+        conn.execute(text("PRAGMA foreign_keys=OFF"))
+        conn.execute(text("PRAGMA ignore_check_constraints=ON"))
+        conn.execute(text("DROP INDEX ix_Parallaxes_adopted"))
+        conn.execute(db.Sources.insert(), [{'source': 'Bad', 'ra': 400., 'dec': 10., 'reference': 'Ref 1'}])
+        conn.execute(db.Names.insert(), [{'source': 'Bad', 'other_name': 'Alias'}])
+        conn.execute(db.Photometry.insert(), [{'source': 'Bad', 'band': 'WISE_W1', 'magnitude': -1.,
+                                               'reference': 'Ref 1'}])
+        conn.execute(db.Parallaxes.insert(), [{'source': 'Bad', 'parallax': 10, 'reference': 'Ref 1', 'adopted': True},
+                                              {'source': 'Bad', 'parallax': 11, 'reference': 'Unused',
+                                               'adopted': True}])
+        # Reference to a missing publication
+        conn.execute(text("INSERT INTO ProperMotions (source, mu_ra, mu_dec, reference) "
+                          "VALUES ('Good', 1, NULL, 'Missing')"))
+        conn.execute(text("PRAGMA ignore_check_constraints=OFF"))
+        conn.execute(text("PRAGMA foreign_keys=ON"))
+    return db
+
+
+def test_validate(db):
+    t = validate(db, enforced=True)
+    assert t.colnames == ['rule', 'level', 'table', 'key', 'description']
+    violations = {(rule, key) for rule, key in zip(t['rule'], t['key'])}
+    assert violations == {
+        ('adopted_parallax', 'source=Bad, reference=Ref 1'), ('adopted_parallax', 'source=Bad, reference=Unused'),
+        ('magnitude_range', 'source=Bad, band=WISE_W1, reference=Ref 1'),
+        ('missing_proper_motion', 'source=Good, reference=Missing'),
+        ('unknown_reference_ProperMotions', 'source=Good, reference=Missing'),
+        ('missing_bibcode', 'name=Unused'),
+        ('coordinates', 'source=Bad'), ('missing_source_name', 'source=Bad'),
+        ('missing_names', 'source=Unnamed'), ('missing_source_name', 'source=Unnamed')}
+    assert set(t['level'][t['rule'] == 'missing_bibcode']) == {'warning'}
+    assert list(t['table']) == sorted(t['table'])
+
+    # Rules enforced by the CHECK constraints of the database are not checked by default
+    assert 'ck_Photometry_magnitude' in check_constraints(db)
+    t = validate(db)
+    assert len(t) == len(violations) - 2
+    assert not set(t['rule']) & {'magnitude_range', 'missing_proper_motion'}
+
+    # Selection of tables and rules
+    t = validate(db, tables=['Sources'], fmt='pandas')
+    assert set(t['rule']) == {'coordinates', 'missing_names', 'missing_source_name'}
+    assert validate(db, rules=['missing_gravity'], fmt='default') == []
+
+
+def test_validation_query(db):
+    # All the rules of a table are checked with a single scan of the table
+    rules = [rule for rule in VALIDATION_RULES.values() if rule['table'] == 'Parallaxes']
+    query = validation_query(db.metadata.tables, 'Parallaxes', rules)
+    with db.engine.connect() as conn:
+        plan = conn.execute(text('EXPLAIN QUERY PLAN ' + str(query.compile(db.engine,
+                                                                           compile_kwargs={'literal_binds': True}))))
+        assert sum('Parallaxes' in row[-1] and 'SCAN' in row[-1] for row in plan) == 1
+        rows = conn.execute(query).fetchall()
+    assert [tuple(row) for row in rows] == [('Bad', 'Ref 1', 1, 0), ('Bad', 'Unused', 1, 0)]
+
+    # The rows of some sources are found with the index
+    query = validation_query(db.metadata.tables, 'Parallaxes', rules, sources=['Good'])
+    with db.engine.connect() as conn:
+        plan = conn.execute(text('EXPLAIN QUERY PLAN ' + str(query.compile(db.engine,
+                                                                           compile_kwargs={'literal_binds': True}))))
+        assert not any('Parallaxes' in row[-1] and 'SCAN' in row[-1] for row in plan)
+        assert conn.execute(query).fetchall() == []
+
+
+def test_validate_changes(db):
+    # Only the rows of the changed sources
+    full = validate(db)
+    t = validate(db, changes={'sources': ['Bad'], 'tables': []})
+    assert list(t['key']) == [key for key in full['key'] if key.startswith('source=Bad')]
+    assert len(validate(db, changes={'sources': ['Good'], 'tables': []}, enforced=True)) == 2
+    assert len(validate(db, changes={'sources': [], 'tables': []})) == 0
+
+    # All the references, and the Publications rules, when Publications changed
+    t = validate(db, changes={'sources': [], 'tables': ['Publications']})
+    assert set(t['rule']) == {'missing_bibcode', 'unknown_reference_ProperMotions'}
+
+
+def write_source(filename, source):
+    with open(filename, 'w') as f:
+        json.dump({'Sources': [{'source': source, 'ra': 0., 'dec': 0.}]}, f)
+
+
+def test_changes(tmp_path, monkeypatch):
+    # Changed sources and reference tables from file names, and from git revisions
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'data').mkdir()
+    write_source('data/a.json', 'A')
+    write_source('data/b.json', 'B')
+    write_source('data/c.json', 'C')
+    (tmp_path / 'data' / 'Publications.json').write_text('[]')
+    assert changes_from_files(['data/a.json', 'data/Publications.json', 'data/missing.json', 'README.md']) == \
+        {'sources': ['A'], 'tables': ['Publications']}
+
+    def git(*args):
+        subprocess.run(['git', '-c', 'user.name=test', '-c', 'user.email=test', *args], check=True,
+                       capture_output=True)
+
+    git('init')
+    git('add', 'data')
+    git('commit', '-m', 'First')
+    write_source('data/a.json', 'A2')  # renamed source
+    (tmp_path / 'data' / 'b.json').unlink()
+    write_source('data/d.json', 'D')
+    git('add', '-A', 'data')
+    git('commit', '-m', 'Second')
+    (tmp_path / 'data' / 'Publications.json').write_text('[{"name": "Ref 1"}]')
+
+    assert changes_from_git('HEAD~1') == {'sources': ['A', 'A2', 'B', 'D'], 'tables': ['Publications']}
+    assert changes_from_git('HEAD~1..HEAD') == {'sources': ['A', 'A2', 'B', 'D'], 'tables': []}
+    assert changes_from_git('HEAD...HEAD~1') == {'sources': [], 'tables': []}